@@ -29,6 +29,12 @@ def get_dataset_class_using_name(dataset_name):
     if dataset_name == 'avsg':
         from data.avsg_dataset import AvsgDataset
         dataset_class = AvsgDataset
+    elif dataset_name == 'avsg_mmap':
+        from data.avsg_mmap_dataset import AvsgMmapDataset
+        dataset_class = AvsgMmapDataset
+    elif dataset_name == 'avsg_stream':
+        from data.avsg_stream_dataset import AvsgStreamDataset
+        dataset_class = AvsgStreamDataset
     elif dataset_name == 'toy':
         from data.toy_dataset import ToyDataset
         dataset_class = ToyDataset
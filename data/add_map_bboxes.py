@@ -0,0 +1,70 @@
+"""Add the bounding boxes of the map elements to an avsg dataset (in place), for the map cropping at load time
+(see --map_crop_radius)
+
+The matrix 'map_elems_bboxes' [n_scenes x n_polygon_types x max_num_elem x 4] (min_x, min_y, max_x, max_y)
+is added to data.h5, and is registered in info.pkl. The boxes of non-existent elements are zeros.
+
+* To run:
+$ python -m data.add_map_bboxes --data_path datasets/avsg_data/sample
+"""
+import argparse
+import pickle
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from data.repack_h5 import check_not_encoded
+
+
+#########################################################################################
+
+def get_elems_bboxes_np(map_elems_points, map_elems_n_points_orig):
+    """ [... x 4] (min_x, min_y, max_x, max_y) of the real points of each element, from points [... x n_points x 2] """
+    is_real_point = np.arange(map_elems_points.shape[-2]) < map_elems_n_points_orig[..., np.newaxis]
+    is_real_point = is_real_point[..., np.newaxis]
+    mins = np.where(is_real_point, map_elems_points, np.inf).min(axis=-2)
+    maxs = np.where(is_real_point, map_elems_points, -np.inf).max(axis=-2)
+    bboxes = np.concatenate([mins, maxs], axis=-1)
+    bboxes[np.logical_not(np.isfinite(bboxes))] = 0.
+    return bboxes.astype(np.float32)
+
+
+def add_map_bboxes(data_path, n_scenes_per_copy=1024):
+    info_file_path = Path(data_path, 'info').with_suffix('.pkl')
+    with info_file_path.open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    saved_mats_info = dataset_info['saved_mats_info']
+    check_not_encoded(dataset_info)
+    if 'map_elems_points' not in saved_mats_info or 'map_ids' in saved_mats_info:
+        raise ValueError('The bounding boxes can be added only to a dataset with padded map matrices per scene')
+    with h5py.File(Path(data_path, 'data').with_suffix('.h5'), 'a') as h5f:
+        map_elems_points = h5f['map_elems_points']
+        map_elems_exists = h5f['map_elems_exists']
+        map_elems_n_points_orig = h5f['map_elems_n_points_orig']
+        n_scenes = map_elems_points.shape[0]
+        if 'map_elems_bboxes' in h5f:
+            del h5f['map_elems_bboxes']
+        bboxes = h5f.create_dataset('map_elems_bboxes', shape=map_elems_points.shape[:-2] + (4,), dtype=np.float32,
+                                    chunks=map_elems_points.chunks[:-2] + (4,) if map_elems_points.chunks else None)
+        for i_first in range(0, n_scenes, n_scenes_per_copy):
+            i_last = min(i_first + n_scenes_per_copy, n_scenes)
+            block_bboxes = get_elems_bboxes_np(map_elems_points[i_first:i_last],
+                                               map_elems_n_points_orig[i_first:i_last])
+            block_bboxes[np.logical_not(map_elems_exists[i_first:i_last].astype(bool))] = 0.
+            bboxes[i_first:i_last] = block_bboxes
+            print(f'Processed {i_last}/{n_scenes} scenes')
+    saved_mats_info['map_elems_bboxes'] = {'entity': 'map_bbox'}
+    with info_file_path.open('wb') as fid:
+        pickle.dump(dataset_info, fid)
+    print(f'Added map_elems_bboxes to {data_path}')
+
+
+#########################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True, help='Path of the dataset dir (info.pkl + data.h5)')
+    parser.add_argument('--n_scenes_per_copy', type=int, default=1024, help='Number of scenes processed at a time')
+    args = parser.parse_args()
+    add_map_bboxes(args.data_path, args.n_scenes_per_copy)
@@ -6,17 +6,26 @@
     -- <__len__>: Return the number of samples.
 """
 
+import os
 import pathlib
 import pickle
+import shutil
 import sys
 from pathlib import Path
 
-import h5py
 import numpy as np
 import torch
 
-from data.avsg_transforms import SelectAgents, PreprocessSceneData, ReadAgentsVecs, sample_sanity_check
+from data.avsg_transforms import SelectAgents, PreprocessSceneData, ReadAgentsVecs, AugmentSceneBatch, \
+    CropMapElems, TrimMapElems, apply_map_poses, sample_sanity_check, batch_sanity_check
 from data.base_dataset import BaseDataset
+from data.dataset_stats import load_dataset_stats
+from data.feature_schema import FeatureSchema
+from data.h5_handle import H5FileHandle, ShardedH5FileHandle
+from data.packed_map import PackedMap, ranges_to_indices
+from data.scene_index import load_scene_index, query_scene_index, build_scene_index
+from data.scene_batch import SceneBatch, collate_scene_dicts
+from data.shards import is_sharded, load_manifest, get_row_refs
 
 is_windows = hasattr(sys, 'getwindowsversion')
 if is_windows:
@@ -29,6 +38,11 @@ if is_windows:
 class AvsgDataset(BaseDataset):
     """A template dataset class for you to implement custom datasets."""
 
+    # the matrices that each consumer of the batches uses, only these are read from the data file (see get_read_mat_names)
+    consumers_mat_names = {'train': ('agents_feat_vecs', 'agents_num', 'map_elems_points', 'map_elems_exists'),
+                           'val': ('agents_feat_vecs', 'agents_num', 'map_elems_points', 'map_elems_exists'),
+                           'vis': ('map_elems_n_points_orig',)}
+
     @staticmethod
     def modify_commandline_options(parser, is_train):
         """Add new dataset-specific options, and rewrite default values for existing options.
@@ -55,19 +69,51 @@ class AvsgDataset(BaseDataset):
         parser.add_argument('--default_agent_extent_length', type=float, default=4.)  # [m]
         parser.add_argument('--default_agent_extent_width', type=float, default=1.5)  # [m]
 
+        parser.add_argument('--normalize_agent_coords', type=str, default='',
+                            help="Comma-separated labels of agents coordinates to normalize with the dataset statistics"
+                                 " (e.g., 'speed', see data/dataset_stats.py). The geometric coordinates are not allowed")
+
         parser.add_argument('--max_num_agents', type=int, default=4, help=' number of agents in a scene')
 
         parser.add_argument('--augmentation_type', type=str, default='rotate_and_translate',
-                            help=" 'none' | 'rotate_and_translate")
+                            help=" 'none' | 'rotate_and_translate'")
         parser.add_argument('--shuffle_agents_inds_flag', type=int, default=1, help="")
+        parser.add_argument('--map_crop_radius', type=float, default=0.,
+                            help='[m] If positive, keep only the map elements within this distance of the crop center'
+                                 ' (see data/add_map_bboxes.py to precompute the elements bounding boxes)')
+        parser.add_argument('--map_crop_center', type=str, default='agents',
+                            help=" 'agents' (distance to the closest agent) | 'ego' ")
+        parser.add_argument('--trim_map_elems', type=int, default=0,
+                            help='If 1, the map elements of each batch are re-packed to the largest number of elements'
+                                 ' of a scene in the batch, instead of max_num_elem (best with --sampler_type bucket)')
+
+        # ~~~~  Data loading
+        parser.add_argument('--scene_query', type=str, default='',
+                            help="Use only the scenes that match this query of the scene index (see data/scene_index.py),"
+                                 " e.g. '(n_agents >= 3) & (n_crosswalks > 0)'")
+        parser.add_argument('--batched_reads', type=int, default=1,
+                            help='If 1, the sampler passes whole batches of indices and each matrix is read once per batch')
+        parser.add_argument('--sampler_type', type=str, default='shuffle',
+                            help=" 'shuffle' | 'block_shuffle' (shuffles contiguous blocks of scenes, for sequential I/O)"
+                                 " | 'bucket' (batches of scenes with similar numbers of map elements)")
+        parser.add_argument('--sampler_block_size', type=int, default=0,
+                            help='Number of scenes in a block for block_shuffle, if 0 then use the HDF5 chunk size')
+        parser.add_argument('--bucket_n_buckets', type=int, default=8,
+                            help='Number of map size buckets for the bucket sampler (by quantiles of the map sizes)')
+        parser.add_argument('--preload_data', type=str, default='none',
+                            help=" 'none' | 'shm' (load all the data to shared memory, used by all the DataLoader workers)")
+        parser.add_argument('--preload_max_gb', type=float, default=8.,
+                            help='If the data is larger than this [GB], it is not preloaded (read from disk instead)')
         return parser
 
     #########################################################################################
-    def __init__(self, opt, data_path):
+    def __init__(self, opt, data_path, consumers=None):
         """Initialize this dataset class.
 
         Parameters:
             opt (Option class) -- stores all the experiment flags; needs to be a subclass of BaseOptions
+            data_path -- the dataset dir
+            consumers -- the users of the batches (keys of consumers_mat_names), if None then all the matrices are read
 
         A few things can be done here.
         - save the options (have been done in BaseDataset)
@@ -77,19 +123,182 @@ class AvsgDataset(BaseDataset):
         # save the option and dataset root
         BaseDataset.__init__(self, opt)
         self.data_path = data_path
-        self.device = torch.device('cuda:{}'.format(opt.gpu_ids[0])) if opt.gpu_ids else torch.device('cpu')
-        info_file_path = Path(data_path, 'info').with_suffix('.pkl')
-        with info_file_path.open('rb') as fid:
-            dataset_info = pickle.load(fid)
+        # the data is prepared on the CPU (also in the DataLoader workers),
+        # the batches are moved to the training device by the BatchPrefetcher
+        dataset_info = self.load_dataset_info()
         self.dataset_props = dataset_info['dataset_props']
         self.saved_mats_info = dataset_info['saved_mats_info']
         self.n_scenes = self.dataset_props['n_scenes']
+        # a sharded dataset (data/shards.py) has a manifest of several dataset files, its scenes are numbered globally
+        self.shards = dataset_info.get('shards')
         print('Loaded dataset file ', data_path)
+        if self.shards:
+            print(f'The dataset has {len(self.shards)} shards')
         print(f"Total number of scenes loaded: {self.dataset_props['n_scenes']}")
+        # a dataset made by data/dedup_maps.py stores each map once, in a map table indexed by the scenes' map ids
+        self.has_map_table = 'map_ids' in self.saved_mats_info
+        if self.has_map_table:
+            print(f"The scenes use {self.dataset_props['n_maps']} unique maps")
+        # a dataset made by data/pack_maps.py stores only the existing map elements (the batches have a PackedMap)
+        self.has_packed_maps = self.dataset_props.get('map_layout') == 'packed'
+        # a dataset made by data/repack_h5.py --map_coords_dtype int16/float16 stores the map points as offsets from
+        # per-scene origins, which are decoded on the training device
+        self.map_coords_encoding = self.dataset_props.get('map_coords_encoding')
+        map_coords_scale = self.map_coords_encoding['scale'] if self.map_coords_encoding else 1.
         opt.polygon_types = self.dataset_props['polygon_types']
         opt.closed_polygon_types = self.dataset_props['closed_polygon_types']
         opt.agent_feat_vec_dim = len(opt.agent_feat_vec_coord_labels)
-        self.transforms = [SelectAgents(opt), ReadAgentsVecs(opt, self.dataset_props), PreprocessSceneData(opt)]
+        opt.feature_schema = FeatureSchema(opt, self.dataset_props)
+        normalize_agent_coords = [label for label in opt.normalize_agent_coords.split(',') if label]
+        if normalize_agent_coords:
+            dataset_stats = load_dataset_stats(data_path)
+            if dataset_stats is None:
+                raise ValueError(f'No dataset statistics in {data_path}, run data/dataset_stats.py first')
+            opt.feature_schema.set_normalization(dataset_stats, normalize_agent_coords)
+        self.init_data_reader()
+        self.read_mat_names = self.get_read_mat_names(consumers)
+        # the matrices of the other consumers are read only on demand, for a few scenes (see fetch_lazy_fields)
+        self.lazy_mat_names = [] if self.has_packed_maps else \
+            [mat_name for mat_name in self.saved_mats_info.keys() if mat_name not in self.read_mat_names]
+        if len(self.read_mat_names) < len(self.saved_mats_info):
+            print(f'Reading only {self.read_mat_names} (for {consumers})')
+        self.preloaded_mats = None
+        if opt.preload_data == 'shm':
+            self.preload_to_shared_memory(opt.preload_max_gb)
+        elif opt.preload_data != 'none':
+            raise NotImplementedError(f'Unrecognized opt.preload_data  {opt.preload_data}')
+        self.transforms = [SelectAgents(opt), ReadAgentsVecs(opt), PreprocessSceneData(map_coords_scale)]
+        # the map cropping and the augmentation run once per batch (see collate_fn and __getitems__)
+        self.crop_map_elems = CropMapElems(opt) if opt.map_crop_radius > 0 else None
+        # the cropping already re-packs the maps
+        self.trim_map_elems = TrimMapElems() if opt.trim_map_elems and not self.crop_map_elems else None
+        self.augment_batch = AugmentSceneBatch(opt)
+
+    #########################################################################################
+
+    def get_read_mat_names(self, consumers):
+        """Return the names of the matrices that are read for each scene, for the given consumers of the batches"""
+        if consumers is None:
+            return list(self.saved_mats_info.keys())
+        mat_names = set()
+        for consumer in consumers:
+            mat_names.update(self.consumers_mat_names[consumer])
+        if self.opt.map_crop_radius > 0 or self.opt.trim_map_elems:
+            # the map cropping computes the elements bounding boxes from their real points, and the re-packed
+            # elements cannot be matched with matrices that are read later
+            mat_names.add('map_elems_n_points_orig')
+        # the map references, the encoded map origins, the elements bounding boxes and the packed maps are needed
+        # to read the consumers matrices
+        return [mat_name for mat_name, mat_info in self.saved_mats_info.items()
+                if mat_name in mat_names or mat_name == 'map_coords_origin'
+                or mat_info['entity'] in ('map_ref', 'map_bbox', 'map_packed')]
+
+    def query_scenes(self, query):
+        """Return the indices of the scenes that match the query of the scene index (data/scene_index.py)"""
+        scene_index = load_scene_index(self.data_path)
+        if scene_index is None:
+            raise ValueError(f'No scene index in {self.data_path}, run data/scene_index.py first')
+        scenes_inds = query_scene_index(scene_index, query)
+        print(f'{len(scenes_inds)}/{self.n_scenes} scenes match the query {query!r}')
+        return scenes_inds
+
+    def get_scenes_map_sizes(self):
+        """Return the largest number of map elements of a polygon type in each scene [n_scenes] (from the scene index,
+        which is built by a one-time scan if missing)"""
+        scene_index = load_scene_index(self.data_path)
+        if scene_index is None:
+            if self.shards or not Path(self.data_path, 'data').with_suffix('.h5').exists():
+                raise ValueError(f'No scene index in {self.data_path}, the map sizes are needed for the bucket sampler')
+            print(f'Building the scene index of {self.data_path} (see data/scene_index.py)')
+            build_scene_index(self.data_path, n_workers=max(int(self.opt.num_threads), 1))
+            scene_index = load_scene_index(self.data_path)
+        return np.stack([scene_index[f'n_{poly_type}'] for poly_type in self.dataset_props['polygon_types']]).max(axis=0)
+
+    def fetch_lazy_fields(self, batch):
+        """Read the matrices that were not read for the scenes of the batch (e.g., for the few visualized scenes)"""
+        map_feat = batch['conditioning']['map_feat']
+        if isinstance(map_feat, PackedMap) or 'scene_inds' not in map_feat:
+            return batch
+        indices = map_feat['scene_inds'].cpu().numpy().astype(np.int64)
+        if self.has_map_table:
+            map_ids = self.get_mat_batch('map_ids', indices)
+            unique_map_ids, map_inverse = np.unique(map_ids, return_inverse=True)
+        for mat_name in self.lazy_mat_names:
+            if self.saved_mats_info[mat_name].get('indexed_by') == 'map_ids':
+                mat_batch = self.get_mat_batch(mat_name, unique_map_ids)[map_inverse]
+            else:
+                mat_batch = self.get_mat_batch(mat_name, indices)
+            map_feat[mat_name] = torch.from_numpy(mat_batch).to(batch.device)
+        return batch
+
+    #########################################################################################
+
+    def load_dataset_info(self):
+        """Return the dataset info dict (with the fields 'dataset_props' and 'saved_mats_info', and 'shards' if sharded)"""
+        if is_sharded(self.data_path):
+            return load_manifest(self.data_path)
+        info_file_path = Path(self.data_path, 'info').with_suffix('.pkl')
+        with info_file_path.open('rb') as fid:
+            dataset_info = pickle.load(fid)
+        return dataset_info
+
+    def init_data_reader(self):
+        # the data file is opened lazily, once per DataLoader worker
+        if self.shards:
+            self.h5_handle = ShardedH5FileHandle([Path(self.data_path, shard['path'], 'data').with_suffix('.h5')
+                                                  for shard in self.shards],
+                                                 [shard['n_rows'] for shard in self.shards],
+                                                 get_row_refs(self.saved_mats_info))
+        else:
+            self.h5_handle = H5FileHandle(Path(self.data_path, 'data').with_suffix('.h5'))
+
+    def close_data_reader(self):
+        self.h5_handle.close()
+
+    def get_mat_array(self, mat_name):
+        """Return the (lazily loaded) array of the matrix 'mat_name' of all the scenes"""
+        return self.h5_handle.get_dataset(mat_name)
+
+    def read_mat_sample(self, mat_name, index):
+        """Return the data of a single scene from the matrix 'mat_name', as a numpy array"""
+        return np.array(self.h5_handle.read(mat_name, index))
+
+    def read_mat_batch(self, mat_name, indices):
+        """Return the data of several scenes from the matrix 'mat_name', stacked as a numpy array"""
+        return self.h5_handle.read_batch(mat_name, indices)
+
+    def get_mat_sample(self, mat_name, index):
+        if self.preloaded_mats is not None and mat_name in self.preloaded_mats:
+            return self.preloaded_mats[mat_name][index].numpy()
+        return self.read_mat_sample(mat_name, index)
+
+    def get_mat_batch(self, mat_name, indices):
+        # the lazily fetched matrices are not preloaded, they are read from the data file
+        if self.preloaded_mats is not None and mat_name in self.preloaded_mats:
+            return self.preloaded_mats[mat_name][torch.from_numpy(indices)].numpy()
+        return self.read_mat_batch(mat_name, indices)
+
+    #########################################################################################
+
+    def preload_to_shared_memory(self, max_gb):
+        """Load all the matrices to shared-memory tensors, if they fit in the memory budget.
+         The forked (or spawned) DataLoader workers index the same memory, with no copy per worker.
+        """
+        n_bytes = sum(self.get_mat_array(mat_name).nbytes for mat_name in self.read_mat_names)
+        max_bytes = max_gb * 1024 ** 3
+        if os.path.isdir('/dev/shm'):
+            max_bytes = min(max_bytes, shutil.disk_usage('/dev/shm').free)
+        if n_bytes > max_bytes:
+            print(f'Data size {n_bytes / 1024 ** 2:.1f} MB is over the preload budget of {max_bytes / 1024 ** 2:.1f} MB,'
+                  f' the data will be read from disk')
+            return
+        self.preloaded_mats = {}
+        for mat_name in self.read_mat_names:
+            mat = torch.from_numpy(np.asarray(self.get_mat_array(mat_name)[()]))
+            self.preloaded_mats[mat_name] = mat.share_memory_()
+        # the data file is re-opened (lazily) only to read the matrices that are not preloaded (see fetch_lazy_fields)
+        self.close_data_reader()
+        print(f'Preloaded {n_bytes / 1024 ** 2:.1f} MB of data to shared memory')
 
     #########################################################################################
 
@@ -107,19 +316,34 @@ class AvsgDataset(BaseDataset):
         Step 3: convert your data to a PyTorch tensor. You can use helper functions such as self.transform. e.g., data = self.transform(image)
         Step 4: return a data point as a dictionary.
         """
+        if not np.isscalar(index) and not (isinstance(index, torch.Tensor) and index.ndim == 0):
+            # a batch of indices was passed by a batch sampler
+            return self.__getitems__(index)
         dataset_props = self.dataset_props
         saved_mats_info = self.saved_mats_info
         agents_feat = {}
         map_feat = {}
-        file_path = Path(self.data_path, 'data').with_suffix('.h5')
-        with h5py.File(file_path, 'r') as h5f:
-            for mat_name, mat_info in saved_mats_info.items():
-                mat_sample = np.array(h5f[mat_name][index])
-                mat_sample = torch.from_numpy(mat_sample).to(device=self.device)
-                if mat_info['entity'] == 'map':
-                    map_feat[mat_name] = mat_sample
-                else:
-                    agents_feat[mat_name] = mat_sample
+        map_index = int(self.get_mat_sample('map_ids', index)) if self.has_map_table else index
+        for mat_name in self.read_mat_names:
+            mat_info = saved_mats_info[mat_name]
+            if mat_info['entity'] == 'map_packed' or (mat_info['entity'] == 'map_bbox' and not self.crop_map_elems):
+                continue
+            if mat_info.get('indexed_by') == 'map_ids':
+                mat_sample = self.get_mat_sample(mat_name, map_index)
+            else:
+                mat_sample = self.get_mat_sample(mat_name, index)
+            mat_sample = torch.from_numpy(mat_sample)
+            if mat_info['entity'] in ('map', 'map_ref', 'map_bbox'):
+                map_feat[mat_name] = mat_sample
+            else:
+                agents_feat[mat_name] = mat_sample
+        if self.has_map_table and not self.map_coords_encoding:
+            map_feat['map_elems_points'] = apply_map_poses(map_feat['map_elems_points'], map_feat['map_poses'])
+        if self.has_packed_maps:
+            # a PackedMap of a single scene
+            map_feat = self.read_packed_maps(np.array([index], dtype=np.int64))
+        elif self.lazy_mat_names:
+            map_feat['scene_inds'] = torch.tensor(int(index))
         sample = {'agents_feat': agents_feat, 'map_feat': map_feat}
         for fn in self.transforms:
             sample = fn(sample)
@@ -128,8 +352,145 @@ class AvsgDataset(BaseDataset):
         return sample
     ########################################################################################
 
+    def __getitems__(self, indices):
+        """Return a whole batch of scenes, with one read per matrix.
+
+        Parameters:
+            indices -- a list of scene indices
+
+        Returns:
+            a SceneBatch with the same fields as in the __getitem__ dictionary, where all tensors are stacked over the scenes.
+        """
+        indices = np.array([int(index) for index in indices], dtype=np.int64)
+        return self.make_batch(self.read_scenes(indices))
+
+    def read_scenes(self, indices):
+        """Return the raw data {'agents_feat', 'map_feat'} of the scenes at 'indices' (numpy int64), stacked over the
+        scenes, with one read per matrix (a contiguous range of indices is read sequentially)"""
+        agents_feat = {}
+        map_feat = {}
+        if self.has_map_table:
+            # each of the unique maps in the batch is read once
+            map_ids = self.get_mat_batch('map_ids', indices)
+            unique_map_ids, map_inverse = np.unique(map_ids, return_inverse=True)
+        for mat_name in self.read_mat_names:
+            mat_info = self.saved_mats_info[mat_name]
+            if mat_info['entity'] == 'map_packed' or (mat_info['entity'] == 'map_bbox' and not self.crop_map_elems):
+                continue
+            if mat_name == 'map_ids' and self.has_map_table:
+                mat_batch = map_ids
+            elif mat_info.get('indexed_by') == 'map_ids':
+                mat_batch = self.get_mat_batch(mat_name, unique_map_ids)[map_inverse]
+            else:
+                mat_batch = self.get_mat_batch(mat_name, indices)
+            mat_batch = torch.from_numpy(mat_batch)
+            if mat_info['entity'] in ('map', 'map_ref', 'map_bbox'):
+                map_feat[mat_name] = mat_batch
+            else:
+                agents_feat[mat_name] = mat_batch
+        if self.has_map_table and not self.map_coords_encoding:
+            map_feat['map_elems_points'] = apply_map_poses(map_feat['map_elems_points'], map_feat['map_poses'])
+        if self.has_packed_maps:
+            map_feat = self.read_packed_maps(indices)
+        elif self.lazy_mat_names:
+            map_feat['scene_inds'] = torch.from_numpy(indices)
+        return {'agents_feat': agents_feat, 'map_feat': map_feat}
+
+    def make_batch(self, batch):
+        """Return a SceneBatch of the raw data of several scenes (from read_scenes): transformed, cropped and augmented"""
+        for fn in self.transforms:
+            batch = fn.batch_call(batch)
+        if self.crop_map_elems:
+            batch = self.crop_map_elems(batch)
+        elif self.trim_map_elems:
+            batch = self.trim_map_elems(batch)
+        batch = self.augment_batch(batch)
+
+        assert batch_sanity_check(batch)
+        return SceneBatch.from_dict(batch)
+
+    ########################################################################################
+
+    def read_packed_mats(self, mat_names, indices):
+        """Return a dict of the rows at 'indices' of each of the matrices (with one read per matrix)"""
+        if len(indices) == 0:
+            return {mat_name: np.empty((0,) + self.get_mat_array(mat_name).shape[1:],
+                                       dtype=self.get_mat_array(mat_name).dtype) for mat_name in mat_names}
+        return {mat_name: self.get_mat_batch(mat_name, indices) for mat_name in mat_names}
+
+    def read_packed_maps(self, indices):
+        """Return a PackedMap of the scenes at 'indices' (only the existing elements are read)"""
+        scenes_mat_names = ['map_scene_elems_start', 'map_scene_n_elems']
+        if self.map_coords_encoding:
+            scenes_mat_names.append('map_scene_coords_origin')
+        scenes_mats = self.read_packed_mats(scenes_mat_names, indices)
+        elems_inds = ranges_to_indices(scenes_mats['map_scene_elems_start'], scenes_mats['map_scene_n_elems'])
+        elems_mats = self.read_packed_mats(['map_elems_poly_type', 'map_elems_slot', 'map_elems_n_points_orig',
+                                            'map_elems_points_start', 'map_elems_n_points_saved'], elems_inds)
+        n_points_saved = elems_mats['map_elems_n_points_saved'].astype(np.int64)
+        points_inds = ranges_to_indices(elems_mats['map_elems_points_start'], n_points_saved)
+        points = self.read_packed_mats(['map_points'], points_inds)['map_points']
+        # restore the points of each element to max_points_per_elem points (padded by zeros)
+        n_elems = len(elems_inds)
+        max_points_per_elem = self.dataset_props['max_points_per_elem']
+        elems_points = np.zeros((n_elems, max_points_per_elem, points.shape[-1]), dtype=np.float32)
+        points_elem = np.repeat(np.arange(n_elems), n_points_saved)
+        points_slot = np.arange(len(points_inds)) - np.repeat(np.cumsum(n_points_saved) - n_points_saved, n_points_saved)
+        if self.map_coords_encoding:
+            # decode the offsets from the scenes origins (the packed maps are decoded here, on the CPU)
+            elems_scene = np.repeat(np.arange(len(indices)), scenes_mats['map_scene_n_elems'])
+            points = points.astype(np.float32) * self.map_coords_encoding['scale'] \
+                     + scenes_mats['map_scene_coords_origin'][elems_scene[points_elem]]
+        elems_points[points_elem, points_slot] = points
+        scene_elems_offsets = np.concatenate([[0], np.cumsum(scenes_mats['map_scene_n_elems'])]).astype(np.int64)
+        return PackedMap(elems_points=torch.from_numpy(elems_points),
+                         elems_n_points_orig=torch.from_numpy(elems_mats['map_elems_n_points_orig']),
+                         elems_poly_type=torch.from_numpy(elems_mats['map_elems_poly_type'].astype(np.int64)),
+                         elems_slot=torch.from_numpy(elems_mats['map_elems_slot'].astype(np.int64)),
+                         scene_elems_offsets=torch.from_numpy(scene_elems_offsets),
+                         n_polygon_types=len(self.dataset_props['polygon_types']),
+                         max_num_elem=self.dataset_props['max_num_elem'])
+
+    ########################################################################################
+
+    def collate_fn(self, samples):
+        """Collate the samples from __getitem__ to a SceneBatch, crop its maps and augment it (in the DataLoader workers)"""
+        if isinstance(samples, SceneBatch):
+            # newer pytorch versions fetch the batch with __getitems__ (already collated and augmented)
+            return samples
+        batch = collate_scene_dicts(samples)
+        if self.crop_map_elems:
+            batch = self.crop_map_elems(batch)
+        elif self.trim_map_elems:
+            batch = self.trim_map_elems(batch)
+        batch = self.augment_batch(batch)
+        return SceneBatch.from_dict(batch)
+
+    ########################################################################################
+
+    def get_read_block_size(self):
+        """Return the number of scenes in an HDF5 chunk of the largest matrix (None if not chunked)"""
+        if self.has_packed_maps:
+            # the map data of a scene is not aligned to the scenes matrices chunks
+            return None
+        return self.h5_handle.get_chunk_len('map_elems_points')
+
+    ########################################################################################
+
     def __len__(self):
         """Return the total number of scenes."""
         return self.n_scenes
 
+    def get_shards_offsets(self):
+        """Return the index of the first scene of each shard, and the number of scenes [n_shards + 1]"""
+        if not self.shards:
+            return np.array([0, self.n_scenes], dtype=np.int64)
+        return np.cumsum([0] + [shard['n_scenes'] for shard in self.shards]).astype(np.int64)
+
+    ########################################################################################
+
+    def get_io_stats(self, reset=False):
+        """Return the number of data file opens and reads (summed over all workers) since the last reset."""
+        return self.h5_handle.get_io_stats(reset)
+
 #########################################################################################
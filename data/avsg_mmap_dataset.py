@@ -0,0 +1,100 @@
+"""Dataset class for the memory-mapped avsg data format
+
+    The dataset directory contains a 'header.json' file (with 'dataset_props' and 'saved_mats_info')
+    and a '<mat_name>.npy' file for each matrix in 'saved_mats_info'.
+    The matrices are opened with np.load(mmap_mode='r'), so a scene is read directly from the OS page cache,
+    which is shared by all the DataLoader workers and by concurrent runs that use the same data.
+    Use data/convert_to_mmap.py to convert a dataset from the info.pkl + data.h5 format.
+"""
+
+import json
+import warnings
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+from data.avsg_dataset import AvsgDataset
+
+
+#########################################################################################
+
+@contextmanager
+def ignore_not_writable_warning():
+    """The matrices are read-only memory maps, and the tensors made from them by torch.from_numpy are never modified
+    in-place by the transforms. The warning is ignored only while reading (not for the rest of the process)"""
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "The given NumPy array is not writable")
+        yield
+
+
+#########################################################################################
+
+
+class AvsgMmapDataset(AvsgDataset):
+    """The avsg dataset, loaded from memory-mapped .npy files (--dataset_mode avsg_mmap)"""
+
+    def load_dataset_info(self):
+        header_file_path = Path(self.data_path, 'header').with_suffix('.json')
+        with header_file_path.open('r') as fid:
+            dataset_info = json.load(fid)
+        return dataset_info
+
+    def init_data_reader(self):
+        # the memory maps are opened lazily (also after being pickled to a spawned DataLoader worker)
+        self._mats = None
+
+    def __getstate__(self):
+        # do not pickle the memory maps (numpy would copy all their data)
+        state = self.__dict__.copy()
+        state['_mats'] = None
+        return state
+
+    def get_mats(self):
+        if self._mats is None:
+            self._mats = {mat_name: np.load(Path(self.data_path, mat_info['file_name']), mmap_mode='r')
+                          for mat_name, mat_info in self.saved_mats_info.items()}
+        return self._mats
+
+    def close_data_reader(self):
+        self._mats = None
+
+    def get_mat_array(self, mat_name):
+        return self.get_mats()[mat_name]
+
+    def read_mat_sample(self, mat_name, index):
+        # zero-copy view of the memory map
+        return np.asarray(self.get_mats()[mat_name][index])
+
+    def read_mat_batch(self, mat_name, indices):
+        mat = self.get_mats()[mat_name]
+        i_first = indices[0]
+        if np.array_equal(indices, np.arange(i_first, i_first + len(indices))):
+            # a contiguous block (e.g., from the block_shuffle sampler) - zero-copy view of the memory map
+            return mat[i_first:i_first + len(indices)]
+        return mat[indices]
+
+    def __getitem__(self, index):
+        with ignore_not_writable_warning():
+            return super().__getitem__(index)
+
+    def read_scenes(self, indices):
+        with ignore_not_writable_warning():
+            return super().read_scenes(indices)
+
+    def fetch_lazy_fields(self, batch):
+        with ignore_not_writable_warning():
+            return super().fetch_lazy_fields(batch)
+
+    def preload_to_shared_memory(self, max_gb):
+        with ignore_not_writable_warning():
+            super().preload_to_shared_memory(max_gb)
+
+    def get_read_block_size(self):
+        return None
+
+    def get_io_stats(self, reset=False):
+        # reads are served by the OS page cache, and are not counted
+        return {'n_opens': 0, 'n_reads': 0}
+
+#########################################################################################
@@ -0,0 +1,198 @@
+"""Dataset class for streaming the avsg data in large contiguous blocks (for datasets larger than the RAM)
+
+    The scenes are split to blocks of consecutive scenes, which are read sequentially (one read per matrix per block)
+    by a pool of I/O threads, a few blocks ahead of their use.
+    The scenes of the loaded blocks are mixed in a bounded shuffle buffer (--stream_shuffle_buffer scenes), and each
+    batch is drawn from it at random, and then transformed, cropped and augmented like in the avsg dataset.
+    In each pass over the data, the blocks are shuffled with the seed sampler_seed + pass, and divided between the
+    DataLoader workers (round-robin), so every scene is used exactly once per pass.
+    A sharded dataset (data/shards.py) is divided by shards between all the DataLoader workers of all the distributed
+    ranks (if there are enough shards), so each process reads only its own shard files. The blocks are within a shard.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.utils.data as data_utils
+
+from data.avsg_dataset import AvsgDataset
+from data.packed_map import PackedMap
+from data.shards import get_rank_and_world_size
+
+
+#########################################################################################
+
+
+class AvsgStreamDataset(AvsgDataset, data_utils.IterableDataset):
+    """The avsg dataset, streamed in blocks of scenes through a shuffle buffer (--dataset_mode avsg_stream)"""
+
+    @staticmethod
+    def modify_commandline_options(parser, is_train):
+        parser = AvsgDataset.modify_commandline_options(parser, is_train)
+        parser.add_argument('--stream_block_size', type=int, default=0,
+                            help='Number of consecutive scenes read at a time, if 0 then use the HDF5 chunk size'
+                                 ' (or 1024 if not chunked)')
+        parser.add_argument('--stream_shuffle_buffer', type=int, default=8192,
+                            help='Number of scenes in the shuffle buffer (per DataLoader worker)')
+        parser.add_argument('--stream_io_threads', type=int, default=2,
+                            help='Number of threads that read the blocks (per DataLoader worker)')
+        parser.add_argument('--stream_prefetch_blocks', type=int, default=4,
+                            help='Number of blocks read ahead (per DataLoader worker)')
+        return parser
+
+    def __init__(self, opt, data_path, consumers=None):
+        AvsgDataset.__init__(self, opt, data_path, consumers=consumers)
+        self.batch_size = opt.batch_size
+        scenes_inds = np.arange(self.n_scenes, dtype=np.int64)
+        if getattr(opt, 'scene_query', ''):
+            scenes_inds = self.query_scenes(opt.scene_query)
+        data_size_limit = getattr(opt, 'data_size_limit', 0)
+        if data_size_limit > 0:
+            scenes_inds = np.sort(scenes_inds[torch.randperm(len(scenes_inds))[:data_size_limit].numpy()])
+            print(f'Dataset reduced to {len(scenes_inds)} scenes')
+        self.block_size = opt.stream_block_size or self.get_read_block_size() or 1024
+        # each block is a sorted array of scene indices in a shard (consecutive, unless a subset of the scenes is used)
+        shards_offsets = self.get_shards_offsets()
+        scenes_shard = np.searchsorted(shards_offsets, scenes_inds, side='right') - 1
+        self.blocks = []
+        self.blocks_shard = []
+        for i_shard in range(len(shards_offsets) - 1):
+            shard_scenes_inds = scenes_inds[scenes_shard == i_shard]
+            for i in range(0, len(shard_scenes_inds), self.block_size):
+                self.blocks.append(shard_scenes_inds[i:i + self.block_size])
+                self.blocks_shard.append(i_shard)
+        self.n_shards = len(shards_offsets) - 1
+        self.rank, self.world_size = get_rank_and_world_size()
+        self.seed = opt.sampler_seed
+        if self.seed < 0:
+            # drawn from the global RNG, so it is reproducible given the global seed
+            self.seed = int(torch.randint(2 ** 31, (1,)))
+        print(f'Streaming {len(scenes_inds)} scenes in {len(self.blocks)} blocks of {self.block_size} scenes'
+              f' (rank {self.rank} of {self.world_size}), with a shuffle buffer of {opt.stream_shuffle_buffer} scenes')
+
+    def __len__(self):
+        """Return the number of batches that this rank yields in a pass over its scenes (by all its DataLoader workers,
+        the batches are drawn endlessly, so the passes are not separated)"""
+        n_workers = max(1, int(self.opt.num_threads))
+        n_readers = self.world_size * n_workers
+        n_rank_scenes = sum(len(block) for i_reader in range(self.rank * n_workers, (self.rank + 1) * n_workers)
+                            for block in self.get_reader_blocks(0, i_reader, n_readers))
+        return -(-n_rank_scenes // self.batch_size)
+
+    #########################################################################################
+
+    def get_reader_blocks(self, i_pass, i_reader, n_readers):
+        """Return the blocks of a reader (a DataLoader worker of a rank) in the pass i_pass.
+        If there are enough shards, each reader gets the blocks of its own shards, otherwise the blocks are divided
+        (the blocks order is the same in all the readers)"""
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + i_pass)
+        blocks_order = torch.randperm(len(self.blocks), generator=generator).tolist()
+        if self.n_shards >= n_readers:
+            return [self.blocks[i_block] for i_block in blocks_order
+                    if self.blocks_shard[i_block] % n_readers == i_reader]
+        return [self.blocks[i_block] for i_block in blocks_order[i_reader::n_readers]]
+
+    def generate_blocks(self, i_reader, n_readers):
+        """Yields the blocks (arrays of scene indices) of the reader endlessly, pass after pass"""
+        i_pass = 0
+        while True:
+            reader_blocks = self.get_reader_blocks(i_pass, i_reader, n_readers)
+            if not reader_blocks:
+                raise ValueError(f'No scenes for the reader {i_reader} of {n_readers} (DataLoader workers x ranks),'
+                                 f' reduce --num_threads or --stream_block_size')
+            yield from reader_blocks
+            i_pass += 1
+
+    def __iter__(self):
+        """Yields SceneBatch objects endlessly"""
+        worker_info = data_utils.get_worker_info()
+        worker_id, n_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        # the readers of all the ranks read disjoint parts of the data
+        i_reader, n_readers = self.rank * n_workers + worker_id, self.world_size * n_workers
+        rng = np.random.default_rng(self.seed + i_reader)
+        blocks = self.generate_blocks(i_reader, n_readers)
+        n_prefetch = max(1, self.opt.stream_prefetch_blocks)
+        with ThreadPoolExecutor(max_workers=max(1, self.opt.stream_io_threads)) as executor:
+            pending = [executor.submit(self.read_scenes, next(blocks)) for _ in range(n_prefetch)]
+            buffer = StreamShuffleBuffer(rng)
+            while True:
+                while buffer.n_scenes < self.opt.stream_shuffle_buffer + self.batch_size:
+                    buffer.add_block(pending.pop(0).result())
+                    pending.append(executor.submit(self.read_scenes, next(blocks)))
+                yield self.make_batch(buffer.pop_batch(self.batch_size))
+
+
+#########################################################################################
+
+
+class StreamShuffleBuffer(object):
+    """
+    The raw data of the scenes of several loaded blocks (from AvsgDataset.read_scenes), from which random batches
+    are drawn. A block is released when all its scenes were drawn.
+    """
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.blocks = {}
+        self.blocks_n_left = {}
+        self.i_next_block = 0
+        # the (block, row) of each scene in the buffer
+        self.scenes_block = np.empty(0, dtype=np.int64)
+        self.scenes_row = np.empty(0, dtype=np.int64)
+
+    @property
+    def n_scenes(self):
+        return len(self.scenes_block)
+
+    def add_block(self, block_data):
+        n_rows = len(block_data['agents_feat']['agents_num'])
+        self.blocks[self.i_next_block] = block_data
+        self.blocks_n_left[self.i_next_block] = n_rows
+        self.scenes_block = np.concatenate([self.scenes_block, np.full(n_rows, self.i_next_block, dtype=np.int64)])
+        self.scenes_row = np.concatenate([self.scenes_row, np.arange(n_rows, dtype=np.int64)])
+        self.i_next_block += 1
+
+    def pop_batch(self, batch_size):
+        """Remove batch_size random scenes from the buffer, and return their raw data (stacked)"""
+        is_drawn = np.zeros(self.n_scenes, dtype=bool)
+        is_drawn[self.rng.choice(self.n_scenes, size=min(batch_size, self.n_scenes), replace=False)] = True
+        drawn_block, drawn_row = self.scenes_block[is_drawn], self.scenes_row[is_drawn]
+        self.scenes_block, self.scenes_row = self.scenes_block[~is_drawn], self.scenes_row[~is_drawn]
+        parts = []
+        for i_block in np.unique(drawn_block):
+            rows = torch.from_numpy(drawn_row[drawn_block == i_block])
+            parts.append(select_scenes(self.blocks[i_block], rows))
+            self.blocks_n_left[i_block] -= len(rows)
+            if self.blocks_n_left[i_block] == 0:
+                del self.blocks[i_block], self.blocks_n_left[i_block]
+        return cat_scenes(parts)
+
+
+def select_scenes(scenes_data, rows):
+    """Return the raw data of the scenes at rows (a LongTensor) of the raw data of several scenes"""
+    map_feat = scenes_data['map_feat']
+    if isinstance(map_feat, PackedMap):
+        map_feat = map_feat.index_select(rows)
+    else:
+        map_feat = {mat_name: mat[rows] for mat_name, mat in map_feat.items()}
+    return {'agents_feat': {mat_name: mat[rows] for mat_name, mat in scenes_data['agents_feat'].items()},
+            'map_feat': map_feat}
+
+
+def cat_scenes(scenes_data_list):
+    """Concatenate the raw data of several groups of scenes"""
+    if len(scenes_data_list) == 1:
+        return scenes_data_list[0]
+    map_feats = [scenes_data['map_feat'] for scenes_data in scenes_data_list]
+    if isinstance(map_feats[0], PackedMap):
+        map_feat = PackedMap.cat(map_feats)
+    else:
+        map_feat = {mat_name: torch.cat([m[mat_name] for m in map_feats]) for mat_name in map_feats[0].keys()}
+    agents_feats = [scenes_data['agents_feat'] for scenes_data in scenes_data_list]
+    return {'agents_feat': {mat_name: torch.cat([a[mat_name] for a in agents_feats])
+                            for mat_name in agents_feats[0].keys()},
+            'map_feat': map_feat}
+
+#########################################################################################
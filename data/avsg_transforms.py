@@ -1,6 +1,9 @@
+import os
+
 import numpy as np
 import torch
 
+from data.packed_map import PackedMap
 from util.common_util import to_num
 
 
@@ -14,6 +17,13 @@ def sample_sanity_check(sample):
         torch.sum(torch.abs(agents_feat_vecs[:n_agents_in_scene]), dim=1)) > 0.999
 
 
+def batch_sanity_check(batch):
+    # same check as sample_sanity_check, for all the existing agents in all the scenes of the batch
+    agents_feat_vecs = batch['agents_feat_vecs']
+    agents_exists = batch['conditioning']['agents_exists']
+    return torch.all(torch.sum(torch.abs(agents_feat_vecs[agents_exists]), dim=-1) > 0.999)
+
+
 #########################################################################################
 
 class ReadAgentsVecs(object):
@@ -22,26 +32,29 @@ class ReadAgentsVecs(object):
     also shuffle their indexing
     """
 
-    def __init__(self, opt, dataset_props):
-        self.old_agent_feat_vec_coord_labels = dataset_props['agent_feat_vec_coord_labels']
-        self.old_agent_feat_vec_dim = len(self.old_agent_feat_vec_coord_labels)
-        self.new_agent_feat_vec_coord_labels = opt.agent_feat_vec_coord_labels
-        self.new_agent_feat_vec_dim = len(self.new_agent_feat_vec_coord_labels)
+    def __init__(self, opt):
+        # the columns of the dataset feature vectors that we use (in our order)
+        self.coord_inds_orig = opt.feature_schema.dataset_coord_inds
+        if self.coord_inds_orig is None:
+            raise ValueError(f'The dataset agents features do not include all of {opt.agent_feat_vec_coord_labels}')
+        self.feature_schema = opt.feature_schema
 
     def __call__(self, sample):
         agents_feat = sample['agents_feat']
         agents_feat_vecs_orig = agents_feat['agents_feat_vecs']
-        agents_exists = agents_feat['agents_exists']
-        device = agents_feat_vecs_orig.device
-        agents_num = agents_feat_vecs_orig.shape[0]
-        agents_feat_vecs = torch.zeros((agents_num, self.new_agent_feat_vec_dim), device=device)
-
-        for i_coord, label in enumerate(self.new_agent_feat_vec_coord_labels):
-            i_coord_orig = self.old_agent_feat_vec_coord_labels.index(label)
-            agents_feat_vecs[:, i_coord] = agents_feat_vecs_orig[:, i_coord_orig]
+        # the leading dimensions are [max_num_agents] for a sample, or [batch_size x max_num_agents] for a batch
+        coord_inds_orig = self.coord_inds_orig.to(agents_feat_vecs_orig.device)
+        agents_feat_vecs = torch.index_select(agents_feat_vecs_orig, -1, coord_inds_orig).float()
+        if self.feature_schema.agent_feat_nrm_scale is not None:
+            # the features of the non-existent agents stay zeros
+            agents_exists = agents_feat['agents_exists'].unsqueeze(-1)
+            agents_feat_vecs = self.feature_schema.normalize(agents_feat_vecs) * agents_exists
         sample['agents_feat']['agents_feat_vecs'] = agents_feat_vecs
         return sample
 
+    def batch_call(self, batch):
+        return self(batch)
+
 
 #########################################################################################
 
@@ -77,62 +90,327 @@ class SelectAgents(object):
         sample['agents_feat']['agents_exists'] = agents_exists
         return sample
 
+    def batch_call(self, batch):
+        agents_feat = batch['agents_feat']
+        agents_feat_vecs_orig = agents_feat['agents_feat_vecs']  # [batch_size x n_agents_orig x feat_dim]
+        agents_num_orig = agents_feat['agents_num']  # [batch_size]
+        device = agents_feat_vecs_orig.device
+        batch_size, n_agents_orig, agent_feat_vec_dim_orig = agents_feat_vecs_orig.shape
+        agents_num = agents_num_orig.clamp(max=self.max_num_agents)
+        n_selected = min(n_agents_orig, self.max_num_agents)
+
+        # Sort keys in [0,1) for the selected agents (random order if shuffling) and in [1,2) for the rest,
+        # so that the selected agents come first
+        if self.shuffle_agents_inds_flag:
+            sort_keys = torch.rand((batch_size, n_agents_orig), device=device)
+        else:
+            sort_keys = torch.arange(n_agents_orig, device=device).expand(batch_size, -1) / n_agents_orig
+        is_selected = torch.arange(n_agents_orig, device=device).unsqueeze(0) < agents_num.unsqueeze(1)
+        sort_keys = sort_keys + is_selected.logical_not()
+        inds = sort_keys.argsort(dim=1)[:, :n_selected]
+
+        agents_exists = torch.arange(self.max_num_agents, device=device).unsqueeze(0) < agents_num.unsqueeze(1)
+        agens_feat_vecs = torch.zeros((batch_size, self.max_num_agents, agent_feat_vec_dim_orig), device=device)
+        agens_feat_vecs[:, :n_selected] = torch.gather(
+            agents_feat_vecs_orig, 1, inds.unsqueeze(-1).expand(-1, -1, agent_feat_vec_dim_orig))
+        agens_feat_vecs[agents_exists.logical_not()] = 0.
+        batch['agents_feat']['agents_feat_vecs'] = agens_feat_vecs
+        batch['agents_feat']['agents_num'] = agents_num
+        batch['agents_feat']['agents_exists'] = agents_exists
+        return batch
+
 
 #########################################################################################
 
 
 class PreprocessSceneData(object):
+    """
+    Arrange the scene data in the format used by the models (the augmentation is done later, on the whole batch)
+    If the map coordinates are encoded (data/repack_h5.py --map_coords_dtype), the map points are kept encoded,
+     and their origins are replaced by 'map_coords_pose' (x, y, yaw) and 'map_coords_scale', which are decoded on the
+     training device (see decode_map_coords).
+    """
+
+    def __init__(self, map_coords_scale=1.):
+        self.map_coords_scale = map_coords_scale
+
+    def __call__(self, sample):
+        map_feat = sample['map_feat']
+        if not isinstance(map_feat, PackedMap) and 'map_coords_origin' in map_feat:
+            origins = map_feat.pop('map_coords_origin').to(torch.float32)
+            map_coords_pose = torch.cat([origins, torch.zeros_like(origins[..., :1])], dim=-1)
+            if 'map_poses' in map_feat:
+                # the origins are in the map table frame
+                map_coords_pose = compose_map_poses(map_feat['map_poses'].to(torch.float32), map_coords_pose)
+            map_feat['map_coords_pose'] = map_coords_pose
+            map_feat['map_coords_scale'] = torch.full(origins.shape[:-1], self.map_coords_scale)
+        agents_feat = sample['agents_feat']
+        conditioning = {'map_feat': sample['map_feat'], 'n_agents_in_scene': agents_feat['agents_num'],
+                        'agents_exists': agents_feat['agents_exists']}
+        sample = {'conditioning': conditioning, 'agents_feat_vecs': agents_feat['agents_feat_vecs']}
+        return sample
+
+    def batch_call(self, batch):
+        return self(batch)
+
+
+#########################################################################################
+
+
+def apply_map_poses(map_elems_points, map_poses):
+    """
+    Transform map points from the map table frame to the scene frame (rotate by yaw, then translate by x,y)
+    map_elems_points [... x n_polygon_types x max_num_elem x max_points_per_elem x 2]
+    map_poses [... x 3]  (x, y, yaw)
+    """
+    map_elems_points = map_elems_points.to(torch.float32)
+    map_poses = map_poses.to(torch.float32)
+    cos_yaw, sin_yaw = torch.cos(map_poses[..., 2]), torch.sin(map_poses[..., 2])
+    rot_mats = torch.stack([torch.stack([cos_yaw, -sin_yaw], dim=-1),
+                            torch.stack([sin_yaw, cos_yaw], dim=-1)], dim=-2)
+    map_elems_points = torch.einsum('...ij,...tepj->...tepi', rot_mats, map_elems_points)
+    return map_elems_points + map_poses[..., None, None, None, :2]
+
+
+def compose_map_poses(outer_poses, inner_poses):
+    """
+    The pose of the transform by inner_poses and then by outer_poses
+    outer_poses, inner_poses [... x 3]  (x, y, yaw)
+    """
+    cos_yaw, sin_yaw = torch.cos(outer_poses[..., 2]), torch.sin(outer_poses[..., 2])
+    x = cos_yaw * inner_poses[..., 0] - sin_yaw * inner_poses[..., 1] + outer_poses[..., 0]
+    y = sin_yaw * inner_poses[..., 0] + cos_yaw * inner_poses[..., 1] + outer_poses[..., 1]
+    return torch.stack([x, y, outer_poses[..., 2] + inner_poses[..., 2]], dim=-1)
+
+
+def decode_map_coords(batch):
+    """
+    Decode the encoded map points of a batch (int16 / float16 offsets, see PreprocessSceneData) to float32 points
+    in the scene frame. Runs on the training device, after the batch is copied (so the copy is of the encoded points).
+    """
+    map_feat = batch['conditioning']['map_feat']
+    if isinstance(map_feat, PackedMap) or 'map_coords_pose' not in map_feat:
+        return batch
+    map_coords_pose = map_feat.pop('map_coords_pose')
+    map_coords_scale = map_feat.pop('map_coords_scale')
+    map_elems_points = map_feat['map_elems_points'].to(torch.float32) * map_coords_scale[..., None, None, None, None]
+    map_feat['map_elems_points'] = apply_map_poses(map_elems_points, map_coords_pose)
+    return batch
+
+
+#########################################################################################
+
+
+def get_elems_bboxes(elems_points, elems_n_points_orig):
+    """
+    The bounding boxes (min_x, min_y, max_x, max_y) of the real points of the map elements
+    elems_points [... x n_points x 2],  elems_n_points_orig [...]  ->  [... x 4]
+    """
+    points_inds = torch.arange(elems_points.shape[-2], device=elems_points.device)
+    is_real_point = (points_inds < elems_n_points_orig.unsqueeze(-1)).unsqueeze(-1)
+    mins = torch.where(is_real_point, elems_points, torch.inf).amin(dim=-2)
+    maxs = torch.where(is_real_point, elems_points, -torch.inf).amax(dim=-2)
+    return torch.cat([mins, maxs], dim=-1)
+
+
+def get_bboxes_dists_sqr(bboxes, points):
+    """
+    The squared distance of each point from each bounding box (0 if the point is inside the box)
+    bboxes [... x 4] (min_x, min_y, max_x, max_y), points [... x 2] (broadcastable)
+    """
+    d_x = torch.clamp(torch.maximum(bboxes[..., 0] - points[..., 0], points[..., 0] - bboxes[..., 2]), min=0)
+    d_y = torch.clamp(torch.maximum(bboxes[..., 1] - points[..., 1], points[..., 1] - bboxes[..., 3]), min=0)
+    return d_x.square() + d_y.square()
+
+
+class CropMapElems(object):
+    """
+    Keep only the map elements that are within map_crop_radius of the ego (agent 0), or of any of the agents,
+    and re-pack the batch maps to the largest number of kept elements (per polygon type) in the batch.
+    The map encoder excludes the padding slots from its sets, so the re-packing doesn't change a scene's map latent.
+    The elements bounding boxes are taken from the dataset, if it has them (data/add_map_bboxes.py),
+     otherwise they are computed from the elements points.
+    Runs on the whole batch, before the augmentation.
+    """
+
     def __init__(self, opt):
-        self.agent_feat_vec_coord_labels = opt.agent_feat_vec_coord_labels
-        assert opt.agent_feat_vec_coord_labels == [
-            'centroid_x',  # [0]  Real number
-            'centroid_y',  # [1]  Real number
-            'yaw_cos',  # [2]  in range [-1,1],  sin(yaw)^2 + cos(yaw)^2 = 1
-            'yaw_sin',  # [3]  in range [-1,1],  sin(yaw)^2 + cos(yaw)^2 = 1
-            'speed',  # [4] Real non-negative
-        ]
-        self.dim_agent_feat_vec = len(self.agent_feat_vec_coord_labels)
+        self.feature_schema = opt.feature_schema
+        self.crop_radius = opt.map_crop_radius
+        self.crop_center = opt.map_crop_center
+        if self.crop_center not in ['agents', 'ego']:
+            raise NotImplementedError(f'Unrecognized opt.map_crop_center  {self.crop_center}')
+
+    def get_crop_centers(self, batch):
+        """ Return the crop centers [batch_size x n_centers x 2] and if they exist [batch_size x n_centers] """
+        centers = batch['agents_feat_vecs'][:, :, self.feature_schema.centroid_inds]
+        centers_exists = batch['conditioning']['agents_exists']
+        if self.crop_center == 'ego':
+            centers, centers_exists = centers[:, :1], centers_exists[:, :1]
+        return centers, centers_exists
+
+    def get_elems_min_dists_sqr(self, bboxes, centers, centers_exists):
+        """
+        bboxes [batch_size x ... x 4], centers [batch_size x n_centers x 2]
+        Returns the squared distance of each element to the closest crop center [batch_size x ...]
+        """
+        n_elem_dims = bboxes.ndim - 2
+        centers = centers.view((centers.shape[0],) + (1,) * n_elem_dims + centers.shape[1:])
+        centers_exists = centers_exists.view((centers_exists.shape[0],) + (1,) * n_elem_dims + centers_exists.shape[1:])
+        dists_sqr = get_bboxes_dists_sqr(bboxes.unsqueeze(-2), centers)  # [batch_size x ... x n_centers]
+        dists_sqr = torch.where(centers_exists, dists_sqr, torch.inf)
+        return dists_sqr.amin(dim=-1)
+
+    def __call__(self, batch):
+        map_feat = batch['conditioning']['map_feat']
+        centers, centers_exists = self.get_crop_centers(batch)
+        if isinstance(map_feat, PackedMap):
+            elems_scene = map_feat.elems_scene
+            bboxes = get_elems_bboxes(map_feat.elems_points, map_feat.elems_n_points_orig)
+            dists_sqr = get_bboxes_dists_sqr(bboxes.unsqueeze(-2), centers[elems_scene])  # [n_elems x n_centers]
+            dists_sqr = torch.where(centers_exists[elems_scene], dists_sqr, torch.inf).amin(dim=-1)
+            batch['conditioning']['map_feat'] = map_feat.select_elems(dists_sqr <= self.crop_radius ** 2)
+            return batch
+        map_elems_points = map_feat['map_elems_points']
+        # [batch_size x n_polygon_types x max_num_elem x max_points_per_elem x 2]
+        bboxes = map_feat.pop('map_elems_bboxes', None)
+        if bboxes is None and 'map_coords_pose' in map_feat:
+            # encoded map points - the crop centers are moved to the frame of the encoded points
+            pose, scale = map_feat['map_coords_pose'], map_feat['map_coords_scale']
+            cos_yaw, sin_yaw = torch.cos(pose[:, 2]).unsqueeze(1), torch.sin(pose[:, 2]).unsqueeze(1)
+            rel_x, rel_y = centers[..., 0] - pose[:, :1], centers[..., 1] - pose[:, 1:2]
+            centers = torch.stack([cos_yaw * rel_x + sin_yaw * rel_y, cos_yaw * rel_y - sin_yaw * rel_x], dim=-1)
+            centers = centers / scale.view(-1, 1, 1)
+            bboxes = get_elems_bboxes(map_elems_points.to(torch.float32), map_feat['map_elems_n_points_orig'])
+            dists_sqr = self.get_elems_min_dists_sqr(bboxes, centers, centers_exists) * scale.view(-1, 1, 1).square()
+        else:
+            if bboxes is None:
+                bboxes = get_elems_bboxes(map_elems_points, map_feat['map_elems_n_points_orig'])
+            dists_sqr = self.get_elems_min_dists_sqr(bboxes, centers, centers_exists)
+        is_kept = torch.logical_and(map_feat['map_elems_exists'].bool(), dists_sqr <= self.crop_radius ** 2)
+        compact_map_elems(map_feat, is_kept)
+        # the map ids are dropped (see MapEncoder.forward)
+        map_feat.pop('map_ids', None)
+        map_feat.pop('map_poses', None)
+        return batch
+
+
+def compact_map_elems(map_feat, is_kept):
+    """
+    Keep only the elements where is_kept [batch_size x n_polygon_types x max_num_elem] (in place): move them to the
+    first slots of their polygon type (in their original order), and drop the slots that are empty in all the scenes
+    """
+    max_num_elem = max(int(is_kept.sum(dim=-1).max()), 1)
+    elems_order = torch.sort(is_kept.logical_not().to(torch.int8), dim=-1, stable=True).indices[..., :max_num_elem]
+    for mat_name in ['map_elems_points', 'map_elems_n_points_orig']:
+        mat = map_feat[mat_name]
+        inds = elems_order.view(elems_order.shape + (1,) * (mat.ndim - 3)).expand(elems_order.shape + mat.shape[3:])
+        map_feat[mat_name] = torch.gather(mat, 2, inds)
+    map_feat['map_elems_exists'] = torch.gather(is_kept, 2, elems_order).to(map_feat['map_elems_exists'].dtype)
+    return map_feat
+
+
+class TrimMapElems(object):
+    """
+    Re-pack the batch maps to the largest number of elements (per polygon type) of a scene in the batch, instead of
+    the dataset max_num_elem (the padding slots that are empty in all the scenes are dropped).
+    It saves the most with batches of scenes of similar map sizes (see --sampler_type bucket).
+    The map encoder masks out the padding slots, so a scene's map latent doesn't depend on the other scenes of its batch.
+    Runs on the whole batch, before the augmentation (the cropping already re-packs the maps).
+    """
+
+    def __call__(self, batch):
+        map_feat = batch['conditioning']['map_feat']
+        if isinstance(map_feat, PackedMap):
+            is_kept = torch.ones(map_feat.n_elems, dtype=torch.bool, device=map_feat.elems_points.device)
+            batch['conditioning']['map_feat'] = map_feat.select_elems(is_kept)
+        else:
+            compact_map_elems(map_feat, map_feat['map_elems_exists'].bool())
+        return batch
+
+
+#########################################################################################
+
+
+class AugmentSceneBatch(object):
+    """
+    Random augmentation of a batch of scenes (after collation), with a different rotation & translation per scene.
+    The random numbers are drawn from a generator that is seeded once per process: in a DataLoader worker by the
+    worker's seed, and in the main process by a seed drawn from the global RNG when the transform is constructed
+    (so each dataset has its own stream, and the augmentation is reproducible given the global seed).
+    """
+
+    def __init__(self, opt):
+        self.feature_schema = opt.feature_schema
         self.augmentation_type = opt.augmentation_type
-        self.polygon_types = opt.polygon_types
+        self.pos_shift_std = 50  # [m]
+        self._seed = int(torch.randint(2 ** 62, (1,)))
+        self._generator = None
+        self._pid = None
 
-    def __call__(self, sample):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_generator'] = None
+        state['_pid'] = None
+        return state
 
-        agents_feat = sample['agents_feat']
-        map_feat = sample['map_feat']
-        agents_feat_vecs = agents_feat['agents_feat_vecs']
-        agents_exists = agents_feat['agents_exists']
-        agents_num = agents_feat['agents_num']
-        device = agents_feat_vecs.device
+    def manual_seed(self, seed):
+        """ Seed the generator of this process with a fixed seed (e.g., for a reproducible set of augmented batches) """
+        self._generator = torch.Generator()
+        self._generator.manual_seed(seed)
+        self._pid = os.getpid()
+
+    def get_generator(self, device):
+        if self._generator is None or self._pid != os.getpid() or self._generator.device != device:
+            worker_info = torch.utils.data.get_worker_info()
+            self._generator = torch.Generator(device=device)
+            self._generator.manual_seed(worker_info.seed if worker_info is not None else self._seed)
+            self._pid = os.getpid()
+        return self._generator
+
+    def __call__(self, batch):
         if self.augmentation_type == 'none':
             pass
         elif self.augmentation_type == 'rotate_and_translate':
-            # Random augmentation: rotation & translation
-            aug_rot = np.random.rand(1).squeeze() * 2 * np.pi
-            rot_mat = np.array([[np.cos(aug_rot), -np.sin(aug_rot)],
-                                [np.sin(aug_rot), np.cos(aug_rot)]])
-            rot_mat = torch.from_numpy(rot_mat).to(device=device, dtype=agents_feat_vecs.dtype)
-            pos_shift_std = 50  # [m]
-            pos_shift = torch.randn_like(agents_feat_vecs[0][:2]) * pos_shift_std
-            for i_agent, feat_vec in enumerate(agents_feat_vecs):
-                # Rotate the centroid (x,y)
-                feat_vec[:2] = rot_mat @ feat_vec[:2]
-                # Rotate the yaw angle (in unit vec form)
-                feat_vec[2:4] = rot_mat @ feat_vec[2:4]
-                # Translate centroid
-                feat_vec[:2] += pos_shift
-                agents_feat_vecs[i_agent] = feat_vec
-            map_elems_points = map_feat['map_elems_points']
-            x_vals = map_elems_points[:, :, :, 0]
-            y_vals = map_elems_points[:, :, :, 1]
-            x_vals, y_vals = rot_mat[0, 0] * x_vals + rot_mat[0, 1] * y_vals, \
-                             rot_mat[1, 0] * x_vals + rot_mat[1, 1] * y_vals,
-            x_vals, y_vals = x_vals + pos_shift[0], y_vals + pos_shift[1]
-            map_feat['map_elems_points'][:, :, :, 0] = x_vals
-            map_feat['map_elems_points'][:, :, :, 1] = y_vals
-
+            agents_feat_vecs = batch['agents_feat_vecs']  # [batch_size x max_num_agents x dim_agent_feat_vec]
+            map_feat = batch['conditioning']['map_feat']
+            batch_size = agents_feat_vecs.shape[0]
+            device = agents_feat_vecs.device
+            dtype = agents_feat_vecs.dtype
+            generator = self.get_generator(device)
+            # Random rotation matrices [batch_size x 2 x 2] and translations [batch_size x 2]
+            aug_rot = torch.rand(batch_size, generator=generator, device=device, dtype=dtype) * 2 * torch.pi
+            cos_rot, sin_rot = torch.cos(aug_rot), torch.sin(aug_rot)
+            rot_mats = torch.stack([torch.stack([cos_rot, -sin_rot], dim=-1),
+                                    torch.stack([sin_rot, cos_rot], dim=-1)], dim=-2)
+            pos_shifts = torch.randn((batch_size, 2), generator=generator, device=device, dtype=dtype) \
+                         * self.pos_shift_std
+            # Rotate & translate the centroids (x,y), and rotate the yaw angle (in unit vec form)
+            centroid_inds = self.feature_schema.centroid_inds
+            yaw_vec_inds = self.feature_schema.yaw_vec_inds
+            agents_feat_vecs = agents_feat_vecs.clone()
+            agents_feat_vecs[:, :, centroid_inds] = \
+                torch.einsum('bij,bnj->bni', rot_mats, agents_feat_vecs[:, :, centroid_inds]) + pos_shifts.unsqueeze(1)
+            agents_feat_vecs[:, :, yaw_vec_inds] = \
+                torch.einsum('bij,bnj->bni', rot_mats, agents_feat_vecs[:, :, yaw_vec_inds])
+            batch['agents_feat_vecs'] = agents_feat_vecs
+            # Rotate & translate the map points
+            if isinstance(map_feat, PackedMap):
+                batch['conditioning']['map_feat'] = map_feat.transform_points(rot_mats, pos_shifts)
+            elif 'map_coords_pose' in map_feat:
+                # encoded map points - the augmentation is composed into the pose they are decoded with
+                aug_poses = torch.cat([pos_shifts, aug_rot.unsqueeze(-1)], dim=-1).to(torch.float32)
+                map_feat['map_coords_pose'] = compose_map_poses(aug_poses, map_feat['map_coords_pose'])
+                # the map ids are dropped (see MapEncoder.forward)
+                map_feat.pop('map_ids', None)
+                map_feat.pop('map_poses', None)
+            else:
+                # [batch_size x n_polygon_types x max_num_elem x max_points_per_elem x 2]
+                map_elems_points = map_feat['map_elems_points']
+                map_elems_points = torch.einsum('bij,btepj->btepi', rot_mats, map_elems_points.to(dtype))
+                map_feat['map_elems_points'] = map_elems_points + pos_shifts.view(batch_size, 1, 1, 1, 2)
+                # the map ids are dropped (see MapEncoder.forward)
+                map_feat.pop('map_ids', None)
+                map_feat.pop('map_poses', None)
         else:
             raise NotImplementedError(f'Unrecognized opt.augmentation_type  {self.augmentation_type}')
-
-        conditioning = {'map_feat': map_feat, 'n_agents_in_scene': agents_num, 'agents_exists': agents_exists}
-        sample = {'conditioning': conditioning, 'agents_feat_vecs': agents_feat_vecs}
-        return sample
+        return batch
@@ -0,0 +1,70 @@
+"""Convert an avsg dataset from the info.pkl + data.h5 format to the memory-mapped format of AvsgMmapDataset
+
+* To run:
+$ python -m data.convert_to_mmap --data_path datasets/avsg_data/sample --out_path datasets/avsg_data/sample_mmap
+
+* Then train with:  --dataset_mode avsg_mmap --data_path_train datasets/avsg_data/sample_mmap
+"""
+import argparse
+import json
+import pickle
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+
+#########################################################################################
+
+def to_json_compatible(obj):
+    """ used as the 'default' of json.dump, for the numpy types in dataset_props """
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.dtype):
+        return obj.str
+    if isinstance(obj, (tuple, set)):
+        return list(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+#########################################################################################
+
+def convert_to_mmap(data_path, out_path, n_scenes_per_copy=1024):
+    info_file_path = Path(data_path, 'info').with_suffix('.pkl')
+    with info_file_path.open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    saved_mats_info = {}
+    with h5py.File(Path(data_path, 'data').with_suffix('.h5'), 'r') as h5f:
+        for mat_name, mat_info in dataset_info['saved_mats_info'].items():
+            h5_dataset = h5f[mat_name]
+            file_name = f'{mat_name}.npy'
+            out_mat = np.lib.format.open_memmap(out_path / file_name, mode='w+',
+                                                dtype=h5_dataset.dtype, shape=h5_dataset.shape)
+            # copy in blocks of scenes, to bound the memory usage
+            for i_first in range(0, h5_dataset.shape[0], n_scenes_per_copy):
+                i_last = min(i_first + n_scenes_per_copy, h5_dataset.shape[0])
+                h5_dataset.read_direct(out_mat, source_sel=np.s_[i_first:i_last], dest_sel=np.s_[i_first:i_last])
+            out_mat.flush()
+            del out_mat
+            saved_mats_info[mat_name] = dict(mat_info, file_name=file_name,
+                                             dtype=h5_dataset.dtype.str, shape=list(h5_dataset.shape))
+            print(f'Saved {mat_name} {h5_dataset.shape} {h5_dataset.dtype}')
+    header = {'dataset_props': dataset_info['dataset_props'], 'saved_mats_info': saved_mats_info}
+    with (out_path / 'header.json').open('w') as fid:
+        json.dump(header, fid, indent=2, default=to_json_compatible)
+    print(f'Converted dataset saved to {out_path}')
+
+
+#########################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True, help='Path of the source dataset dir (info.pkl + data.h5)')
+    parser.add_argument('--out_path', type=str, required=True, help='Path of the output dataset dir')
+    parser.add_argument('--n_scenes_per_copy', type=int, default=1024, help='Number of scenes copied at a time')
+    args = parser.parse_args()
+    convert_to_mmap(args.data_path, args.out_path, args.n_scenes_per_copy)
@@ -1,43 +1,342 @@
+import queue
+import threading
+import time
+
 import torch
 import torch.utils.data as data_utils
 
 from . import get_dataset_class_using_name
+from .avsg_transforms import decode_map_coords
+from .samplers import BlockShuffleBatchSampler, BucketBatchSampler, EndlessSampler
+from .shards import get_rank_and_world_size
 
 
-def create_dataloader(opt, data_path):
+def create_dataloader(opt, data_path, consumers=None):
     """Create a dataset given the option.
 
     This function wraps the class CustomDatasetDataLoader.
         This is the main interface between this package and 'train.py'/'test.py'
 
+    Returns a BatchPrefetcher (or the dataset's own batch source, if it has one),
+     get the next batch (on the training device) with next(data_gen)
+    consumers -- the users of the batches (e.g., ['train']), so only the matrices they need are read
+     (the matrices of other consumers are read on demand with data_gen.fetch_lazy_fields), if None then all are read
     """
     dataset_class = get_dataset_class_using_name(opt.dataset_mode)
-    dataset_obj = dataset_class(opt, data_path)
+    dataset_obj = dataset_class(opt, data_path, consumers=consumers)
+    device = torch.device('cuda:{}'.format(opt.gpu_ids[0])) if opt.gpu_ids else torch.device('cpu')
+
+    if getattr(opt, 'direct_batches', 0) and hasattr(dataset_class, 'get_batch_source'):
+        # whole batches are generated directly on the device, without a DataLoader
+        print(f"dataset [{type(dataset_obj).__name__}] was created, batches are generated on {device}")
+        return dataset_obj.get_batch_source(opt.batch_size, device)
+
+    # the batches (SceneBatch) are copied to page-locked memory, so the copy to the GPU can be non-blocking
+    pin_memory = bool(opt.pin_memory and opt.gpu_ids)
+    num_workers = int(opt.num_threads)
+    if isinstance(dataset_obj, data_utils.IterableDataset):
+        # the dataset yields whole batches endlessly (and selects its scenes by itself)
+        print(f"dataset [{type(dataset_obj).__name__}] was created, data streamed from {data_path}")
+        data_loader = data_utils.DataLoader(
+            dataset_obj,
+            batch_size=None,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            pin_memory=pin_memory)
+        return BatchPrefetcher(data_loader, device, n_prefetch=get_n_prefetch(opt))
 
+    if getattr(dataset_obj, 'shards', None) and get_rank_and_world_size()[1] > 1:
+        # the map-style samplers draw from all the scenes, so every rank would read all the shards
+        raise ValueError('A sharded dataset is divided between the distributed ranks only with'
+                         ' --dataset_mode avsg_stream')
+    scenes_inds = get_query_scenes_inds(opt, dataset_obj)
+    if scenes_inds is not None:
+        dataset_obj = data_utils.Subset(dataset_obj, scenes_inds)
     if opt.data_size_limit > 0:
         indices = torch.randperm(len(dataset_obj))[:opt.data_size_limit]
-        dataset_obj = data_utils.Subset(dataset_obj, indices)
+        dataset_obj = data_utils.Subset(unwrap_dataset(dataset_obj), unwrap_indices(dataset_obj, indices))
         print(f'Dataset reduced to {len(dataset_obj)} scenes')
 
     print(f"dataset [{type(dataset_obj).__name__}] was created, data loaded from {data_path}")
-    data_loader = data_utils.DataLoader(
-        dataset_obj,
-        batch_size=opt.batch_size,
-        shuffle=True,
-        num_workers=int(opt.num_threads))
-    data_iterator = iter(data_loader)
-    data_gen = {'data_loader': data_loader, 'data_iterator': data_iterator}
+    # the sampler is endless (reshuffled each epoch), so the workers are kept alive for the whole run
+    batch_sampler = get_endless_batch_sampler(opt, dataset_obj)
+    if getattr(opt, 'batched_reads', 0) and hasattr(dataset_class, '__getitems__'):
+        # the dataset gets a whole batch of indices and returns an already stacked batch
+        data_loader = data_utils.DataLoader(
+            dataset_obj,
+            batch_size=None,
+            sampler=batch_sampler,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            pin_memory=pin_memory)
+    else:
+        data_loader = data_utils.DataLoader(
+            dataset_obj,
+            batch_sampler=batch_sampler,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            pin_memory=pin_memory,
+            collate_fn=getattr(unwrap_dataset(dataset_obj), 'collate_fn', None))
+    data_gen = BatchPrefetcher(data_loader, device, n_prefetch=get_n_prefetch(opt))
     return data_gen
 
 
-def get_next_batch_cyclic(data_gen):
-    """ get sample from iterator, if it finishes then restart  """
-    data_loader = data_gen['data_loader']
-    data_iterator = data_gen['data_iterator']
-    try:
-        batch_data = next(data_iterator)
-    except StopIteration:
-        #  just restart the iterator and re-use the samples
-        data_iterator = iter(data_loader)
-        batch_data = next(data_iterator)
-    return batch_data
+def get_n_prefetch(opt):
+    """ Return the number of batches that the BatchPrefetcher loads in the background.
+    Without DataLoader workers, the dataset and its transforms would run in the background thread and draw from the
+    global RNG (e.g., SelectAgents) concurrently with the training loop, so the batches are loaded synchronously """
+    if int(opt.num_threads) == 0:
+        return 0
+    return opt.n_prefetch_batches
+
+
+def get_endless_batch_sampler(opt, dataset_obj):
+    """ get a sampler that yields batches of indices endlessly, with a reproducible reshuffle in each epoch  """
+    seed = opt.sampler_seed
+    if seed < 0:
+        # drawn from the global RNG, so it is reproducible given the global seed
+        seed = int(torch.randint(2 ** 31, (1,)))
+    generator = torch.Generator()
+    batch_sampler = get_batch_sampler(opt, dataset_obj, generator)
+    return EndlessSampler(batch_sampler, generator, seed,
+                          epoch_end_callback=lambda: print_epoch_io_stats(dataset_obj))
+
+
+def get_batch_sampler(opt, dataset_obj, generator=None):
+    """ get a sampler that yields batches of indices (a single epoch)  """
+    sampler_type = getattr(opt, 'sampler_type', 'shuffle')
+    if sampler_type == 'shuffle':
+        return data_utils.BatchSampler(data_utils.RandomSampler(dataset_obj, generator=generator),
+                                       batch_size=opt.batch_size, drop_last=False)
+    elif sampler_type == 'block_shuffle':
+        block_size = opt.sampler_block_size
+        if block_size <= 0:
+            block_size = dataset_obj.get_read_block_size() if hasattr(dataset_obj, 'get_read_block_size') else None
+            block_size = block_size or opt.batch_size
+        print(f'Sampling blocks of {block_size} consecutive scenes')
+        # the blocks are of consecutive rows in the data file (a subset of the scenes is sorted by the scene indices)
+        samples_order = None
+        if isinstance(dataset_obj, data_utils.Subset):
+            samples_order = torch.argsort(unwrap_indices(dataset_obj, torch.arange(len(dataset_obj))))
+        return BlockShuffleBatchSampler(len(dataset_obj), batch_size=opt.batch_size, block_size=block_size,
+                                        generator=generator, samples_order=samples_order)
+    elif sampler_type == 'bucket':
+        map_sizes = unwrap_dataset(dataset_obj).get_scenes_map_sizes()
+        map_sizes = map_sizes[unwrap_indices(dataset_obj, torch.arange(len(dataset_obj))).numpy()]
+        print(f'Sampling batches from {opt.bucket_n_buckets} buckets of map sizes')
+        return BucketBatchSampler(map_sizes, batch_size=opt.batch_size, n_buckets=opt.bucket_n_buckets,
+                                  generator=generator)
+    else:
+        raise NotImplementedError(f'Unrecognized opt.sampler_type  {sampler_type}')
+
+
+class BatchPrefetcher(object):
+    """
+    An endless iterator over the batches of a DataLoader (with an EndlessSampler, the DataLoader iterator is never
+    restarted, otherwise it is restarted at the end of each epoch).
+    A background thread keeps up to n_prefetch batches ready, already copied to the device, so the data loading
+    overlaps the training steps. The copy to a GPU is non-blocking (from pinned memory, on a separate CUDA stream).
+    If n_prefetch == 0, the batches are loaded synchronously in next().
+    The background thread only iterates the DataLoader, so it should have workers (the dataset code runs in them),
+    see get_n_prefetch.
+    The time that next() waited for data is accumulated (see pop_wait_time).
+    """
+
+    def __init__(self, data_loader, device, n_prefetch=2):
+        self.data_loader = data_loader
+        self.device = device
+        self.n_prefetch = n_prefetch
+        self.copy_stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.wait_time = 0.
+        self._batches = self.generate_batches()
+        if n_prefetch > 0:
+            self._queue = queue.Queue(maxsize=n_prefetch)
+            self._stop_event = threading.Event()
+            self._thread = threading.Thread(target=self.prefetch_loop, daemon=True)
+            self._thread.start()
+
+    def generate_batches(self):
+        """ yields the batches of the data loader endlessly, with their copy-done events (if copied on a stream) """
+        while True:
+            for batch in self.data_loader:
+                # the encoded map coordinates (if any) are decoded after the copy, on the device
+                if self.copy_stream is None:
+                    yield decode_map_coords(batch.to(self.device)), None
+                else:
+                    with torch.cuda.stream(self.copy_stream):
+                        batch = decode_map_coords(batch.to(self.device, non_blocking=True))
+                        copy_done = torch.cuda.Event()
+                        copy_done.record(self.copy_stream)
+                    yield batch, copy_done
+
+    def prefetch_loop(self):
+        try:
+            for item in self._batches:
+                while not self._stop_event.is_set():
+                    try:
+                        self._queue.put(item, timeout=1.)
+                        break
+                    except queue.Full:
+                        pass
+                if self._stop_event.is_set():
+                    return
+        except Exception as err:
+            # re-raised in the training loop, by next()
+            self._queue.put(err)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start_time = time.time()
+        if self.n_prefetch > 0:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+        else:
+            item = next(self._batches)
+        self.wait_time += time.time() - start_time
+        batch, copy_done = item
+        if copy_done is not None:
+            # the consuming stream waits for the copy on the GPU (the CPU does not wait)
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_event(copy_done)
+            batch.record_stream(current_stream)
+        return batch
+
+    def fetch_lazy_fields(self, batch):
+        """ Add the matrices that were not read for the batch (for another consumer, e.g., the visualization) """
+        dataset_obj = get_dataset_obj(self.data_loader)
+        if not hasattr(dataset_obj, 'fetch_lazy_fields'):
+            return batch
+        return dataset_obj.fetch_lazy_fields(batch)
+
+    def pop_wait_time(self):
+        """ Returns the total time [sec] that next() waited for data since the last call, and resets it """
+        wait_time = self.wait_time
+        self.wait_time = 0.
+        return wait_time
+
+    def close(self):
+        if self.n_prefetch > 0:
+            self._stop_event.set()
+            self._thread.join()
+
+
+def get_query_scenes_inds(opt, dataset_obj):
+    """ Return the indices of the scenes that match opt.scene_query (None if there is no query) """
+    query = getattr(opt, 'scene_query', '')
+    if not query:
+        return None
+    if not hasattr(dataset_obj, 'query_scenes'):
+        raise ValueError(f'The dataset [{type(dataset_obj).__name__}] does not support --scene_query')
+    return torch.from_numpy(dataset_obj.query_scenes(query))
+
+
+def unwrap_indices(dataset_obj, indices):
+    """ map indices of a Subset to the indices of its dataset  """
+    if isinstance(dataset_obj, data_utils.Subset):
+        return torch.as_tensor(dataset_obj.indices)[indices]
+    return indices
+
+
+def create_val_cache(opt, data_path, consumers=None):
+    """Read a fixed set of opt.val_cache_n_batches validation batches once, and return a ValBatchCache of them.
+
+    The scenes are drawn with the seed opt.val_cache_seed, and they are not augmented (or augmented with that seed,
+     if opt.val_cache_augment), so the validation metrics are comparable across iterations.
+    """
+    dataset_class = get_dataset_class_using_name(opt.dataset_mode)
+    dataset_obj = dataset_class(opt, data_path, consumers=consumers)
+    device = torch.device('cuda:{}'.format(opt.gpu_ids[0])) if opt.gpu_ids else torch.device('cpu')
+    n_batches = opt.val_cache_n_batches
+    if hasattr(dataset_class, 'get_batch_source'):
+        # generated scenes
+        torch.manual_seed(opt.val_cache_seed)
+        batch_source = dataset_obj.get_batch_source(opt.batch_size, device)
+        batches = [next(batch_source) for _ in range(n_batches)]
+    else:
+        augment_batch = getattr(dataset_obj, 'augment_batch', None)
+        if augment_batch is not None:
+            if opt.val_cache_augment:
+                augment_batch.manual_seed(opt.val_cache_seed)
+            else:
+                augment_batch.augmentation_type = 'none'
+        generator = torch.Generator()
+        generator.manual_seed(opt.val_cache_seed)
+        scenes_pool = get_query_scenes_inds(opt, dataset_obj)
+        if scenes_pool is None:
+            # all the scenes (the length of a streamed dataset is its number of batches)
+            scenes_pool = torch.arange(dataset_obj.n_scenes)
+        n_scenes = min(n_batches * opt.batch_size, len(scenes_pool))
+        scenes_inds = scenes_pool[torch.randperm(len(scenes_pool), generator=generator)[:n_scenes]]
+        batches = []
+        for batch_inds in scenes_inds.split(opt.batch_size):
+            # sorted, so the reads of a batch are in the file order
+            batch_inds = batch_inds.sort().values.tolist()
+            if hasattr(dataset_class, '__getitems__'):
+                batch = dataset_obj.__getitems__(batch_inds)
+            else:
+                batch = dataset_obj.collate_fn([dataset_obj[i] for i in batch_inds])
+            batches.append(decode_map_coords(batch.to(device)))
+        if hasattr(dataset_obj, 'close_data_reader'):
+            # re-opened on demand, by fetch_lazy_fields
+            dataset_obj.close_data_reader()
+    print(f'Cached {len(batches)} validation batches from {data_path} on {device}')
+    return ValBatchCache(batches, dataset_obj)
+
+
+class ValBatchCache(object):
+    """
+    A fixed list of ready batches (on the training device), returned by next() in a round-robin order.
+    It has the same interface as BatchPrefetcher, so it can be used as the validation data generator.
+    """
+
+    def __init__(self, batches, dataset_obj):
+        self.batches = batches
+        self.dataset_obj = dataset_obj
+        self._i_next = 0
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.batches[self._i_next]
+        self._i_next = (self._i_next + 1) % len(self.batches)
+        return batch
+
+    def fetch_lazy_fields(self, batch):
+        if not hasattr(self.dataset_obj, 'fetch_lazy_fields'):
+            return batch
+        return self.dataset_obj.fetch_lazy_fields(batch)
+
+    def pop_wait_time(self):
+        return 0.
+
+    def close(self):
+        pass
+
+
+def unwrap_dataset(dataset_obj):
+    """ get the dataset object unwrapped from a Subset, if used  """
+    if isinstance(dataset_obj, data_utils.Subset):
+        dataset_obj = dataset_obj.dataset
+    return dataset_obj
+
+
+def get_dataset_obj(data_loader):
+    """ get the dataset object of the loader (unwrapped from a Subset, if used)  """
+    return unwrap_dataset(data_loader.dataset)
+
+
+def print_epoch_io_stats(dataset_obj):
+    """ print the number of data file opens and reads in the epoch that ended, and reset the counters  """
+    dataset_obj = unwrap_dataset(dataset_obj)
+    if not hasattr(dataset_obj, 'get_io_stats'):
+        return
+    io_stats = dataset_obj.get_io_stats(reset=True)
+    print(f"End of epoch on {dataset_obj.data_path}: {io_stats['n_opens']} data file opens,"
+          f" {io_stats['n_reads']} reads")
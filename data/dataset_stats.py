@@ -0,0 +1,189 @@
+"""Compute the statistics of an avsg dataset in one streaming pass over data.h5, and cache them next to info.pkl
+
+The scenes are split to blocks that are processed in parallel by a pool of processes. Each block gives the moments
+(count, mean, sum of squared deviations) of the agents feature vectors, which are merged with the parallel
+variance formula, so the data is read once and never fully loaded to memory.
+The statistics are:
+    agent_feat_labels        -- the labels of the dataset agents feature vector columns
+    agent_feat_mean          -- [agent_feat_dim] the mean of each column (over the existing agents)
+    agent_feat_std           -- [agent_feat_dim] the std of each column (over the existing agents)
+    n_agents                 -- the total number of agents
+    agents_num_hist          -- [max_n_agents + 1] the number of scenes with each number of agents
+    map_elems_num_hist       -- {polygon_type: [max_num_elem + 1]} the number of scenes with each number of elements
+    map_elems_n_points_hist  -- [max_points_per_elem + 1] the number of elements with each number of points
+The padded, the map table (data/dedup_maps.py) and the packed (data/pack_maps.py) map layouts are supported.
+The cache file 'stats.pkl' is keyed by a fingerprint of data.h5, so stale statistics are ignored by the datasets
+(see --normalize_agent_coords).
+
+* To run:
+$ python -m data.dataset_stats --data_path datasets/avsg_data/sample --n_workers 8
+"""
+import argparse
+import hashlib
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+
+#########################################################################################
+
+def get_file_fingerprint(file_path, n_samples=16, sample_size=2 ** 20):
+    """ A hash of the file size and of n_samples blocks spread over the file (cheap also for very large files) """
+    file_path = Path(file_path)
+    file_size = file_path.stat().st_size
+    key = hashlib.sha1(str(file_size).encode())
+    with file_path.open('rb') as fid:
+        for offset in np.linspace(0, max(file_size - sample_size, 0), n_samples, dtype=np.int64):
+            fid.seek(int(offset))
+            key.update(fid.read(sample_size))
+    return key.hexdigest()
+
+
+def get_stats_file_path(data_path):
+    return Path(data_path, 'stats').with_suffix('.pkl')
+
+
+def load_dataset_stats(data_path):
+    """ Return the cached statistics of the dataset, or None if they were not computed or data.h5 was changed """
+    stats_file_path = get_stats_file_path(data_path)
+    data_file_path = Path(data_path, 'data').with_suffix('.h5')
+    if not stats_file_path.exists() or not data_file_path.exists():
+        return None
+    with stats_file_path.open('rb') as fid:
+        cached = pickle.load(fid)
+    if cached['data_file_hash'] != get_file_fingerprint(data_file_path):
+        print(f'The statistics in {stats_file_path} are stale (data.h5 was changed), rerun data/dataset_stats.py')
+        return None
+    return cached['stats']
+
+
+#########################################################################################
+
+def get_moments(x):
+    """ The moments (count, mean, sum of squared deviations) of the rows of x [n x dim] """
+    x = x.astype(np.float64)
+    if x.shape[0] == 0:
+        return 0, np.zeros(x.shape[1]), np.zeros(x.shape[1])
+    mean = x.mean(axis=0)
+    return x.shape[0], mean, np.square(x - mean).sum(axis=0)
+
+
+def merge_moments(moments_a, moments_b):
+    """ The moments of the union of two sets of rows (Chan et al. parallel variance) """
+    count_a, mean_a, m2_a = moments_a
+    count_b, mean_b, m2_b = moments_b
+    count = count_a + count_b
+    if count == 0:
+        return moments_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + np.square(delta) * (count_a * count_b / count)
+    return count, mean, m2
+
+
+def add_hists(hist_a, hist_b):
+    n_bins = max(len(hist_a), len(hist_b))
+    return np.pad(hist_a, (0, n_bins - len(hist_a))) + np.pad(hist_b, (0, n_bins - len(hist_b)))
+
+
+#########################################################################################
+
+def read_block_map_counts(h5f, dataset_info, i_first, i_last):
+    """ Return the number of elements [n_scenes_in_block x n_polygon_types] and the number of points of each
+    element [n_elems] of the scenes [i_first:i_last] """
+    saved_mats_info = dataset_info['saved_mats_info']
+    n_polygon_types = len(dataset_info['dataset_props']['polygon_types'])
+    if dataset_info['dataset_props'].get('map_layout') == 'packed':
+        scene_elems_start = h5f['map_scene_elems_start'][i_first:i_last]
+        scene_n_elems = h5f['map_scene_n_elems'][i_first:i_last].astype(np.int64)
+        # the elements of consecutive scenes are contiguous
+        i_elem_first = int(scene_elems_start[0])
+        i_elem_last = i_elem_first + int(scene_n_elems.sum())
+        elems_poly_type = h5f['map_elems_poly_type'][i_elem_first:i_elem_last].astype(np.int64)
+        elems_scene = np.repeat(np.arange(i_last - i_first), scene_n_elems)
+        elems_num = np.bincount(elems_scene * n_polygon_types + elems_poly_type,
+                                minlength=(i_last - i_first) * n_polygon_types)
+        elems_n_points = h5f['map_elems_n_points_orig'][i_elem_first:i_elem_last]
+        return elems_num.reshape(i_last - i_first, n_polygon_types), elems_n_points
+    if 'map_ids' in saved_mats_info:
+        # each of the unique maps of the block is read once (h5py needs increasing indices)
+        unique_map_ids, map_inverse = np.unique(h5f['map_ids'][i_first:i_last], return_inverse=True)
+        map_elems_exists = h5f['map_elems_exists'][unique_map_ids][map_inverse]
+        map_elems_n_points_orig = h5f['map_elems_n_points_orig'][unique_map_ids][map_inverse]
+    else:
+        map_elems_exists = h5f['map_elems_exists'][i_first:i_last]
+        map_elems_n_points_orig = h5f['map_elems_n_points_orig'][i_first:i_last]
+    map_elems_exists = map_elems_exists.astype(bool)
+    return map_elems_exists.sum(axis=-1), map_elems_n_points_orig[map_elems_exists]
+
+
+def calc_block_stats(args):
+    """ The partial statistics of the scenes [i_first:i_last] (runs in a worker process) """
+    data_path, dataset_info, i_first, i_last = args
+    with h5py.File(Path(data_path, 'data').with_suffix('.h5'), 'r') as h5f:
+        agents_feat_vecs = h5f['agents_feat_vecs'][i_first:i_last]  # [n_scenes x max_n_agents x agent_feat_dim]
+        agents_num = h5f['agents_num'][i_first:i_last].astype(np.int64).reshape(-1)
+        elems_num, elems_n_points = read_block_map_counts(h5f, dataset_info, i_first, i_last)
+    agents_exists = np.arange(agents_feat_vecs.shape[1]) < agents_num[:, np.newaxis]
+    return {'agent_feat_moments': get_moments(agents_feat_vecs[agents_exists]),
+            'agents_num_hist': np.bincount(agents_num),
+            'map_elems_num_hists': [np.bincount(elems_num[:, i_type]) for i_type in range(elems_num.shape[1])],
+            'map_elems_n_points_hist': np.bincount(elems_n_points.astype(np.int64))}
+
+
+def merge_block_stats(stats_a, stats_b):
+    return {'agent_feat_moments': merge_moments(stats_a['agent_feat_moments'], stats_b['agent_feat_moments']),
+            'agents_num_hist': add_hists(stats_a['agents_num_hist'], stats_b['agents_num_hist']),
+            'map_elems_num_hists': [add_hists(hist_a, hist_b) for hist_a, hist_b
+                                    in zip(stats_a['map_elems_num_hists'], stats_b['map_elems_num_hists'])],
+            'map_elems_n_points_hist': add_hists(stats_a['map_elems_n_points_hist'],
+                                                 stats_b['map_elems_n_points_hist'])}
+
+
+#########################################################################################
+
+def calc_dataset_stats(data_path, n_workers=4, n_scenes_per_block=1024):
+    info_file_path = Path(data_path, 'info').with_suffix('.pkl')
+    with info_file_path.open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    dataset_props = dataset_info['dataset_props']
+    data_file_path = Path(data_path, 'data').with_suffix('.h5')
+    with h5py.File(data_file_path, 'r') as h5f:
+        n_scenes = h5f['agents_feat_vecs'].shape[0]
+    blocks = [(data_path, dataset_info, i_first, min(i_first + n_scenes_per_block, n_scenes))
+              for i_first in range(0, n_scenes, n_scenes_per_block)]
+    # the file is opened by each worker, after the fork
+    merged = None
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for i_block, block_stats in enumerate(executor.map(calc_block_stats, blocks)):
+            merged = block_stats if merged is None else merge_block_stats(merged, block_stats)
+            print(f'Processed {blocks[i_block][3]}/{n_scenes} scenes')
+    n_agents, agent_feat_mean, agent_feat_m2 = merged['agent_feat_moments']
+    stats = {'agent_feat_labels': list(dataset_props['agent_feat_vec_coord_labels']),
+             'agent_feat_mean': agent_feat_mean.astype(np.float32),
+             'agent_feat_std': np.sqrt(agent_feat_m2 / max(n_agents, 1)).astype(np.float32),
+             'n_agents': int(n_agents),
+             'agents_num_hist': merged['agents_num_hist'],
+             'map_elems_num_hist': dict(zip(dataset_props['polygon_types'], merged['map_elems_num_hists'])),
+             'map_elems_n_points_hist': merged['map_elems_n_points_hist']}
+    stats_file_path = get_stats_file_path(data_path)
+    with stats_file_path.open('wb') as fid:
+        pickle.dump({'data_file_hash': get_file_fingerprint(data_file_path), 'stats': stats}, fid)
+    for label, mean, std in zip(stats['agent_feat_labels'], stats['agent_feat_mean'], stats['agent_feat_std']):
+        print(f'{label}: mean {mean:.3f}, std {std:.3f}')
+    print(f'{n_agents} agents in {n_scenes} scenes, statistics saved to {stats_file_path}')
+    return stats
+
+
+#########################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True, help='Path of the dataset dir (info.pkl + data.h5)')
+    parser.add_argument('--n_workers', type=int, default=4, help='Number of processes')
+    parser.add_argument('--n_scenes_per_block', type=int, default=1024, help='Number of scenes processed by a task')
+    args = parser.parse_args()
+    calc_dataset_stats(args.data_path, args.n_workers, args.n_scenes_per_block)
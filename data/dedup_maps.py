@@ -0,0 +1,152 @@
+"""Rewrite an avsg dataset so that each distinct map is stored once, in a map table referenced by the scenes
+
+In the output data.h5, the map matrices ('map_elems_points', 'map_elems_exists', 'map_elems_n_points_orig')
+hold one row per unique map, and each scene has:
+    map_ids    -- [n_scenes] the row of the scene's map in the map table
+    map_poses  -- [n_scenes x 3] (x, y, yaw) the transform from the map table frame to the scene frame
+The maps are compared after a translation to the mean of their points, so a map is also shared by scenes where it
+is shifted (e.g., a static ego in consecutive frames). By default the relative coordinates must be equal, with
+--tolerance > 0 they are compared after rounding to the tolerance, and the scenes of a map get the first map that was
+found with its key. The largest distance between a scene's points and its reconstruction from the map table is
+saved in the dataset props (map_dedup_max_error).
+
+* To run:
+$ python -m data.dedup_maps --data_path datasets/avsg_data/sample --out_path datasets/avsg_data/sample_dedup
+
+* Then train with:  --data_path_train datasets/avsg_data/sample_dedup  (the layout is detected by AvsgDataset)
+
+The map table saves storage and reads, it does not reduce the map encoder's compute (see MapEncoder.forward).
+"""
+import argparse
+import hashlib
+import pickle
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from data.repack_h5 import check_not_encoded
+
+map_mat_names = ('map_elems_points', 'map_elems_exists', 'map_elems_n_points_orig')
+
+
+#########################################################################################
+
+def get_real_points_mask(map_elems_exists, map_elems_n_points_orig, max_points_per_elem):
+    """ [n_polygon_types x max_num_elem x max_points_per_elem] True for the points of the existing elements """
+    points_inds = np.arange(max_points_per_elem)
+    return np.logical_and(map_elems_exists.astype(bool)[..., np.newaxis],
+                          points_inds < map_elems_n_points_orig[..., np.newaxis])
+
+
+def get_map_key(map_elems_points, map_elems_exists, map_elems_n_points_orig, tolerance):
+    """ Return the origin of the map (mean of its points) and a hash key of the map relative to that origin
+    (of the exact relative coordinates if tolerance == 0, otherwise of the coordinates rounded to the tolerance) """
+    real_points = get_real_points_mask(map_elems_exists, map_elems_n_points_orig, map_elems_points.shape[-2])
+    origin = map_elems_points[real_points].mean(axis=0) if real_points.any() else np.zeros(2)
+    origin = origin.astype(np.float64)
+    if tolerance > 0:
+        relative_points = np.round((map_elems_points - origin) / tolerance).astype(np.int64)
+    else:
+        relative_points = (map_elems_points - origin).astype(map_elems_points.dtype)
+    relative_points[np.logical_not(real_points)] = 0
+    key = hashlib.sha1()
+    for arr in (relative_points, map_elems_exists.astype(bool), map_elems_n_points_orig):
+        key.update(np.ascontiguousarray(arr).tobytes())
+    return origin, key.digest()
+
+
+#########################################################################################
+
+def get_reconstruction_error(block, map_tables, block_map_ids, block_map_poses):
+    """ Return the largest distance between the real points of the scenes of the block and their map points, as read
+    from the map table and translated by the scenes map poses """
+    unique_map_ids, map_inverse = np.unique(block_map_ids, return_inverse=True)
+    table_points = map_tables['map_elems_points'][unique_map_ids][map_inverse]
+    points = block['map_elems_points']
+    real_points = get_real_points_mask(block['map_elems_exists'], block['map_elems_n_points_orig'], points.shape[-2])
+    # the map poses have no rotation, and they are applied in float32 (see apply_map_poses)
+    reconstructed = table_points.astype(np.float32) + block_map_poses[:, np.newaxis, np.newaxis, np.newaxis, :2]
+    errors = np.sqrt(np.square(reconstructed.astype(np.float64) - points).sum(axis=-1))[real_points]
+    return float(errors.max()) if errors.size else 0.
+
+
+def dedup_maps(data_path, out_path, tolerance=0., n_scenes_per_copy=1024):
+    info_file_path = Path(data_path, 'info').with_suffix('.pkl')
+    with info_file_path.open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    saved_mats_info_orig = dataset_info['saved_mats_info']
+    check_not_encoded(dataset_info)
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    map_keys_to_ids = {}
+    max_error = 0.
+    with h5py.File(Path(data_path, 'data').with_suffix('.h5'), 'r') as h5f, \
+            h5py.File(Path(out_path, 'data').with_suffix('.h5'), 'w') as out_h5f:
+        n_scenes = h5f['map_elems_points'].shape[0]
+        # the scenes matrices are copied as is
+        for mat_name, mat_info in saved_mats_info_orig.items():
+            if mat_info['entity'] != 'map':
+                h5f.copy(h5f[mat_name], out_h5f, name=mat_name)
+        # the map table grows as new maps are found
+        map_tables = {mat_name: out_h5f.create_dataset(mat_name, shape=(0,) + h5f[mat_name].shape[1:],
+                                                       maxshape=(None,) + h5f[mat_name].shape[1:],
+                                                       dtype=h5f[mat_name].dtype,
+                                                       chunks=(1,) + h5f[mat_name].shape[1:])
+                      for mat_name in map_mat_names}
+        map_ids = out_h5f.create_dataset('map_ids', shape=(n_scenes,), dtype=np.int64)
+        map_poses = out_h5f.create_dataset('map_poses', shape=(n_scenes, 3), dtype=np.float32)
+        for i_first in range(0, n_scenes, n_scenes_per_copy):
+            i_last = min(i_first + n_scenes_per_copy, n_scenes)
+            block = {mat_name: h5f[mat_name][i_first:i_last] for mat_name in map_mat_names}
+            block_map_ids = np.empty(i_last - i_first, dtype=np.int64)
+            block_map_poses = np.zeros((i_last - i_first, 3), dtype=np.float32)
+            for i in range(i_last - i_first):
+                points = block['map_elems_points'][i]
+                origin, key = get_map_key(points, block['map_elems_exists'][i],
+                                          block['map_elems_n_points_orig'][i], tolerance)
+                if key not in map_keys_to_ids:
+                    map_id = len(map_keys_to_ids)
+                    map_keys_to_ids[key] = map_id
+                    new_map = {'map_elems_points': (points - origin).astype(points.dtype),
+                               'map_elems_exists': block['map_elems_exists'][i],
+                               'map_elems_n_points_orig': block['map_elems_n_points_orig'][i]}
+                    for mat_name, map_table in map_tables.items():
+                        map_table.resize(map_id + 1, axis=0)
+                        map_table[map_id] = new_map[mat_name]
+                block_map_ids[i] = map_keys_to_ids[key]
+                block_map_poses[i, :2] = origin
+            map_ids[i_first:i_last] = block_map_ids
+            map_poses[i_first:i_last] = block_map_poses
+            max_error = max(max_error, get_reconstruction_error(block, map_tables, block_map_ids, block_map_poses))
+            print(f'Processed {i_last}/{n_scenes} scenes, {len(map_keys_to_ids)} unique maps,'
+                  f' max reconstruction error {max_error:.2e} m')
+    n_maps = len(map_keys_to_ids)
+    saved_mats_info = {}
+    for mat_name, mat_info in saved_mats_info_orig.items():
+        if mat_info['entity'] == 'map':
+            # the map matrices are indexed by the scene's map id
+            mat_info = dict(mat_info, indexed_by='map_ids')
+        saved_mats_info[mat_name] = mat_info
+    saved_mats_info['map_ids'] = {'entity': 'map_ref'}
+    saved_mats_info['map_poses'] = {'entity': 'map_ref'}
+    dataset_props = dict(dataset_info['dataset_props'], n_maps=n_maps, map_dedup_tolerance=tolerance,
+                         map_dedup_max_error=max_error)
+    with Path(out_path, 'info').with_suffix('.pkl').open('wb') as fid:
+        pickle.dump({'dataset_props': dataset_props, 'saved_mats_info': saved_mats_info}, fid)
+    print(f'{n_scenes} scenes use {n_maps} unique maps (reuse factor {n_scenes / max(n_maps, 1):.1f}),'
+          f' dataset saved to {out_path}')
+
+
+#########################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True, help='Path of the source dataset dir (info.pkl + data.h5)')
+    parser.add_argument('--out_path', type=str, required=True, help='Path of the output dataset dir')
+    parser.add_argument('--tolerance', type=float, default=0.,
+                        help='[m] maps are considered the same if their coordinates (relative to their mean point) are'
+                             ' equal up to this tolerance, if 0 they must be equal')
+    parser.add_argument('--n_scenes_per_copy', type=int, default=1024, help='Number of scenes processed at a time')
+    args = parser.parse_args()
+    dedup_maps(args.data_path, args.out_path, args.tolerance, args.n_scenes_per_copy)
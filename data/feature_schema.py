@@ -0,0 +1,118 @@
+import torch
+
+
+#########################################################################################
+
+def get_index(inds):
+    """ Returns a slice if the indices are consecutive (so indexing gives a view), otherwise an index tensor """
+    if inds == list(range(inds[0], inds[0] + len(inds))):
+        return slice(inds[0], inds[0] + len(inds))
+    return torch.tensor(inds, dtype=torch.long)
+
+
+#########################################################################################
+
+class FeatureSchema(object):
+    """
+    The layout of the agents feature vectors and of the map polygon types.
+    It is built once (by the dataset) from the dataset props and the options, and saved in opt.feature_schema,
+    so the data transforms, the models, the penalty terms and the visualization do not search labels in lists.
+    """
+    required_agent_coord_labels = ['centroid_x', 'centroid_y', 'yaw_cos', 'yaw_sin']
+    # coordinates that are projected to non-negative numbers in the generator output:
+    non_negative_agent_coord_labels = ['speed', 'extent_length', 'extent_width']
+    # coordinates in meters / unit vectors, used by the augmentation, the map cropping and the penalty terms:
+    geometric_agent_coord_labels = ['centroid_x', 'centroid_y', 'yaw_cos', 'yaw_sin', 'extent_length', 'extent_width']
+
+    def __init__(self, opt, dataset_props):
+        # ~~~~  Agents features
+        self.agent_feat_vec_coord_labels = list(opt.agent_feat_vec_coord_labels)
+        self.agent_feat_vec_dim = len(self.agent_feat_vec_coord_labels)
+        for label in self.required_agent_coord_labels:
+            if label not in self.agent_feat_vec_coord_labels:
+                raise ValueError(f'The agents feature vector must include {label}')
+        self.i_coord = {label: i for i, label in enumerate(self.agent_feat_vec_coord_labels)}
+        self.i_centroid_x = self.i_coord['centroid_x']
+        self.i_centroid_y = self.i_coord['centroid_y']
+        self.i_yaw_cos = self.i_coord['yaw_cos']
+        self.i_yaw_sin = self.i_coord['yaw_sin']
+        self.i_speed = self.i_coord.get('speed')
+        self.i_extent_length = self.i_coord.get('extent_length')
+        self.i_extent_width = self.i_coord.get('extent_width')
+        self.has_extent = self.i_extent_length is not None and self.i_extent_width is not None
+        # indices (slices when possible) of coordinates groups in the feature vectors:
+        self.centroid_inds = get_index([self.i_centroid_x, self.i_centroid_y])
+        self.yaw_vec_inds = get_index([self.i_yaw_cos, self.i_yaw_sin])
+        non_negative_inds = [self.i_coord[label] for label in self.non_negative_agent_coord_labels
+                             if label in self.i_coord]
+        self.non_negative_inds = get_index(non_negative_inds) if non_negative_inds else None
+
+        # the columns of the dataset feature vectors that make up our feature vectors (None if some are missing)
+        dataset_labels = dataset_props.get('agent_feat_vec_coord_labels', [])
+        if all(label in dataset_labels for label in self.agent_feat_vec_coord_labels):
+            self.dataset_coord_inds = torch.tensor([dataset_labels.index(label)
+                                                    for label in self.agent_feat_vec_coord_labels], dtype=torch.long)
+        else:
+            self.dataset_coord_inds = None
+        # the normalization of the features (see set_normalization), None if the features are not normalized
+        self.agent_feat_nrm_offset = None
+        self.agent_feat_nrm_scale = None
+
+        # ~~~~  Map polygon types
+        self.polygon_types = list(dataset_props['polygon_types'])
+        self.closed_polygon_types = list(dataset_props['closed_polygon_types'])
+        self.n_polygon_types = len(self.polygon_types)
+        self.i_polygon_type = {poly_type: i for i, poly_type in enumerate(self.polygon_types)}
+        self.i_lanes_mid = self.i_polygon_type.get('lanes_mid')
+        self.i_lanes_left = self.i_polygon_type.get('lanes_left')
+        self.i_lanes_right = self.i_polygon_type.get('lanes_right')
+
+    def __repr__(self):
+        return f'FeatureSchema(agents={self.agent_feat_vec_coord_labels}, polygons={self.polygon_types})'
+
+    def set_normalization(self, dataset_stats, labels):
+        """
+        Normalize the coordinates in labels with the dataset statistics (data/dataset_stats.py):
+        the non-negative coordinates are divided by their std (so they stay non-negative),
+        and the others are standardized (minus the mean, divided by the std).
+        """
+        for label in labels:
+            if label not in self.i_coord:
+                raise ValueError(f'Cannot normalize {label}, it is not in {self.agent_feat_vec_coord_labels}')
+            if label in self.geometric_agent_coord_labels:
+                raise ValueError(f'Cannot normalize {label}, the geometric coordinates must stay in their units')
+        offset = torch.zeros(self.agent_feat_vec_dim)
+        scale = torch.ones(self.agent_feat_vec_dim)
+        for label in labels:
+            i_stats = dataset_stats['agent_feat_labels'].index(label)
+            std = float(dataset_stats['agent_feat_std'][i_stats])
+            if label not in self.non_negative_agent_coord_labels:
+                offset[self.i_coord[label]] = float(dataset_stats['agent_feat_mean'][i_stats])
+            scale[self.i_coord[label]] = 1. / max(std, 1e-6)
+        self.agent_feat_nrm_offset = offset
+        self.agent_feat_nrm_scale = scale
+
+    def normalize(self, agents_feat_vecs):
+        if self.agent_feat_nrm_scale is None:
+            return agents_feat_vecs
+        offset = self.agent_feat_nrm_offset.to(agents_feat_vecs.device)
+        scale = self.agent_feat_nrm_scale.to(agents_feat_vecs.device)
+        return (agents_feat_vecs - offset) * scale
+
+    def denormalize(self, agents_feat_vecs):
+        """ Return the features in their original units (e.g., for the visualization) """
+        if self.agent_feat_nrm_scale is None:
+            return agents_feat_vecs
+        offset = self.agent_feat_nrm_offset.to(agents_feat_vecs.device)
+        scale = self.agent_feat_nrm_scale.to(agents_feat_vecs.device)
+        return agents_feat_vecs / scale + offset
+
+    def get_extents(self, agents_feat_vecs, opt):
+        """ Returns the agents extents (length, width) [... x 2], from the features or the default extent """
+        if self.has_extent:
+            return agents_feat_vecs[..., [self.i_extent_length, self.i_extent_width]]
+        default_extent = torch.tensor([opt.default_agent_extent_length, opt.default_agent_extent_width],
+                                      dtype=agents_feat_vecs.dtype, device=agents_feat_vecs.device)
+        return default_extent.expand(agents_feat_vecs.shape[:-1] + (2,))
+
+#########################################################################################
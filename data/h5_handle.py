@@ -0,0 +1,236 @@
+import multiprocessing
+import os
+import threading
+from multiprocessing.util import Finalize
+
+import h5py
+import numpy as np
+
+try:
+    # registers the compression filters of hdf5plugin (e.g., blosc, see data/repack_h5.py), if installed
+    import hdf5plugin  # noqa: F401
+except ImportError:
+    pass
+
+
+#########################################################################################
+
+class H5FileHandle(object):
+    """
+    Lazily opened read-only handle to an HDF5 file.
+    The file is opened once per process (the main process or a DataLoader worker) on the first read, and is kept
+    open until that process exits.
+    A handle inherited from a parent process (by fork) is never used by the child - the child opens its own.
+    The number of file opens and dataset reads are counted across all the worker processes (for I/O profiling).
+    """
+    # in batch reads, read the whole covering slice if it is at most this many times the number of requested rows
+    dense_read_ratio = 4
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._h5f = None
+        self._h5_datasets = {}
+        self._read_buffers = {}
+        self._pid = None
+        self._open_lock = threading.Lock()
+        self._n_opens = multiprocessing.Value('q', 0)
+        self._n_reads = multiprocessing.Value('q', 0)
+
+    def __getstate__(self):
+        # the open file is not picklable (e.g., when the DataLoader workers are spawned), the workers re-open it
+        state = self.__dict__.copy()
+        state['_h5f'] = None
+        state['_h5_datasets'] = {}
+        state['_read_buffers'] = {}
+        state['_pid'] = None
+        state['_open_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open_lock = threading.Lock()
+
+    def get_file(self):
+        if self._h5f is None or self._pid != os.getpid():
+            # the file may be first used by several threads at once (e.g., the I/O threads of the streaming dataset)
+            with self._open_lock:
+                if self._h5f is None or self._pid != os.getpid():
+                    self.open_file()
+        return self._h5f
+
+    def open_file(self):
+        self._h5f = h5py.File(self.file_path, 'r')
+        self._h5_datasets = {}
+        self._read_buffers = {}
+        self._pid = os.getpid()
+        # close the file when the process exits (also runs in DataLoader workers, unlike atexit)
+        Finalize(self, self._h5f.close, exitpriority=10)
+        with self._n_opens.get_lock():
+            self._n_opens.value += 1
+
+    def get_dataset(self, mat_name):
+        h5f = self.get_file()
+        if mat_name not in self._h5_datasets:
+            self._h5_datasets[mat_name] = h5f[mat_name]
+        return self._h5_datasets[mat_name]
+
+    def read(self, mat_name, index):
+        h5_dataset = self.get_dataset(mat_name)
+        with self._n_reads.get_lock():
+            self._n_reads.value += 1
+        return h5_dataset[index]
+
+    def read_batch(self, mat_name, indices):
+        """
+        Read the rows of a dataset at the given indices (any order, may repeat) with a single HDF5 read.
+        The unique indices are sorted, and if they are dense enough, the covering chunk-aligned slice is read
+        (sequential I/O), otherwise a single fancy-index read is used.
+        The read goes into a reused staging buffer, the returned array is a new array in the order of 'indices'.
+        """
+        h5_dataset = self.get_dataset(mat_name)
+        unique_inds, inverse = np.unique(np.asarray(indices), return_inverse=True)
+        i_first, i_last = unique_inds[0], unique_inds[-1] + 1
+        if h5_dataset.chunks is not None:
+            chunk_len = h5_dataset.chunks[0]
+            i_first = (i_first // chunk_len) * chunk_len
+            i_last = min(-(-i_last // chunk_len) * chunk_len, h5_dataset.shape[0])
+        if i_last - i_first <= self.dense_read_ratio * len(unique_inds):
+            n_rows = i_last - i_first
+            source_sel = np.s_[i_first:i_last]
+            rows = (unique_inds - i_first)[inverse]
+        else:
+            n_rows = len(unique_inds)
+            source_sel = np.s_[unique_inds.tolist()]
+            rows = inverse
+        # a buffer per thread, so reads from several threads (e.g., by the streaming dataset) do not share a buffer
+        buffer_key = (mat_name, threading.get_ident())
+        read_buffer = self._read_buffers.get(buffer_key)
+        if read_buffer is None or read_buffer.shape[0] < n_rows:
+            read_buffer = np.empty((n_rows,) + h5_dataset.shape[1:], dtype=h5_dataset.dtype)
+            self._read_buffers[buffer_key] = read_buffer
+        h5_dataset.read_direct(read_buffer, source_sel=source_sel, dest_sel=np.s_[:n_rows])
+        with self._n_reads.get_lock():
+            self._n_reads.value += 1
+        return read_buffer[rows]
+
+    def get_chunk_len(self, mat_name):
+        """Return the number of rows in an HDF5 chunk of the dataset (None if it is not chunked)."""
+        chunks = self.get_dataset(mat_name).chunks
+        return None if chunks is None else chunks[0]
+
+    def get_io_stats(self, reset=False):
+        """Returns the number of file opens and dataset reads since the last reset."""
+        io_stats = {}
+        for name, counter in [('n_opens', self._n_opens), ('n_reads', self._n_reads)]:
+            with counter.get_lock():
+                io_stats[name] = counter.value
+                if reset:
+                    counter.value = 0
+        return io_stats
+
+    def close(self):
+        if self._h5f is not None and self._pid == os.getpid():
+            self._h5f.close()
+        self._h5f = None
+        self._h5_datasets = {}
+        self._read_buffers = {}
+        self._pid = None
+
+
+#########################################################################################
+
+class ShardedH5FileHandle(object):
+    """
+    The HDF5 files of the shards of a sharded dataset (see data/shards.py), read as if they were a single file.
+    The rows of each matrix are numbered globally, shard after shard, and the shard of a row is found by a binary
+    search over the shards row offsets.
+    The matrices that hold row numbers of other matrices (row_refs, e.g., 'map_ids' holds rows of the map table) are
+    shifted on read to the global numbering of the rows they refer to.
+    Each shard file has its own H5FileHandle, so a process opens only the shards that it reads.
+    """
+
+    def __init__(self, file_paths, shards_n_rows, row_refs):
+        """
+        file_paths -- the data.h5 file of each shard
+        shards_n_rows -- a {mat_name: number of rows} dict of each shard
+        row_refs -- {mat_name: the matrix whose rows it refers to}
+        """
+        self.handles = [H5FileHandle(file_path) for file_path in file_paths]
+        self.row_offsets = {mat_name: np.cumsum([0] + [n_rows[mat_name] for n_rows in shards_n_rows])
+                            for mat_name in shards_n_rows[0].keys()}
+        self.row_refs = row_refs
+
+    @property
+    def n_shards(self):
+        return len(self.handles)
+
+    def locate(self, mat_name, indices):
+        """Return the shard of each (global) row of the matrix, and its row in the shard"""
+        row_offsets = self.row_offsets[mat_name]
+        shard_inds = np.searchsorted(row_offsets, indices, side='right') - 1
+        return shard_inds, indices - row_offsets[shard_inds]
+
+    def to_global_refs(self, mat_name, i_shard, mat_rows):
+        if mat_name not in self.row_refs:
+            return mat_rows
+        return mat_rows.astype(np.int64) + self.row_offsets[self.row_refs[mat_name]][i_shard]
+
+    def get_dataset(self, mat_name):
+        return ShardedH5Dataset(self, mat_name)
+
+    def read(self, mat_name, index):
+        i_shard, row = self.locate(mat_name, np.int64(index))
+        return self.to_global_refs(mat_name, i_shard, np.asarray(self.handles[i_shard].read(mat_name, int(row))))
+
+    def read_batch(self, mat_name, indices):
+        """Read the rows at the given (global) indices, with one read per shard (see H5FileHandle.read_batch)"""
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_inds, rows = self.locate(mat_name, indices)
+        mat_batch = None
+        for i_shard in np.unique(shard_inds):
+            is_in_shard = shard_inds == i_shard
+            shard_batch = self.to_global_refs(mat_name, i_shard,
+                                              self.handles[i_shard].read_batch(mat_name, rows[is_in_shard]))
+            if mat_batch is None:
+                mat_batch = np.empty((len(indices),) + shard_batch.shape[1:], dtype=shard_batch.dtype)
+            mat_batch[is_in_shard] = shard_batch
+        return mat_batch
+
+    def get_chunk_len(self, mat_name):
+        return self.handles[0].get_chunk_len(mat_name)
+
+    def get_io_stats(self, reset=False):
+        io_stats = {'n_opens': 0, 'n_reads': 0}
+        for handle in self.handles:
+            for name, count in handle.get_io_stats(reset).items():
+                io_stats[name] += count
+        return io_stats
+
+    def close(self):
+        for handle in self.handles:
+            handle.close()
+
+
+class ShardedH5Dataset(object):
+    """The shape and type of a matrix of a sharded dataset, its whole data is read with [()] (like an h5py dataset)"""
+
+    def __init__(self, sharded_handle, mat_name):
+        self.sharded_handle = sharded_handle
+        self.mat_name = mat_name
+        first_dataset = sharded_handle.handles[0].get_dataset(mat_name)
+        self.shape = (int(sharded_handle.row_offsets[mat_name][-1]),) + first_dataset.shape[1:]
+        self.dtype = np.dtype(np.int64) if mat_name in sharded_handle.row_refs else first_dataset.dtype
+        self.chunks = first_dataset.chunks
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __getitem__(self, key):
+        if key != ():
+            raise NotImplementedError('Only the whole data can be read, use ShardedH5FileHandle.read_batch')
+        return np.concatenate([self.sharded_handle.to_global_refs(self.mat_name, i_shard,
+                                                                  handle.get_dataset(self.mat_name)[()])
+                               for i_shard, handle in enumerate(self.sharded_handle.handles)])
+
+#########################################################################################
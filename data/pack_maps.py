@@ -0,0 +1,127 @@
+"""Rewrite an avsg dataset with ragged (packed) map storage, instead of padding every scene to
+max_num_elem elements x max_points_per_elem points
+
+In the output data.h5, the padded map matrices are replaced by:
+    map_scene_elems_start    -- [n_scenes] the index of the first element of the scene
+    map_scene_n_elems        -- [n_scenes] the number of existing elements in the scene
+    map_elems_poly_type      -- [n_elems] the polygon type index of the element
+    map_elems_slot           -- [n_elems] the index of the element in the padded layout (among its type elements)
+    map_elems_n_points_orig  -- [n_elems] the number of real points in the element
+    map_elems_points_start   -- [n_elems] the index of the first point of the element
+    map_elems_n_points_saved -- [n_elems] the number of saved points of the element
+    map_points               -- [n_points x 2] the points of all the elements
+The padded element bounding boxes (data/add_map_bboxes.py) are not kept, they are computed from the packed points.
+Only the real points of an element are saved if its padding points are zeros (the zeros are restored on load),
+otherwise all its max_points_per_elem points are saved, so the padded layout is always restored exactly.
+
+* To run:
+$ python -m data.pack_maps --data_path datasets/avsg_data/sample --out_path datasets/avsg_data/sample_packed
+
+* Then train with:  --data_path_train datasets/avsg_data/sample_packed  (the layout is detected by AvsgDataset)
+"""
+import argparse
+import pickle
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from data.dedup_maps import map_mat_names
+from data.repack_h5 import check_not_encoded
+
+
+#########################################################################################
+
+def append_rows(h5_dataset, rows):
+    n_rows = h5_dataset.shape[0]
+    h5_dataset.resize(n_rows + rows.shape[0], axis=0)
+    h5_dataset[n_rows:] = rows
+
+
+def pack_maps(data_path, out_path, n_scenes_per_copy=1024):
+    info_file_path = Path(data_path, 'info').with_suffix('.pkl')
+    with info_file_path.open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    saved_mats_info_orig = dataset_info['saved_mats_info']
+    check_not_encoded(dataset_info)
+    if 'map_ids' in saved_mats_info_orig:
+        raise ValueError('The maps of the dataset are in a map table (data/dedup_maps.py), pack the original dataset')
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    n_elems = 0
+    n_points = 0
+    with h5py.File(Path(data_path, 'data').with_suffix('.h5'), 'r') as h5f, \
+            h5py.File(Path(out_path, 'data').with_suffix('.h5'), 'w') as out_h5f:
+        n_scenes = h5f['map_elems_points'].shape[0]
+        for mat_name, mat_info in saved_mats_info_orig.items():
+            if mat_info['entity'] not in ('map', 'map_bbox'):
+                h5f.copy(h5f[mat_name], out_h5f, name=mat_name)
+        points_dtype = h5f['map_elems_points'].dtype
+        coord_dim = h5f['map_elems_points'].shape[-1]
+        n_points_dtype = h5f['map_elems_n_points_orig'].dtype
+
+        def create_ragged(name, dtype, row_shape=()):
+            return out_h5f.create_dataset(name, shape=(0,) + row_shape, maxshape=(None,) + row_shape,
+                                          dtype=dtype, chunks=(4096,) + row_shape)
+
+        scene_elems_start = out_h5f.create_dataset('map_scene_elems_start', shape=(n_scenes,), dtype=np.int64)
+        scene_n_elems = out_h5f.create_dataset('map_scene_n_elems', shape=(n_scenes,), dtype=np.int32)
+        elems_poly_type = create_ragged('map_elems_poly_type', np.int8)
+        elems_slot = create_ragged('map_elems_slot', np.int32)
+        elems_n_points_orig = create_ragged('map_elems_n_points_orig', n_points_dtype)
+        elems_points_start = create_ragged('map_elems_points_start', np.int64)
+        elems_n_points_saved = create_ragged('map_elems_n_points_saved', np.int32)
+        points = create_ragged('map_points', points_dtype, (coord_dim,))
+        n_padded_bytes = 0
+        for i_first in range(0, n_scenes, n_scenes_per_copy):
+            i_last = min(i_first + n_scenes_per_copy, n_scenes)
+            block = {mat_name: h5f[mat_name][i_first:i_last] for mat_name in map_mat_names}
+            n_padded_bytes += sum(mat.nbytes for mat in block.values())
+            # the existing elements, ordered by scene (then by polygon type and slot)
+            i_scene, i_type, i_slot = np.nonzero(block['map_elems_exists'])
+            block_elems_points = block['map_elems_points'][i_scene, i_type, i_slot]  # [n x max_points_per_elem x 2]
+            block_n_points_orig = block['map_elems_n_points_orig'][i_scene, i_type, i_slot]
+            max_points_per_elem = block_elems_points.shape[1]
+            is_real_point = np.arange(max_points_per_elem) < block_n_points_orig[:, np.newaxis]
+            zero_padded = np.all(np.logical_or(is_real_point, np.all(block_elems_points == 0, axis=-1)), axis=-1)
+            block_n_points_saved = np.where(zero_padded, block_n_points_orig, max_points_per_elem)
+            is_saved_point = np.arange(max_points_per_elem) < block_n_points_saved[:, np.newaxis]
+            block_scene_n_elems = np.bincount(i_scene, minlength=i_last - i_first)
+            scene_n_elems[i_first:i_last] = block_scene_n_elems
+            scene_elems_start[i_first:i_last] = n_elems + np.cumsum(block_scene_n_elems) - block_scene_n_elems
+            append_rows(elems_poly_type, i_type.astype(np.int8))
+            append_rows(elems_slot, i_slot.astype(np.int32))
+            append_rows(elems_n_points_orig, block_n_points_orig)
+            append_rows(elems_points_start, n_points + np.cumsum(block_n_points_saved) - block_n_points_saved)
+            append_rows(elems_n_points_saved, block_n_points_saved.astype(np.int32))
+            append_rows(points, block_elems_points[is_saved_point])
+            n_elems += len(i_scene)
+            n_points += int(block_n_points_saved.sum())
+            print(f'Processed {i_last}/{n_scenes} scenes')
+        n_packed_bytes = sum(out_h5f[name].nbytes for name in out_h5f.keys() if name.startswith('map_'))
+    saved_mats_info = {mat_name: mat_info for mat_name, mat_info in saved_mats_info_orig.items()
+                       if mat_info['entity'] not in ('map', 'map_bbox')}
+    saved_mats_info['map_scene_elems_start'] = {'entity': 'map_packed'}
+    saved_mats_info['map_scene_n_elems'] = {'entity': 'map_packed'}
+    for mat_name in ['map_elems_poly_type', 'map_elems_slot', 'map_elems_n_points_orig', 'map_elems_points_start',
+                     'map_elems_n_points_saved']:
+        saved_mats_info[mat_name] = {'entity': 'map_packed', 'indexed_by': 'map_elems'}
+    saved_mats_info['map_points'] = {'entity': 'map_packed', 'indexed_by': 'map_points'}
+    dataset_props = dict(dataset_info['dataset_props'], map_layout='packed', n_map_elems=n_elems,
+                         n_map_points=n_points)
+    with Path(out_path, 'info').with_suffix('.pkl').open('wb') as fid:
+        pickle.dump({'dataset_props': dataset_props, 'saved_mats_info': saved_mats_info}, fid)
+    print(f'Packed the maps of {n_scenes} scenes: {n_elems} elements, {n_points} points,'
+          f' {n_padded_bytes / 1024 ** 2:.1f} MB -> {n_packed_bytes / 1024 ** 2:.1f} MB.'
+          f' Dataset saved to {out_path}')
+
+
+#########################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True, help='Path of the source dataset dir (info.pkl + data.h5)')
+    parser.add_argument('--out_path', type=str, required=True, help='Path of the output dataset dir')
+    parser.add_argument('--n_scenes_per_copy', type=int, default=1024, help='Number of scenes processed at a time')
+    args = parser.parse_args()
+    pack_maps(args.data_path, args.out_path, args.n_scenes_per_copy)
@@ -0,0 +1,197 @@
+import numpy as np
+import torch
+
+padded_map_keys = ('map_elems_points', 'map_elems_exists', 'map_elems_n_points_orig')
+
+
+#########################################################################################
+
+class PackedMap(object):
+    """
+    The map elements of a batch of scenes, packed without the non-existent elements.
+    Fields:
+        elems_points -- [n_elems x max_points_per_elem x 2] the points of all the existing elements in the batch
+        elems_n_points_orig -- [n_elems] number of real points in each element
+        elems_poly_type -- [n_elems] the polygon type index of each element
+        elems_slot -- [n_elems] the index of the element in the padded layout (among its polygon type elements)
+        scene_elems_offsets -- [batch_size + 1] the elements of scene i are [scene_elems_offsets[i]:scene_elems_offsets[i+1]]
+        n_polygon_types, max_num_elem -- the dimensions of the padded layout
+    It is used in place of the map_feat dict. The padded map tensors ('map_elems_points', 'map_elems_exists',
+     'map_elems_n_points_orig') are produced on demand by key access (e.g., map_feat['map_elems_points']),
+     for the code that still needs them (e.g., the penalties and the visualization).
+    """
+    __slots__ = ('elems_points', 'elems_n_points_orig', 'elems_poly_type', 'elems_slot', 'scene_elems_offsets',
+                 'n_polygon_types', 'max_num_elem', '_padded')
+    tensor_fields = ('elems_points', 'elems_n_points_orig', 'elems_poly_type', 'elems_slot', 'scene_elems_offsets')
+
+    def __init__(self, elems_points, elems_n_points_orig, elems_poly_type, elems_slot, scene_elems_offsets,
+                 n_polygon_types, max_num_elem):
+        self.elems_points = elems_points
+        self.elems_n_points_orig = elems_n_points_orig
+        self.elems_poly_type = elems_poly_type
+        self.elems_slot = elems_slot
+        self.scene_elems_offsets = scene_elems_offsets
+        self.n_polygon_types = n_polygon_types
+        self.max_num_elem = max_num_elem
+        self._padded = None
+
+    def __len__(self):
+        return self.scene_elems_offsets.shape[0] - 1
+
+    @property
+    def batch_size(self):
+        return len(self)
+
+    @property
+    def n_elems(self):
+        return self.elems_points.shape[0]
+
+    @property
+    def scene_n_elems(self):
+        """ [batch_size] the number of elements in each scene """
+        return self.scene_elems_offsets[1:] - self.scene_elems_offsets[:-1]
+
+    @property
+    def elems_scene(self):
+        """ [n_elems] the scene index of each element """
+        return torch.repeat_interleave(torch.arange(self.batch_size, device=self.elems_points.device),
+                                       self.scene_n_elems, output_size=self.n_elems)
+
+    def __repr__(self):
+        return f'PackedMap(batch_size={len(self)}, elems_points={tuple(self.elems_points.shape)},' \
+               f' n_polygon_types={self.n_polygon_types}, max_num_elem={self.max_num_elem})'
+
+    ########################################################################################
+    # dict-like access to the padded map tensors
+
+    def to_padded(self):
+        """ Return the map_feat dict of the padded layout [batch_size x n_polygon_types x max_num_elem x ...] """
+        if self._padded is None:
+            batch_size, n_polygon_types, max_num_elem = self.batch_size, self.n_polygon_types, self.max_num_elem
+            device = self.elems_points.device
+            elems_inds = (self.elems_scene, self.elems_poly_type.long(), self.elems_slot.long())
+            map_elems_points = torch.zeros((batch_size, n_polygon_types, max_num_elem) + self.elems_points.shape[1:],
+                                           dtype=self.elems_points.dtype, device=device)
+            map_elems_points[elems_inds] = self.elems_points
+            map_elems_exists = torch.zeros((batch_size, n_polygon_types, max_num_elem), dtype=torch.bool,
+                                           device=device)
+            map_elems_exists[elems_inds] = True
+            map_elems_n_points_orig = torch.zeros((batch_size, n_polygon_types, max_num_elem),
+                                                  dtype=self.elems_n_points_orig.dtype, device=device)
+            map_elems_n_points_orig[elems_inds] = self.elems_n_points_orig
+            self._padded = {'map_elems_points': map_elems_points, 'map_elems_exists': map_elems_exists,
+                            'map_elems_n_points_orig': map_elems_n_points_orig}
+        return self._padded
+
+    def __getitem__(self, key):
+        return self.to_padded()[key]
+
+    def get(self, key, default=None):
+        if key not in padded_map_keys:
+            return default
+        return self[key]
+
+    def keys(self):
+        return padded_map_keys
+
+    def items(self):
+        return self.to_padded().items()
+
+    def values(self):
+        return self.to_padded().values()
+
+    ########################################################################################
+
+    def tensors(self):
+        return [getattr(self, name) for name in self.tensor_fields]
+
+    def replace(self, **fields):
+        """ Return a new PackedMap with some of the fields replaced """
+        args = {name: getattr(self, name) for name in self.tensor_fields}
+        args.update(fields)
+        return PackedMap(n_polygon_types=self.n_polygon_types, max_num_elem=self.max_num_elem, **args)
+
+    def apply(self, fn):
+        """ Return a new PackedMap with fn (that keeps the shape, e.g., .to(device)) applied to each of the tensors """
+        return self.replace(**{name: fn(getattr(self, name)) for name in self.tensor_fields})
+
+    def slice(self, start, stop):
+        """ Return the scenes [start:stop] (views, no copy) """
+        scene_elems_offsets = self.scene_elems_offsets[start:stop + 1]
+        i_first, i_last = int(scene_elems_offsets[0]), int(scene_elems_offsets[-1])
+        return self.replace(elems_points=self.elems_points[i_first:i_last],
+                            elems_n_points_orig=self.elems_n_points_orig[i_first:i_last],
+                            elems_poly_type=self.elems_poly_type[i_first:i_last],
+                            elems_slot=self.elems_slot[i_first:i_last],
+                            scene_elems_offsets=scene_elems_offsets - i_first)
+
+    def index_select(self, scene_inds):
+        """ Return the scenes at scene_inds [n] (a LongTensor, in that order) """
+        starts = self.scene_elems_offsets[:-1][scene_inds]
+        counts = self.scene_n_elems[scene_inds]
+        ends = torch.cumsum(counts, dim=0)
+        n_elems = int(ends[-1]) if ends.numel() else 0
+        elems_inds = torch.repeat_interleave(starts - (ends - counts), counts, output_size=n_elems) \
+                     + torch.arange(n_elems, device=starts.device)
+        return self.replace(elems_points=self.elems_points[elems_inds],
+                            elems_n_points_orig=self.elems_n_points_orig[elems_inds],
+                            elems_poly_type=self.elems_poly_type[elems_inds],
+                            elems_slot=self.elems_slot[elems_inds],
+                            scene_elems_offsets=torch.cat([ends.new_zeros(1), ends]))
+
+    def transform_points(self, rot_mats, shifts):
+        """ Return a new PackedMap with the points of scene i rotated by rot_mats[i] [2x2] and shifted by shifts[i] [2] """
+        elems_scene = self.elems_scene
+        elems_points = torch.einsum('eij,epj->epi', rot_mats[elems_scene], self.elems_points.to(rot_mats.dtype))
+        return self.replace(elems_points=elems_points + shifts[elems_scene].unsqueeze(1))
+
+    def select_elems(self, keep):
+        """
+        Return a new PackedMap with only the elements where keep [n_elems] is True.
+        The kept elements are re-packed to the first slots of their scene and polygon type, and max_num_elem is
+         reduced to the largest number of kept elements of a polygon type in a scene (at least 1).
+        """
+        batch_size, n_polygon_types = self.batch_size, self.n_polygon_types
+        # the elements are ordered by scene and then by polygon type, so each (scene, type) group is contiguous
+        elems_group = (self.elems_scene * n_polygon_types + self.elems_poly_type.long())[keep]
+        group_n_elems = torch.bincount(elems_group, minlength=batch_size * n_polygon_types)
+        group_start = torch.cumsum(group_n_elems, dim=0) - group_n_elems
+        elems_slot = torch.arange(elems_group.shape[0], device=elems_group.device) - group_start[elems_group]
+        scene_n_elems = group_n_elems.view(batch_size, n_polygon_types).sum(dim=1)
+        scene_elems_offsets = torch.cat([scene_n_elems.new_zeros(1), torch.cumsum(scene_n_elems, dim=0)])
+        max_num_elem = max(int(group_n_elems.max()) if group_n_elems.numel() else 0, 1)
+        return PackedMap(elems_points=self.elems_points[keep],
+                         elems_n_points_orig=self.elems_n_points_orig[keep],
+                         elems_poly_type=self.elems_poly_type[keep],
+                         elems_slot=elems_slot.to(self.elems_slot.dtype),
+                         scene_elems_offsets=scene_elems_offsets,
+                         n_polygon_types=n_polygon_types,
+                         max_num_elem=max_num_elem)
+
+    @classmethod
+    def cat(cls, packed_maps):
+        """ Concatenate the scenes of several PackedMap objects """
+        first = packed_maps[0]
+        offsets = [first.scene_elems_offsets]
+        n_elems = first.n_elems
+        for packed_map in packed_maps[1:]:
+            offsets.append(packed_map.scene_elems_offsets[1:] + n_elems)
+            n_elems += packed_map.n_elems
+        return cls(elems_points=torch.cat([m.elems_points for m in packed_maps]),
+                   elems_n_points_orig=torch.cat([m.elems_n_points_orig for m in packed_maps]),
+                   elems_poly_type=torch.cat([m.elems_poly_type for m in packed_maps]),
+                   elems_slot=torch.cat([m.elems_slot for m in packed_maps]),
+                   scene_elems_offsets=torch.cat(offsets),
+                   n_polygon_types=first.n_polygon_types,
+                   max_num_elem=first.max_num_elem)
+
+
+#########################################################################################
+
+def ranges_to_indices(starts, counts):
+    """ Return the concatenation of the index ranges [starts[i] : starts[i] + counts[i]] (numpy int64 arrays) """
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    return np.repeat(np.asarray(starts, dtype=np.int64) - (ends - counts), counts) + np.arange(ends[-1] if len(ends) else 0)
+
+#########################################################################################
@@ -0,0 +1,368 @@
+"""Rewrite the data.h5 of an avsg dataset with a chosen HDF5 layout (chunking, compression and dtypes),
+and benchmark the read speed of layouts, to pick the fastest one for the storage
+
+The chunks of the matrices whose rows are scenes hold --chunk_scenes scenes (e.g., the batch size, or the
+--sampler_block_size of the block_shuffle sampler). The chunks of the matrices with other rows (a map table, or the
+packed map elements / points) hold the same number of scenes on average.
+The compression is one of: none | gzip | lzf | blosc | zstd | lz4  (blosc, zstd and lz4 need the hdf5plugin package,
+both here and when the dataset is read).
+The dataset statistics (data/dataset_stats.py) are not copied, since they are keyed by the data.h5 file.
+The --mat_dtypes overrides the dtype of some matrices, e.g. 'agents_num=int16,map_elems_n_points_orig=int16'.
+The integer casts are checked to be lossless. The map coordinates are changed only by --map_coords_dtype:
+    float32 -- kept as is
+    float16 -- float16 offsets from an origin of each scene (each map in a map table), i.e., the center of its
+               bounding box
+    int16   -- int16 offsets from that origin, in units of --map_coords_resolution [m] (1 cm by default)
+The origins are saved in 'map_coords_origin' ('map_scene_coords_origin' in the packed layout), and the points are
+decoded to float32 on the training device (see decode_map_coords in data/avsg_transforms.py).
+The padding points of the padded layout are decoded to the origin (as in a map table), not to zeros.
+The max geometric error of the encoding is checked against its bound, and saved in dataset_props.
+
+* To run:
+$ python -m data.repack_h5 --data_path datasets/avsg_data/sample --out_path datasets/avsg_data/sample_lzf
+    --chunk_scenes 64 --compression lzf
+
+* To benchmark all the combinations of some settings (each one is written to a sub-dir of --out_path):
+$ python -m data.repack_h5 --data_path datasets/avsg_data/sample --out_path /tmp/layouts --benchmark 1
+    --chunk_scenes 1,16,64,256 --compression none,gzip,lzf --batch_size 64
+The read speeds are measured with the OS page cache as is, drop it between the runs for cold-storage numbers.
+"""
+import argparse
+import itertools
+import pickle
+import time
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from data.h5_handle import H5FileHandle
+from data.packed_map import ranges_to_indices
+
+
+#########################################################################################
+
+def get_compression_kwargs(compression, compression_level):
+    """ The h5py create_dataset arguments of the compression filter """
+    if compression == 'none':
+        return {}
+    if compression == 'gzip':
+        return {'compression': 'gzip', 'compression_opts': compression_level, 'shuffle': True}
+    if compression == 'lzf':
+        return {'compression': 'lzf', 'shuffle': True}
+    try:
+        import hdf5plugin
+    except ImportError:
+        raise ImportError(f'The {compression} compression needs the hdf5plugin package') from None
+    if compression == 'blosc':
+        return dict(hdf5plugin.Blosc(cname='lz4', clevel=compression_level, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    if compression == 'zstd':
+        return dict(hdf5plugin.Zstd(clevel=compression_level))
+    if compression == 'lz4':
+        return dict(hdf5plugin.LZ4())
+    raise NotImplementedError(f'Unrecognized compression  {compression}')
+
+
+def parse_mat_dtypes(mat_dtypes):
+    """ 'name1=dtype1,name2=dtype2' -> {name1: dtype1, name2: dtype2} """
+    return {name: np.dtype(dtype) for name, dtype in (item.split('=') for item in mat_dtypes.split(',') if item)}
+
+
+def cast_block(block, dtype, mat_name):
+    if np.issubdtype(dtype, np.integer) and block.size:
+        dtype_info = np.iinfo(dtype)
+        if block.min() < dtype_info.min or block.max() > dtype_info.max:
+            raise ValueError(f'The values of {mat_name} do not fit in {dtype}')
+    return block.astype(dtype)
+
+
+#########################################################################################
+
+def check_not_encoded(dataset_info):
+    """ Raise a ValueError if the map coordinates of the dataset are encoded (the map tools need the original ones) """
+    if 'map_coords_encoding' in dataset_info['dataset_props']:
+        raise ValueError('The map coordinates of the dataset are encoded (data/repack_h5.py), use the original dataset')
+
+
+def get_encoding_error_bound(coords_dtype, resolution, max_abs_offset):
+    """ The bound of the distance between a point and its decoded point (half a quantization step per axis) """
+    if coords_dtype == 'int16':
+        step = resolution
+    else:
+        # the float16 spacing at the largest offset (10 bits of mantissa)
+        step = 2. ** (np.floor(np.log2(max(max_abs_offset, 2. ** -14))) - 10)
+    return np.sqrt(2.) * step / 2
+
+
+def encode_map_points(points, origins, is_real, coords_dtype, resolution, mat_name):
+    """
+    Encode the points [... x 2] as offsets from their origins [... x 2] (broadcastable).
+    The offsets of the non-real points (is_real [...]) are zeros.
+    Returns the encoded points and the max distance of a real point from its decoded point.
+    """
+    offsets = np.where(is_real[..., np.newaxis], points.astype(np.float64) - origins, 0.)
+    if coords_dtype == 'int16':
+        encoded = np.round(offsets / resolution)
+        if np.abs(encoded).max(initial=0) > np.iinfo(np.int16).max:
+            raise ValueError(f'The {mat_name} offsets do not fit in int16 with a resolution of {resolution} m,'
+                             f' use a coarser resolution or float16')
+        encoded = encoded.astype(np.int16)
+        decoded = encoded * resolution
+    elif coords_dtype == 'float16':
+        if np.abs(offsets).max(initial=0) > np.finfo(np.float16).max:
+            raise ValueError(f'The {mat_name} offsets do not fit in float16, use int16')
+        encoded = offsets.astype(np.float16)
+        decoded = encoded.astype(np.float64)
+    else:
+        raise NotImplementedError(f'Unrecognized map coordinates dtype  {coords_dtype}')
+    errors = np.sqrt(np.square(decoded - offsets).sum(axis=-1))[is_real]
+    error_bound = get_encoding_error_bound(coords_dtype, resolution, np.abs(offsets).max(initial=0))
+    max_error = float(errors.max(initial=0.))
+    if max_error > error_bound * (1 + 1e-6):
+        raise ValueError(f'The {mat_name} encoding error {max_error} exceeds its bound {error_bound}')
+    return encoded, max_error
+
+
+def get_bbox_centers(points, is_real, groups, n_groups):
+    """ The centers of the bounding boxes of the real points [n_points x 2] of each group -> [n_groups x 2] """
+    mins = np.full((n_groups, 2), np.inf)
+    maxs = np.full((n_groups, 2), -np.inf)
+    np.minimum.at(mins, groups[is_real], points[is_real])
+    np.maximum.at(maxs, groups[is_real], points[is_real])
+    centers = (mins + maxs) / 2
+    centers[np.logical_not(np.isfinite(centers))] = 0.
+    return centers
+
+
+def encode_map_coords(h5f, saved_mats_info, dataset_props, coords_dtype, resolution, create_out_dataset,
+                      n_scenes_per_copy):
+    """
+    Write the encoded map points and their origins (and register the origins in saved_mats_info).
+    Returns the names of the written matrices and the max geometric error.
+    """
+    max_error = 0.
+    if dataset_props.get('map_layout') == 'packed':
+        scene_elems_start = h5f['map_scene_elems_start'][:]
+        scene_n_elems = h5f['map_scene_n_elems'][:].astype(np.int64)
+        elems_points_start = h5f['map_elems_points_start']
+        elems_n_points_saved = h5f['map_elems_n_points_saved']
+        n_scenes = scene_elems_start.shape[0]
+        out_points = create_out_dataset('map_points', h5f['map_points'].shape, coords_dtype)
+        out_origins = create_out_dataset('map_scene_coords_origin', (n_scenes, 2), np.float32)
+        for i_first in range(0, n_scenes, n_scenes_per_copy):
+            i_last = min(i_first + n_scenes_per_copy, n_scenes)
+            # the elements of consecutive scenes, and their points, are contiguous
+            i_elem_first = int(scene_elems_start[i_first])
+            i_elem_last = i_elem_first + int(scene_n_elems[i_first:i_last].sum())
+            if i_elem_last == i_elem_first:
+                out_origins[i_first:i_last] = 0.
+                continue
+            n_points_saved = elems_n_points_saved[i_elem_first:i_elem_last].astype(np.int64)
+            i_point_first = int(elems_points_start[i_elem_first])
+            i_point_last = i_point_first + int(n_points_saved.sum())
+            points = h5f['map_points'][i_point_first:i_point_last]
+            points_scene = np.repeat(np.repeat(np.arange(i_last - i_first), scene_n_elems[i_first:i_last]),
+                                     n_points_saved)
+            is_real = np.ones(points.shape[0], dtype=bool)
+            origins = get_bbox_centers(points, is_real, points_scene, i_last - i_first)
+            encoded, block_max_error = encode_map_points(points, origins[points_scene], is_real, coords_dtype,
+                                                         resolution, 'map_points')
+            out_points[i_point_first:i_point_last] = encoded
+            out_origins[i_first:i_last] = origins
+            max_error = max(max_error, block_max_error)
+        saved_mats_info['map_scene_coords_origin'] = {'entity': 'map_packed'}
+        return ['map_points'], max_error
+    # the padded layout, or a map table (one origin per map)
+    points_mat = h5f['map_elems_points']
+    n_rows = points_mat.shape[0]
+    out_points = create_out_dataset('map_elems_points', points_mat.shape, coords_dtype)
+    out_origins = create_out_dataset('map_coords_origin', (n_rows, 2), np.float32)
+    for i_first in range(0, n_rows, n_scenes_per_copy):
+        i_last = min(i_first + n_scenes_per_copy, n_rows)
+        points = points_mat[i_first:i_last]  # [n x n_polygon_types x max_num_elem x max_points_per_elem x 2]
+        n_points_orig = h5f['map_elems_n_points_orig'][i_first:i_last]
+        is_real = np.logical_and(h5f['map_elems_exists'][i_first:i_last].astype(bool)[..., np.newaxis],
+                                 np.arange(points.shape[-2]) < n_points_orig[..., np.newaxis])
+        points_row = np.broadcast_to(np.arange(i_last - i_first).reshape(-1, 1, 1, 1), is_real.shape)
+        origins = get_bbox_centers(points.reshape(-1, 2), is_real.reshape(-1), points_row.reshape(-1), i_last - i_first)
+        encoded, block_max_error = encode_map_points(points, origins.reshape(-1, 1, 1, 1, 2), is_real, coords_dtype,
+                                                     resolution, 'map_elems_points')
+        out_points[i_first:i_last] = encoded
+        out_origins[i_first:i_last] = origins
+        max_error = max(max_error, block_max_error)
+    origin_info = {'entity': 'map'}
+    if saved_mats_info['map_elems_points'].get('indexed_by') == 'map_ids':
+        origin_info['indexed_by'] = 'map_ids'
+    saved_mats_info['map_coords_origin'] = origin_info
+    return ['map_elems_points'], max_error
+
+
+#########################################################################################
+
+def repack_h5(data_path, out_path, chunk_scenes=64, compression='none', compression_level=4, mat_dtypes='',
+              map_coords_dtype='float32', map_coords_resolution=0.01, n_scenes_per_copy=1024):
+    info_file_path = Path(data_path, 'info').with_suffix('.pkl')
+    with info_file_path.open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    n_scenes = dataset_info['dataset_props']['n_scenes']
+    saved_mats_info_orig = dataset_info['saved_mats_info']
+    # the output info (new matrices are registered by the map coordinates encoding)
+    saved_mats_info = dict(saved_mats_info_orig)
+    dataset_props = dict(dataset_info['dataset_props'])
+    compression_kwargs = get_compression_kwargs(compression, compression_level)
+    mat_dtypes = parse_mat_dtypes(mat_dtypes)
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    with h5py.File(Path(data_path, 'data').with_suffix('.h5'), 'r') as h5f, \
+            h5py.File(Path(out_path, 'data').with_suffix('.h5'), 'w') as out_h5f:
+
+        def create_out_dataset(mat_name, shape, dtype):
+            # the same number of scenes per chunk on average, also for the matrices with other rows
+            n_rows = shape[0]
+            chunk_rows = int(np.clip(np.ceil(chunk_scenes * n_rows / max(n_scenes, 1)), 1, max(n_rows, 1)))
+            return out_h5f.create_dataset(mat_name, shape=shape, dtype=dtype, chunks=(chunk_rows,) + tuple(shape[1:]),
+                                          **compression_kwargs)
+
+        encoded_mat_names = []
+        if map_coords_dtype != 'float32':
+            if 'map_coords_origin' in saved_mats_info or 'map_scene_coords_origin' in saved_mats_info:
+                raise ValueError('The map coordinates of the dataset are already encoded')
+            encoded_mat_names, max_error = encode_map_coords(h5f, saved_mats_info, dataset_props, map_coords_dtype,
+                                                             map_coords_resolution, create_out_dataset,
+                                                             n_scenes_per_copy)
+            scale = map_coords_resolution if map_coords_dtype == 'int16' else 1.
+            dataset_props['map_coords_encoding'] = {'dtype': map_coords_dtype, 'scale': scale, 'max_error': max_error}
+            print(f'Encoded the map coordinates as {map_coords_dtype}, max geometric error: {max_error:.4f} m')
+        for mat_name, mat_info in saved_mats_info_orig.items():
+            if mat_name in encoded_mat_names:
+                continue
+            h5_dataset = h5f[mat_name]
+            n_rows = h5_dataset.shape[0]
+            dtype = mat_dtypes.get(mat_name, h5_dataset.dtype)
+            if mat_info['entity'] in ('map', 'map_packed') and np.issubdtype(h5_dataset.dtype, np.floating) \
+                    and dtype != h5_dataset.dtype:
+                raise ValueError(f'The dtype of the map coordinates ({mat_name}) is set by --map_coords_dtype')
+            out_dataset = create_out_dataset(mat_name, h5_dataset.shape, dtype)
+            chunk_rows = out_dataset.chunks[0]
+            # copy in blocks of whole chunks, to bound the memory usage
+            n_rows_per_copy = max(n_scenes_per_copy // chunk_rows, 1) * chunk_rows
+            for i_first in range(0, n_rows, n_rows_per_copy):
+                i_last = min(i_first + n_rows_per_copy, n_rows)
+                out_dataset[i_first:i_last] = cast_block(h5_dataset[i_first:i_last], dtype, mat_name)
+            print(f'Saved {mat_name} {h5_dataset.shape} {dtype}, chunk rows: {chunk_rows},'
+                  f' {h5_dataset.id.get_storage_size() / 1024 ** 2:.1f} MB'
+                  f' -> {out_dataset.id.get_storage_size() / 1024 ** 2:.1f} MB')
+    dataset_props['h5_layout'] = {'chunk_scenes': chunk_scenes, 'compression': compression,
+                                  'compression_level': compression_level}
+    with Path(out_path, 'info').with_suffix('.pkl').open('wb') as fid:
+        pickle.dump({'dataset_props': dataset_props, 'saved_mats_info': saved_mats_info}, fid)
+    print(f'Dataset saved to {out_path}')
+
+
+#########################################################################################
+
+def read_scenes(h5_handle, saved_mats_info, indices):
+    """ Read all the matrices of the scenes at 'indices', with one read per matrix (like AvsgDataset) """
+    mats = {}
+    for mat_name, mat_info in saved_mats_info.items():
+        if mat_info['entity'] != 'map_packed' and 'indexed_by' not in mat_info:
+            mats[mat_name] = h5_handle.read_batch(mat_name, indices)
+    if 'map_ids' in saved_mats_info:
+        unique_map_ids = np.unique(mats['map_ids'])
+        for mat_name, mat_info in saved_mats_info.items():
+            if mat_info.get('indexed_by') == 'map_ids':
+                mats[mat_name] = h5_handle.read_batch(mat_name, unique_map_ids)
+    if 'map_scene_elems_start' in saved_mats_info:
+        elems_inds = ranges_to_indices(h5_handle.read_batch('map_scene_elems_start', indices),
+                                       h5_handle.read_batch('map_scene_n_elems', indices))
+        if len(elems_inds):
+            points_inds = ranges_to_indices(h5_handle.read_batch('map_elems_points_start', elems_inds),
+                                            h5_handle.read_batch('map_elems_n_points_saved', elems_inds))
+            for mat_name, mat_info in saved_mats_info.items():
+                if mat_info.get('indexed_by') == 'map_elems':
+                    mats[mat_name] = h5_handle.read_batch(mat_name, elems_inds)
+            mats['map_points'] = h5_handle.read_batch('map_points', points_inds)
+        if 'map_scene_coords_origin' in saved_mats_info:
+            mats['map_scene_coords_origin'] = h5_handle.read_batch('map_scene_coords_origin', indices)
+    return mats
+
+
+def benchmark_reads(data_path, batch_size=64, n_batches=50, seed=0):
+    """ Return the read speeds [scenes/sec] of random scenes, of random batches and of contiguous batches """
+    with Path(data_path, 'info').with_suffix('.pkl').open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    saved_mats_info = dataset_info['saved_mats_info']
+    n_scenes = dataset_info['dataset_props']['n_scenes']
+    batch_size = min(batch_size, n_scenes)
+    rng = np.random.default_rng(seed)
+    h5_handle = H5FileHandle(Path(data_path, 'data').with_suffix('.h5'))
+    read_scenes(h5_handle, saved_mats_info, np.arange(1))  # open the file and the datasets
+    speeds = {}
+    # random access - one scene per read (the per-sample loading)
+    start_time = time.perf_counter()
+    for index in rng.integers(n_scenes, size=n_batches * batch_size):
+        read_scenes(h5_handle, saved_mats_info, np.array([index]))
+    speeds['random_scenes'] = n_batches * batch_size / (time.perf_counter() - start_time)
+    # batched reads of random scenes (the shuffle sampler)
+    start_time = time.perf_counter()
+    for _ in range(n_batches):
+        read_scenes(h5_handle, saved_mats_info, rng.choice(n_scenes, size=batch_size, replace=False))
+    speeds['random_batches'] = n_batches * batch_size / (time.perf_counter() - start_time)
+    # batched reads of contiguous scenes (the block_shuffle sampler)
+    start_time = time.perf_counter()
+    for i_first in rng.integers(n_scenes - batch_size + 1, size=n_batches):
+        read_scenes(h5_handle, saved_mats_info, np.arange(i_first, i_first + batch_size))
+    speeds['block_batches'] = n_batches * batch_size / (time.perf_counter() - start_time)
+    h5_handle.close()
+    return speeds
+
+
+def benchmark_layouts(data_path, out_path, chunk_scenes_list, compression_list, compression_level=4, mat_dtypes='',
+                      map_coords_dtype='float32', map_coords_resolution=0.01, batch_size=64, n_batches=50):
+    results = [('source', Path(Path(data_path, 'data').with_suffix('.h5')).stat().st_size,
+                benchmark_reads(data_path, batch_size, n_batches))]
+    for chunk_scenes, compression in itertools.product(chunk_scenes_list, compression_list):
+        name = f'chunk{chunk_scenes}_{compression}'
+        layout_path = Path(out_path, name)
+        repack_h5(data_path, layout_path, chunk_scenes, compression, compression_level, mat_dtypes,
+                  map_coords_dtype, map_coords_resolution)
+        results.append((name, Path(layout_path, 'data').with_suffix('.h5').stat().st_size,
+                        benchmark_reads(layout_path, batch_size, n_batches)))
+    print(f"{'layout':<24}{'size [MB]':>12}{'random scenes/s':>18}{'random batches scenes/s':>26}"
+          f"{'block batches scenes/s':>25}")
+    for name, file_size, speeds in results:
+        print(f"{name:<24}{file_size / 1024 ** 2:>12.1f}{speeds['random_scenes']:>18.0f}"
+              f"{speeds['random_batches']:>26.0f}{speeds['block_batches']:>25.0f}")
+
+
+#########################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True, help='Path of the source dataset dir (info.pkl + data.h5)')
+    parser.add_argument('--out_path', type=str, required=True,
+                        help='Path of the output dataset dir (in the benchmark, the dir of the layouts sub-dirs)')
+    parser.add_argument('--chunk_scenes', type=str, default='64',
+                        help='Number of scenes in an HDF5 chunk (comma-separated values in the benchmark)')
+    parser.add_argument('--compression', type=str, default='none',
+                        help=" 'none' | 'gzip' | 'lzf' | 'blosc' | 'zstd' | 'lz4' (comma-separated values in the benchmark)")
+    parser.add_argument('--compression_level', type=int, default=4, help='The level of gzip, blosc and zstd')
+    parser.add_argument('--mat_dtypes', type=str, default='',
+                        help="dtypes of some of the matrices, e.g., 'agents_num=int16' (other matrices keep their dtype)")
+    parser.add_argument('--map_coords_dtype', type=str, default='float32',
+                        help=" 'float32' | 'float16' (offsets from a per-scene origin) | 'int16' (quantized offsets)")
+    parser.add_argument('--map_coords_resolution', type=float, default=0.01,
+                        help='[m] The quantization step of the int16 map coordinates')
+    parser.add_argument('--n_scenes_per_copy', type=int, default=1024, help='Number of scenes copied at a time')
+    parser.add_argument('--benchmark', type=int, default=0,
+                        help='If 1, write each combination of the settings and measure its read speed')
+    parser.add_argument('--batch_size', type=int, default=64, help='The batch size in the benchmark')
+    parser.add_argument('--n_batches', type=int, default=50, help='Number of batches read in each benchmark test')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark_layouts(args.data_path, args.out_path, [int(n) for n in args.chunk_scenes.split(',')],
+                          args.compression.split(','), args.compression_level, args.mat_dtypes,
+                          args.map_coords_dtype, args.map_coords_resolution, args.batch_size, args.n_batches)
+    else:
+        repack_h5(args.data_path, args.out_path, int(args.chunk_scenes), args.compression, args.compression_level,
+                  args.mat_dtypes, args.map_coords_dtype, args.map_coords_resolution, args.n_scenes_per_copy)
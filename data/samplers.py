@@ -0,0 +1,116 @@
+import numpy as np
+import torch
+import torch.utils.data as data_utils
+
+
+#########################################################################################
+
+class BlockShuffleBatchSampler(data_utils.Sampler):
+    """
+    Yields batches of indices, made of contiguous blocks of indices (e.g., HDF5 chunks) drawn in a random order.
+    The blocks are read with sequential I/O, in exchange for a lower shuffle quality
+    (each batch contains about batch_size / block_size  blocks).
+    samples_order -- (optional) [n_samples] the indices in the order of their rows in the data file (e.g., the
+     positions in a Subset sorted by the underlying scene indices), the blocks are consecutive runs of this order
+    """
+
+    def __init__(self, n_samples, batch_size, block_size, drop_last=False, generator=None, samples_order=None):
+        self.n_samples = n_samples
+        self.batch_size = batch_size
+        self.block_size = max(1, block_size)
+        self.drop_last = drop_last
+        self.generator = generator
+        self.samples_order = None if samples_order is None else torch.as_tensor(samples_order).tolist()
+
+    def __iter__(self):
+        n_blocks = -(-self.n_samples // self.block_size)
+        blocks_order = torch.randperm(n_blocks, generator=self.generator).tolist()
+        batch = []
+        for i_block in blocks_order:
+            i_first = i_block * self.block_size
+            i_last = min(i_first + self.block_size, self.n_samples)
+            if self.samples_order is None:
+                batch.extend(range(i_first, i_last))
+            else:
+                batch.extend(self.samples_order[i_first:i_last])
+            while len(batch) >= self.batch_size:
+                yield batch[:self.batch_size]
+                batch = batch[self.batch_size:]
+        if batch and not self.drop_last:
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n_samples // self.batch_size
+        return -(-self.n_samples // self.batch_size)
+
+#########################################################################################
+
+class BucketBatchSampler(data_utils.Sampler):
+    """
+    Yields batches of indices of samples of similar sizes (e.g., the number of map elements of the scenes), so each
+    batch can be trimmed to its largest sample instead of the dataset maximum.
+    The samples are divided to n_buckets buckets by the quantiles of their sizes. In each epoch every bucket is
+    shuffled and split to batches, the leftover samples of all the buckets are batched together (in the buckets order),
+    and the batches are yielded in a random order.
+    """
+
+    def __init__(self, sizes, batch_size, n_buckets, drop_last=False, generator=None):
+        sizes = np.asarray(sizes)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.generator = generator
+        boundaries = np.unique(np.quantile(sizes, np.linspace(0., 1., max(n_buckets, 1) + 1)[1:-1]))
+        samples_bucket = np.searchsorted(boundaries, sizes, side='right')
+        self.buckets = [torch.from_numpy(np.nonzero(samples_bucket == i_bucket)[0])
+                        for i_bucket in range(len(boundaries) + 1)]
+        self.buckets = [bucket for bucket in self.buckets if len(bucket)]
+
+    def __iter__(self):
+        batches = []
+        leftovers = []
+        for bucket in self.buckets:
+            bucket = bucket[torch.randperm(len(bucket), generator=self.generator)]
+            n_full = (len(bucket) // self.batch_size) * self.batch_size
+            batches += list(bucket[:n_full].split(self.batch_size))
+            leftovers.append(bucket[n_full:])
+        leftovers = torch.cat(leftovers)
+        n_leftovers = (len(leftovers) // self.batch_size) * self.batch_size if self.drop_last else len(leftovers)
+        batches += list(leftovers[:n_leftovers].split(self.batch_size))
+        for i_batch in torch.randperm(len(batches), generator=self.generator).tolist():
+            yield batches[i_batch].tolist()
+
+    def __len__(self):
+        n_full = sum(len(bucket) // self.batch_size for bucket in self.buckets)
+        n_leftovers = sum(len(bucket) % self.batch_size for bucket in self.buckets)
+        if self.drop_last:
+            return n_full + n_leftovers // self.batch_size
+        return n_full + -(-n_leftovers // self.batch_size)
+
+#########################################################################################
+
+class EndlessSampler(data_utils.Sampler):
+    """
+    Yields the items of a (batch) sampler endlessly, epoch after epoch, so the DataLoader iterator never runs out
+    and its workers are never restarted.
+    At the start of each epoch, the generator used by the sampler is re-seeded with seed + epoch, so every epoch is
+    reshuffled in a reproducible way.
+    The optional epoch_end_callback is called when the sampler finished yielding an epoch (in the main process).
+    """
+
+    def __init__(self, sampler, generator, seed, epoch_end_callback=None):
+        self.sampler = sampler
+        self.generator = generator
+        self.seed = seed
+        self.epoch_end_callback = epoch_end_callback
+        self.epoch = 0
+
+    def __iter__(self):
+        while True:
+            self.generator.manual_seed(self.seed + self.epoch)
+            yield from self.sampler
+            if self.epoch_end_callback is not None:
+                self.epoch_end_callback()
+            self.epoch += 1
+
+#########################################################################################
@@ -0,0 +1,144 @@
+import torch
+
+from data.packed_map import PackedMap
+
+
+#########################################################################################
+
+class SceneBatch(object):
+    """
+    A batch of scenes, as used by the models and the visualizer.
+    Fields:
+        map_feat -- dict of the map tensors [batch_size x ...]
+                    (optionally with 'map_ids' and 'map_poses', if the scenes maps come from a map table)
+                    or a PackedMap (if the maps are stored packed)
+        n_agents_in_scene -- [batch_size]
+        agents_exists -- [batch_size x max_num_agents]
+        agents_feat_vecs -- [batch_size x max_num_agents x agent_feat_vec_dim]
+    The batch is also the 'conditioning' input of the models, and it supports the key access of the former batch dicts
+    (e.g., batch['conditioning']['map_feat']), so code that reads the dicts works unchanged.
+    """
+    __slots__ = ('map_feat', 'n_agents_in_scene', 'agents_exists', 'agents_feat_vecs')
+
+    def __init__(self, map_feat, n_agents_in_scene, agents_exists, agents_feat_vecs):
+        self.map_feat = map_feat
+        self.n_agents_in_scene = n_agents_in_scene
+        self.agents_exists = agents_exists
+        self.agents_feat_vecs = agents_feat_vecs
+
+    @classmethod
+    def from_dict(cls, batch):
+        """ Build from a batch dict {'conditioning': {'map_feat', 'n_agents_in_scene', 'agents_exists'}, 'agents_feat_vecs'} """
+        conditioning = batch['conditioning']
+        return cls(map_feat=conditioning['map_feat'],
+                   n_agents_in_scene=conditioning['n_agents_in_scene'],
+                   agents_exists=conditioning['agents_exists'],
+                   agents_feat_vecs=batch['agents_feat_vecs'])
+
+    @property
+    def conditioning(self):
+        return self
+
+    def __getitem__(self, key):
+        if key == 'conditioning':
+            return self
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __len__(self):
+        return self.agents_exists.shape[0]
+
+    @property
+    def batch_size(self):
+        return len(self)
+
+    @property
+    def device(self):
+        return self.agents_feat_vecs.device
+
+    def __repr__(self):
+        if isinstance(self.map_feat, PackedMap):
+            map_shapes = self.map_feat
+        else:
+            map_shapes = {k: tuple(v.shape) for k, v in self.map_feat.items()}
+        return f'SceneBatch(batch_size={len(self)}, agents_feat_vecs={tuple(self.agents_feat_vecs.shape)},' \
+               f' map_feat={map_shapes}, device={self.device})'
+
+    ########################################################################################
+
+    def tensors(self):
+        """ Return a list of all the tensors of the batch """
+        if isinstance(self.map_feat, PackedMap):
+            map_tensors = self.map_feat.tensors()
+        else:
+            map_tensors = list(self.map_feat.values())
+        return map_tensors + [self.n_agents_in_scene, self.agents_exists, self.agents_feat_vecs]
+
+    def apply(self, fn):
+        """ Return a new batch with fn (that keeps the tensor shapes) applied to each of the tensors """
+        if isinstance(self.map_feat, PackedMap):
+            map_feat = self.map_feat.apply(fn)
+        else:
+            map_feat = {k: fn(v) for k, v in self.map_feat.items()}
+        return SceneBatch(map_feat=map_feat,
+                          n_agents_in_scene=fn(self.n_agents_in_scene),
+                          agents_exists=fn(self.agents_exists),
+                          agents_feat_vecs=fn(self.agents_feat_vecs))
+
+    def to(self, device, non_blocking=False):
+        """ Move all the tensors to the device (use non_blocking=True with a pinned batch for an async copy) """
+        return self.apply(lambda t: t.to(device, non_blocking=non_blocking))
+
+    def pin_memory(self):
+        """ Return a copy in page-locked memory (also called by the DataLoader if pin_memory=True) """
+        return self.apply(lambda t: t.pin_memory() if t.device.type == 'cpu' else t)
+
+    def record_stream(self, stream):
+        """ Mark the (CUDA) tensors as used by the stream, so their memory is not reused before the stream is done """
+        for t in self.tensors():
+            t.record_stream(stream)
+        return self
+
+    def slice(self, start, stop):
+        """ Return the scenes [start:stop] (views, no copy) """
+        if isinstance(self.map_feat, PackedMap):
+            map_feat = self.map_feat.slice(start, stop)
+        else:
+            map_feat = {k: v[start:stop] for k, v in self.map_feat.items()}
+        return SceneBatch(map_feat=map_feat,
+                          n_agents_in_scene=self.n_agents_in_scene[start:stop],
+                          agents_exists=self.agents_exists[start:stop],
+                          agents_feat_vecs=self.agents_feat_vecs[start:stop])
+
+    def select(self, i_scene):
+        """ Return the scene i_scene, as a batch of size 1 (views, no copy) """
+        return self.slice(i_scene, i_scene + 1)
+
+
+#########################################################################################
+
+def stack_to_buffer(tensors, pin_memory=False):
+    """ Stack same-shaped tensors with a single copy into one new contiguous (optionally pinned) buffer """
+    first = tensors[0]
+    pin_memory = pin_memory and first.device.type == 'cpu' and torch.cuda.is_available()
+    out = torch.empty((len(tensors),) + tuple(first.shape), dtype=first.dtype, device=first.device,
+                      pin_memory=pin_memory)
+    return torch.stack(tensors, out=out)
+
+
+def collate_scene_dicts(samples, pin_memory=False):
+    """ Collate a list of (nested) sample dicts to a batch dict with the same structure """
+    first = samples[0]
+    if isinstance(first, PackedMap):
+        return PackedMap.cat(samples)
+    if isinstance(first, dict):
+        return {key: collate_scene_dicts([sample[key] for sample in samples], pin_memory) for key in first.keys()}
+    return stack_to_buffer([torch.as_tensor(sample) for sample in samples], pin_memory)
+
+
+def collate_scenes(samples, pin_memory=False):
+    """ The collate_fn for datasets that return scene sample dicts: stacks them into a SceneBatch """
+    return SceneBatch.from_dict(collate_scene_dicts(samples, pin_memory))
+
+#########################################################################################
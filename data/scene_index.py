@@ -0,0 +1,121 @@
+"""Build a columnar metadata index of the scenes of an avsg dataset, for fast filtered subsets (see --scene_query)
+
+The index 'scene_index.npz' (next to info.pkl) has one array per column, with a row per scene:
+    n_agents                    -- the number of agents in the scene
+    n_<polygon_type>            -- the number of map elements of each polygon type (e.g., n_crosswalks)
+    min_x, min_y, max_x, max_y  -- the bounding box of the agents centroids [m]
+    map_id                      -- the row of the scene's map in the map table (the scene index if there is no table)
+It is built in one parallel pass over data.h5 (the map points are not read), and is keyed by a fingerprint of data.h5
+like the dataset statistics.
+A query is a numpy expression over the columns, e.g. '(n_agents >= 3) & (n_crosswalks > 0) & (max_x < 100)',
+which is resolved to the indices of the matching scenes without reading data.h5.
+
+* To run:
+$ python -m data.scene_index --data_path datasets/avsg_data/sample --n_workers 8
+
+* Then train with, e.g.:  --scene_query '(n_agents >= 3) & (n_crosswalks > 0)'
+"""
+import argparse
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from data.dataset_stats import get_file_fingerprint, read_block_map_counts
+
+
+#########################################################################################
+
+def get_scene_index_file_path(data_path):
+    return Path(data_path, 'scene_index').with_suffix('.npz')
+
+
+def load_scene_index(data_path):
+    """ Return the columns dict of the scene index, or None if it was not built or data.h5 was changed """
+    index_file_path = get_scene_index_file_path(data_path)
+    data_file_path = Path(data_path, 'data').with_suffix('.h5')
+    if not index_file_path.exists() or not data_file_path.exists():
+        return None
+    with np.load(index_file_path) as index_file:
+        columns = {name: index_file[name] for name in index_file.files}
+    if str(columns.pop('data_file_hash')) != get_file_fingerprint(data_file_path):
+        print(f'The scene index {index_file_path} is stale (data.h5 was changed), rerun data/scene_index.py')
+        return None
+    return columns
+
+
+def query_scene_index(columns, query):
+    """ Return the indices of the scenes where the query expression (over the columns arrays) is True """
+    is_selected = eval(query, {'__builtins__': {}, 'np': np}, dict(columns))
+    n_scenes = len(columns['n_agents'])
+    is_selected = np.broadcast_to(np.asarray(is_selected, dtype=bool), (n_scenes,))
+    return np.nonzero(is_selected)[0]
+
+
+#########################################################################################
+
+def calc_block_index(args):
+    """ The index rows of the scenes [i_first:i_last] (runs in a worker process) """
+    data_path, dataset_info, i_first, i_last = args
+    dataset_labels = dataset_info['dataset_props']['agent_feat_vec_coord_labels']
+    centroid_inds = [dataset_labels.index('centroid_x'), dataset_labels.index('centroid_y')]
+    with h5py.File(Path(data_path, 'data').with_suffix('.h5'), 'r') as h5f:
+        agents_num = h5f['agents_num'][i_first:i_last].astype(np.int64).reshape(-1)
+        centroids = h5f['agents_feat_vecs'][i_first:i_last][..., centroid_inds].astype(np.float64)
+        elems_num, _ = read_block_map_counts(h5f, dataset_info, i_first, i_last)
+        if 'map_ids' in dataset_info['saved_mats_info']:
+            map_ids = h5f['map_ids'][i_first:i_last].astype(np.int64)
+        else:
+            map_ids = np.arange(i_first, i_last, dtype=np.int64)
+    agents_exists = (np.arange(centroids.shape[1]) < agents_num[:, np.newaxis])[..., np.newaxis]
+    mins = np.where(agents_exists, centroids, np.inf).min(axis=1)
+    maxs = np.where(agents_exists, centroids, -np.inf).max(axis=1)
+    # the scenes with no agents have no bounding box (they match no region query)
+    mins[np.logical_not(np.isfinite(mins))] = np.nan
+    maxs[np.logical_not(np.isfinite(maxs))] = np.nan
+    columns = {'n_agents': agents_num.astype(np.int32),
+               'min_x': mins[:, 0], 'min_y': mins[:, 1], 'max_x': maxs[:, 0], 'max_y': maxs[:, 1],
+               'map_id': map_ids}
+    for i_type, poly_type in enumerate(dataset_info['dataset_props']['polygon_types']):
+        columns[f'n_{poly_type}'] = elems_num[:, i_type].astype(np.int32)
+    return {name: (col.astype(np.float32) if col.dtype == np.float64 else col) for name, col in columns.items()}
+
+
+def build_scene_index(data_path, n_workers=4, n_scenes_per_block=4096):
+    with Path(data_path, 'info').with_suffix('.pkl').open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    data_file_path = Path(data_path, 'data').with_suffix('.h5')
+    with h5py.File(data_file_path, 'r') as h5f:
+        n_scenes = h5f['agents_num'].shape[0]
+    blocks = [(data_path, dataset_info, i_first, min(i_first + n_scenes_per_block, n_scenes))
+              for i_first in range(0, n_scenes, n_scenes_per_block)]
+    # the file is opened by each worker, after the fork
+    blocks_columns = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for i_block, block_columns in enumerate(executor.map(calc_block_index, blocks)):
+            blocks_columns.append(block_columns)
+            print(f'Processed {blocks[i_block][3]}/{n_scenes} scenes')
+    columns = {name: np.concatenate([block_columns[name] for block_columns in blocks_columns])
+               for name in blocks_columns[0].keys()}
+    index_file_path = get_scene_index_file_path(data_path)
+    np.savez(index_file_path, data_file_hash=get_file_fingerprint(data_file_path), **columns)
+    print(f'Scene index of {n_scenes} scenes with the columns {list(columns.keys())} saved to {index_file_path}')
+
+
+#########################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True, help='Path of the dataset dir (info.pkl + data.h5)')
+    parser.add_argument('--n_workers', type=int, default=4, help='Number of processes')
+    parser.add_argument('--n_scenes_per_block', type=int, default=4096, help='Number of scenes processed by a task')
+    parser.add_argument('--query', type=str, default='', help='If given, print the number of matching scenes')
+    args = parser.parse_args()
+    build_scene_index(args.data_path, args.n_workers, args.n_scenes_per_block)
+    if args.query:
+        start_time = time.perf_counter()
+        scenes_inds = query_scene_index(load_scene_index(args.data_path), args.query)
+        print(f'{len(scenes_inds)} scenes match {args.query!r} ({(time.perf_counter() - start_time) * 1e3:.1f} ms)')
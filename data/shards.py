@@ -0,0 +1,168 @@
+"""Sharded avsg datasets - several dataset files that are used as one dataset
+
+A sharded dataset dir has a 'manifest.json' file, and a sub-dir per shard. Each shard is a regular avsg dataset dir
+(info.pkl + data.h5), so the shards can be written independently (e.g., by parallel ingest jobs), and then listed in
+the manifest. The manifest holds:
+    dataset_props    -- the dataset_props of the shards (equal in all the shards, except the counts), with the total
+                        n_scenes (and n_maps)
+    saved_mats_info  -- the saved_mats_info of the shards (equal in all the shards)
+    shards           -- a list of {'path' (relative to the dataset dir), 'n_scenes', 'n_rows' (of each matrix)}
+The avsg dataset of a sharded dataset dir (e.g., --data_path_train) numbers the scenes globally, shard after shard,
+and finds the shard of a scene by a binary search over the shards offsets (see ShardedH5FileHandle).
+With --dataset_mode avsg_stream, the shards are divided between the distributed ranks and the DataLoader workers, so
+each process reads only its own shards. The other (map-style) dataset modes read all the shards, so they reject a
+sharded dataset in a distributed run.
+The maps of a scene must be in its shard (the map table and the packed maps are per shard). The dataset statistics and
+the scene index (data/dataset_stats.py, data/scene_index.py) are not supported for a sharded dataset.
+
+* To list existing shards in a manifest:
+$ python -m data.shards --data_path datasets/avsg_data/sharded --shard_paths shard_000 shard_001 shard_002
+
+* To split a dataset to shards (before dedup_maps / pack_maps, which can then be applied per shard):
+$ python -m data.shards --data_path datasets/avsg_data/sharded --split_from datasets/avsg_data/sample --n_shards 8
+"""
+import argparse
+import json
+import os
+import pickle
+from pathlib import Path
+
+import h5py
+import numpy as np
+import torch
+
+# the dataset props that must be equal in all the shards (the others, e.g., the counts, are taken from the first shard
+# or summed)
+shard_equal_props = ('polygon_types', 'closed_polygon_types', 'agent_feat_vec_coord_labels', 'coord_dim',
+                     'max_num_elem', 'max_points_per_elem', 'map_layout')
+
+
+#########################################################################################
+
+def get_manifest_file_path(data_path):
+    return Path(data_path, 'manifest').with_suffix('.json')
+
+
+def is_sharded(data_path):
+    return get_manifest_file_path(data_path).exists()
+
+
+def load_manifest(data_path):
+    """Return the manifest dict of a sharded dataset (with the fields 'dataset_props', 'saved_mats_info', 'shards')"""
+    with get_manifest_file_path(data_path).open('r') as fid:
+        return json.load(fid)
+
+
+def get_row_refs(saved_mats_info):
+    """Return {mat_name: the matrix whose rows it refers to} for the matrices that hold row numbers
+     (e.g., 'map_ids' holds rows of the map table)"""
+    ref_spaces = {'map_ids': 'map_ids', 'map_scene_elems_start': 'map_elems', 'map_elems_points_start': 'map_points'}
+    row_refs = {}
+    for ref_mat_name, space in ref_spaces.items():
+        target_mat_names = [mat_name for mat_name, mat_info in saved_mats_info.items()
+                            if mat_info.get('indexed_by') == space]
+        if ref_mat_name in saved_mats_info and target_mat_names:
+            row_refs[ref_mat_name] = target_mat_names[0]
+    return row_refs
+
+
+def get_rank_and_world_size():
+    """Return the rank of this process and the number of processes in distributed training ((0, 1) if not distributed)"""
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return int(os.environ.get('RANK', 0)), int(os.environ.get('WORLD_SIZE', 1))
+
+
+#########################################################################################
+
+def build_manifest(data_path, shard_paths):
+    """Write the manifest of the shards (dataset dirs, relative to data_path) to data_path"""
+    shards = []
+    dataset_props = saved_mats_info = None
+    for shard_path in shard_paths:
+        with Path(data_path, shard_path, 'info').with_suffix('.pkl').open('rb') as fid:
+            shard_info = pickle.load(fid)
+        shard_props = shard_info['dataset_props']
+        if dataset_props is None:
+            dataset_props, saved_mats_info = shard_props, shard_info['saved_mats_info']
+        elif shard_info['saved_mats_info'] != saved_mats_info:
+            raise ValueError(f'The saved_mats_info of the shard {shard_path} differs from the first shard')
+        for name in shard_equal_props:
+            if list(np.atleast_1d(shard_props.get(name, []))) != list(np.atleast_1d(dataset_props.get(name, []))):
+                raise ValueError(f'The {name} of the shard {shard_path} differs from the first shard')
+        encoding, shard_encoding = dataset_props.get('map_coords_encoding'), shard_props.get('map_coords_encoding')
+        if (encoding is None) != (shard_encoding is None) or \
+                (encoding and (encoding['dtype'], encoding['scale']) != (shard_encoding['dtype'], shard_encoding['scale'])):
+            raise ValueError(f'The map coordinates encoding of the shard {shard_path} differs from the first shard')
+        with h5py.File(Path(data_path, shard_path, 'data').with_suffix('.h5'), 'r') as h5f:
+            n_rows = {mat_name: int(h5f[mat_name].shape[0]) for mat_name in saved_mats_info.keys()}
+        shards.append({'path': str(shard_path), 'n_scenes': n_rows['agents_num'], 'n_rows': n_rows,
+                       'n_maps': shard_props.get('n_maps')})
+    dataset_props = dict(dataset_props, n_scenes=sum(shard['n_scenes'] for shard in shards))
+    if 'map_ids' in saved_mats_info:
+        dataset_props['n_maps'] = sum(shard.pop('n_maps') for shard in shards)
+    else:
+        for shard in shards:
+            shard.pop('n_maps')
+    manifest = {'dataset_props': dataset_props, 'saved_mats_info': saved_mats_info, 'shards': shards}
+    manifest_file_path = get_manifest_file_path(data_path)
+    with manifest_file_path.open('w') as fid:
+        # the numpy values in the dataset props are saved as plain numbers and lists
+        json.dump(manifest, fid, indent=2, default=lambda x: x.tolist())
+    print(f"Manifest of {len(shards)} shards with {dataset_props['n_scenes']} scenes saved to {manifest_file_path}")
+
+
+def split_to_shards(source_path, data_path, n_shards, n_scenes_per_copy=1024):
+    """Split a dataset with per-scene matrices to n_shards shards of consecutive scenes, and write their manifest"""
+    with Path(source_path, 'info').with_suffix('.pkl').open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    if any('indexed_by' in mat_info for mat_info in dataset_info['saved_mats_info'].values()):
+        raise ValueError('Only a dataset with per-scene matrices can be split (run dedup_maps / pack_maps per shard)')
+    shard_paths = []
+    with h5py.File(Path(source_path, 'data').with_suffix('.h5'), 'r') as h5f:
+        n_scenes = h5f['agents_num'].shape[0]
+        if not 0 < n_shards <= n_scenes:
+            raise ValueError(f'Cannot split {n_scenes} scenes to {n_shards} shards')
+        shard_starts = np.linspace(0, n_scenes, n_shards + 1).astype(np.int64)
+        for i_shard in range(n_shards):
+            i_start, i_stop = int(shard_starts[i_shard]), int(shard_starts[i_shard + 1])
+            shard_path = f'shard_{i_shard:03d}'
+            Path(data_path, shard_path).mkdir(parents=True, exist_ok=True)
+            n_shard_scenes = i_stop - i_start
+            with h5py.File(Path(data_path, shard_path, 'data').with_suffix('.h5'), 'w') as out_h5f:
+                for mat_name in dataset_info['saved_mats_info'].keys():
+                    h5_dataset = h5f[mat_name]
+                    shape = (n_shard_scenes,) + h5_dataset.shape[1:]
+                    # the chunks of the source dataset, but not larger than the shard
+                    chunks = None if h5_dataset.chunks is None else \
+                        (min(h5_dataset.chunks[0], n_shard_scenes),) + h5_dataset.chunks[1:]
+                    out_dataset = out_h5f.create_dataset(mat_name, shape=shape, dtype=h5_dataset.dtype, chunks=chunks,
+                                                         compression=h5_dataset.compression,
+                                                         compression_opts=h5_dataset.compression_opts)
+                    for i_first in range(i_start, i_stop, n_scenes_per_copy):
+                        i_last = min(i_first + n_scenes_per_copy, i_stop)
+                        out_dataset[i_first - i_start:i_last - i_start] = h5_dataset[i_first:i_last]
+            shard_props = dict(dataset_info['dataset_props'], n_scenes=n_shard_scenes)
+            with Path(data_path, shard_path, 'info').with_suffix('.pkl').open('wb') as fid:
+                pickle.dump({'dataset_props': shard_props, 'saved_mats_info': dataset_info['saved_mats_info']}, fid)
+            shard_paths.append(shard_path)
+            print(f'Shard {shard_path}: scenes [{i_start}:{i_stop}]')
+    build_manifest(data_path, shard_paths)
+
+
+#########################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True, help='Path of the sharded dataset dir')
+    parser.add_argument('--shard_paths', type=str, nargs='*', default=[],
+                        help='The shards dataset dirs (relative to data_path), in the order of the global scene indices')
+    parser.add_argument('--split_from', type=str, default='',
+                        help='If given, split this dataset dir (info.pkl + data.h5) to --n_shards shards in data_path')
+    parser.add_argument('--n_shards', type=int, default=8, help='Number of shards to split to')
+    parser.add_argument('--n_scenes_per_copy', type=int, default=1024, help='Number of scenes copied at a time')
+    args = parser.parse_args()
+    if args.split_from:
+        split_to_shards(args.split_from, args.data_path, args.n_shards, args.n_scenes_per_copy)
+    else:
+        build_manifest(args.data_path, args.shard_paths)
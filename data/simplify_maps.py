@@ -0,0 +1,256 @@
+"""Simplify the map polylines of an avsg dataset, to reduce max_points_per_elem (the point budget of every element)
+
+Each map element is either:
+    dp       -- simplified with the Douglas-Peucker algorithm, keeping the points needed for a max deviation of
+                --tolerance [m] from the original polyline
+    resample -- resampled to points with a fixed arc-length spacing of --spacing [m]
+If an element still has more than --max_points points, it is resampled (by arc-length) to --max_points points.
+The closed polygon types (e.g., crosswalks) are simplified as loops through their first point, so the closing edge
+is kept within the tolerance too. Repeated points (zero-length segments) are dropped before resampling.
+The output dataset has max_points_per_elem = the largest number of points of a simplified element,
+map_elems_n_points_orig is updated, and the settings and the max error of each of the two passes are recorded in
+dataset_props['map_simplification']. The compression ratio and the max geometric error (the distance of the original
+points from the simplified polylines) are printed, to help choosing the settings.
+The element bounding boxes (data/add_map_bboxes.py) are not copied, add them again to the output if needed.
+
+* To run:
+$ python -m data.simplify_maps --data_path datasets/avsg_data/sample --out_path datasets/avsg_data/sample_dp --tolerance 0.2
+"""
+import argparse
+import pickle
+from pathlib import Path
+
+import h5py
+import numpy as np
+
+from data.repack_h5 import check_not_encoded
+
+
+#########################################################################################
+
+def get_points_to_segments_dists(points, seg_starts, seg_ends):
+    """ The distance of each point [n x 2] from each segment [m x 2] -> [n x m] """
+    seg_vecs = seg_ends - seg_starts
+    seg_len_sqr = np.maximum(np.square(seg_vecs).sum(axis=-1), 1e-12)
+    rel_points = points[:, np.newaxis, :] - seg_starts[np.newaxis, :, :]
+    t = np.clip((rel_points * seg_vecs[np.newaxis]).sum(axis=-1) / seg_len_sqr, 0., 1.)
+    closest = seg_starts[np.newaxis] + t[..., np.newaxis] * seg_vecs[np.newaxis]
+    return np.sqrt(np.square(points[:, np.newaxis, :] - closest).sum(axis=-1))
+
+
+def get_polyline_error(orig_points, new_points):
+    """ The max distance of the original points from the new polyline """
+    if len(new_points) == 1:
+        return float(np.sqrt(np.square(orig_points - new_points[0]).sum(axis=-1)).max())
+    dists = get_points_to_segments_dists(orig_points, new_points[:-1], new_points[1:])
+    return float(dists.min(axis=1).max())
+
+
+def douglas_peucker(points, tolerance):
+    """ Return the points of the polyline simplified with the Douglas-Peucker algorithm """
+    n_points = len(points)
+    if n_points <= 2:
+        return points
+    is_kept = np.zeros(n_points, dtype=bool)
+    is_kept[[0, -1]] = True
+    ranges = [(0, n_points - 1)]
+    while ranges:
+        i_first, i_last = ranges.pop()
+        if i_last - i_first < 2:
+            continue
+        dists = get_points_to_segments_dists(points[i_first + 1:i_last], points[i_first:i_first + 1],
+                                             points[i_last:i_last + 1])[:, 0]
+        i_max = int(dists.argmax())
+        if dists[i_max] > tolerance:
+            i_split = i_first + 1 + i_max
+            is_kept[i_split] = True
+            ranges += [(i_first, i_split), (i_split, i_last)]
+    return points[is_kept]
+
+
+def drop_repeated_points(points):
+    """ Return the polyline without its zero-length segments (consecutive repeated points) """
+    is_new_point = np.concatenate([[True], np.square(np.diff(points, axis=0)).sum(axis=-1) > 0])
+    return points[is_new_point]
+
+
+def resample_by_arc_length(points, n_out):
+    """ Return n_out points, equally spaced along the polyline """
+    points = drop_repeated_points(points)
+    if len(points) == 1:
+        return np.repeat(points, n_out, axis=0)
+    seg_lens = np.sqrt(np.square(np.diff(points, axis=0)).sum(axis=-1))
+    arc_lens = np.concatenate([[0.], np.cumsum(seg_lens)])
+    targets = np.linspace(0., arc_lens[-1], n_out)
+    return np.stack([np.interp(targets, arc_lens, points[:, i_coord]) for i_coord in range(points.shape[1])], axis=-1)
+
+
+def simplify_polyline(points, mode, tolerance, spacing, max_points, is_closed=False):
+    """
+    Return the simplified points, and if they were resampled to max_points (the second pass)
+    A closed polygon is simplified as a loop that starts and ends at its first point, so the closing edge is kept
+     within the tolerance (the first point is fixed, and the repeated closing point is dropped again at the end).
+    """
+    if len(points) <= 2:
+        return points, False
+    is_loop_added = bool(is_closed and np.any(points[0] != points[-1]))
+    if is_loop_added:
+        points = np.concatenate([points, points[:1]])
+    # the closing point (if added) is not counted in max_points
+    max_points = max_points + is_loop_added
+    if mode == 'dp':
+        new_points = douglas_peucker(points, tolerance)
+    elif mode == 'resample':
+        seg_lens = np.sqrt(np.square(np.diff(points, axis=0)).sum(axis=-1))
+        n_out = max(2, int(np.ceil(seg_lens.sum() / spacing)) + 1)
+        new_points = resample_by_arc_length(points, min(n_out, max_points))
+    else:
+        raise NotImplementedError(f'Unrecognized mode  {mode}')
+    is_capped = len(new_points) > max_points
+    if is_capped:
+        new_points = resample_by_arc_length(new_points, max_points)
+    if is_loop_added:
+        new_points = new_points[:-1]
+    return new_points, is_capped
+
+
+#########################################################################################
+
+def simplify_block(block, mode, tolerance, spacing, max_points, closed_types_inds=()):
+    """
+    Return the simplified polylines of the existing elements of a block of scenes, and the max errors of the
+     elements simplified only by the first pass (dp / resample) and of the elements also resampled to max_points
+     (with their number)
+    """
+    simplified = {}
+    errors = {'first_pass_max_error': 0., 'max_points_pass_max_error': 0., 'max_points_pass_n_elems': 0}
+    for i_scene, i_type, i_elem in zip(*np.nonzero(block['map_elems_exists'])):
+        n_points = int(block['map_elems_n_points_orig'][i_scene, i_type, i_elem])
+        points = block['map_elems_points'][i_scene, i_type, i_elem, :n_points].astype(np.float64)
+        if n_points == 0:
+            continue
+        is_closed = i_type in closed_types_inds
+        new_points, is_capped = simplify_polyline(points, mode, tolerance, spacing, max_points, is_closed)
+        if is_closed and len(new_points) > 1:
+            # the error of the closing edge is included
+            error = get_polyline_error(np.concatenate([points, points[:1]]),
+                                       np.concatenate([new_points, new_points[:1]]))
+        else:
+            error = get_polyline_error(points, new_points)
+        if is_capped:
+            errors['max_points_pass_max_error'] = max(errors['max_points_pass_max_error'], error)
+            errors['max_points_pass_n_elems'] += 1
+        else:
+            errors['first_pass_max_error'] = max(errors['first_pass_max_error'], error)
+        simplified[(i_scene, i_type, i_elem)] = new_points
+    return simplified, errors
+
+
+def simplify_maps(data_path, out_path, mode='dp', tolerance=0.1, spacing=1., max_points=0, n_scenes_per_copy=1024):
+    info_file_path = Path(data_path, 'info').with_suffix('.pkl')
+    with info_file_path.open('rb') as fid:
+        dataset_info = pickle.load(fid)
+    saved_mats_info_orig = dataset_info['saved_mats_info']
+    check_not_encoded(dataset_info)
+    if 'map_elems_points' not in saved_mats_info_orig or 'map_ids' in saved_mats_info_orig:
+        raise ValueError('The maps can be simplified only in a dataset with padded map matrices per scene')
+    out_path = Path(out_path)
+    out_path.mkdir(parents=True, exist_ok=True)
+    with h5py.File(Path(data_path, 'data').with_suffix('.h5'), 'r') as h5f, \
+            h5py.File(Path(out_path, 'data').with_suffix('.h5'), 'w') as out_h5f:
+        map_elems_points = h5f['map_elems_points']
+        n_scenes = map_elems_points.shape[0]
+        max_points_orig = map_elems_points.shape[-2]
+        max_points = max_points if max_points > 0 else max_points_orig
+        polygon_types = list(dataset_info['dataset_props']['polygon_types'])
+        closed_types_inds = [polygon_types.index(poly_type)
+                             for poly_type in dataset_info['dataset_props'].get('closed_polygon_types', [])]
+
+        # simplify all the blocks, and find the number of points of the largest simplified element
+        # (the simplified elements are kept packed, the padded matrix is written once its size is known)
+        max_points_per_elem = 2
+        n_points_before = 0
+        n_points_after = 0
+        errors = {'first_pass_max_error': 0., 'max_points_pass_max_error': 0., 'max_points_pass_n_elems': 0}
+        packed_blocks = []
+        for i_first in range(0, n_scenes, n_scenes_per_copy):
+            i_last = min(i_first + n_scenes_per_copy, n_scenes)
+            block = {mat_name: h5f[mat_name][i_first:i_last]
+                     for mat_name in ['map_elems_points', 'map_elems_exists', 'map_elems_n_points_orig']}
+            simplified, block_errors = simplify_block(block, mode, tolerance, spacing, max_points, closed_types_inds)
+            for name in ['first_pass_max_error', 'max_points_pass_max_error']:
+                errors[name] = max(errors[name], block_errors[name])
+            errors['max_points_pass_n_elems'] += block_errors['max_points_pass_n_elems']
+            block_n_points = np.zeros_like(block['map_elems_n_points_orig'])
+            for (i_scene, i_type, i_elem), new_points in simplified.items():
+                block_n_points[i_scene, i_type, i_elem] = len(new_points)
+                n_points_before += int(block['map_elems_n_points_orig'][i_scene, i_type, i_elem])
+                n_points_after += len(new_points)
+                max_points_per_elem = max(max_points_per_elem, len(new_points))
+            elems_inds = np.array(list(simplified.keys()), dtype=np.int64).reshape(-1, 3)
+            elems_points = np.concatenate([np.zeros((0, map_elems_points.shape[-1]))] + list(simplified.values()))
+            elems_points = elems_points.astype(map_elems_points.dtype)
+            packed_blocks.append((i_first, i_last, block_n_points, elems_inds, elems_points))
+            print(f'Simplified {i_last}/{n_scenes} scenes')
+
+        # write the simplified elements
+        for mat_name, mat_info in saved_mats_info_orig.items():
+            if mat_info['entity'] != 'map_bbox' and mat_name not in ['map_elems_points', 'map_elems_n_points_orig']:
+                h5f.copy(h5f[mat_name], out_h5f, name=mat_name)
+        out_points = out_h5f.create_dataset('map_elems_points',
+                                            shape=map_elems_points.shape[:-2] + (max_points_per_elem,
+                                                                                 map_elems_points.shape[-1]),
+                                            dtype=map_elems_points.dtype)
+        out_n_points = out_h5f.create_dataset('map_elems_n_points_orig', shape=h5f['map_elems_n_points_orig'].shape,
+                                              dtype=h5f['map_elems_n_points_orig'].dtype)
+        for i_first, i_last, block_n_points, elems_inds, elems_points in packed_blocks:
+            block_points = np.zeros((i_last - i_first,) + out_points.shape[1:], dtype=out_points.dtype)
+            elems_n_points = block_n_points[tuple(elems_inds.T)]
+            points_elem = np.repeat(np.arange(len(elems_inds)), elems_n_points)
+            points_slot = np.arange(len(points_elem)) - np.repeat(np.cumsum(elems_n_points) - elems_n_points,
+                                                                  elems_n_points)
+            block_points[elems_inds[points_elem, 0], elems_inds[points_elem, 1], elems_inds[points_elem, 2],
+                         points_slot] = elems_points
+            out_points[i_first:i_last] = block_points
+            out_n_points[i_first:i_last] = block_n_points
+            print(f'Written {i_last}/{n_scenes} scenes')
+    saved_mats_info = {mat_name: mat_info for mat_name, mat_info in saved_mats_info_orig.items()
+                       if mat_info['entity'] != 'map_bbox'}
+    max_error = max(errors['first_pass_max_error'], errors['max_points_pass_max_error'])
+    # the settings and the actual max error of each pass: the first pass (dp with tolerance / resample with spacing),
+    # and the resampling of the elements that still had more than max_points points
+    simplification = {'mode': mode, 'tolerance': tolerance, 'spacing': spacing, 'max_points': max_points,
+                      'max_error': max_error,
+                      'first_pass': {'mode': mode, 'tolerance': tolerance if mode == 'dp' else None,
+                                     'spacing': spacing if mode == 'resample' else None,
+                                     'max_error': errors['first_pass_max_error']},
+                      'max_points_pass': {'max_points': max_points, 'n_elems': errors['max_points_pass_n_elems'],
+                                          'max_error': errors['max_points_pass_max_error']}}
+    dataset_props = dict(dataset_info['dataset_props'], max_points_per_elem=max_points_per_elem,
+                         map_simplification=simplification)
+    with Path(out_path, 'info').with_suffix('.pkl').open('wb') as fid:
+        pickle.dump({'dataset_props': dataset_props, 'saved_mats_info': saved_mats_info}, fid)
+    print(f'Real points: {n_points_before} -> {n_points_after}'
+          f' (compression ratio {n_points_before / max(n_points_after, 1):.2f}),'
+          f' max_points_per_elem: {max_points_orig} -> {max_points_per_elem}'
+          f' (compression ratio of the padded points {max_points_orig / max_points_per_elem:.2f}),'
+          f' max geometric error: {max_error:.3f} m (first pass {errors["first_pass_max_error"]:.3f} m,'
+          f' {errors["max_points_pass_n_elems"]} elements resampled to max_points with'
+          f' {errors["max_points_pass_max_error"]:.3f} m). Dataset saved to {out_path}')
+
+
+#########################################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--data_path', type=str, required=True, help='Path of the source dataset dir (info.pkl + data.h5)')
+    parser.add_argument('--out_path', type=str, required=True, help='Path of the output dataset dir')
+    parser.add_argument('--mode', type=str, default='dp', help=" 'dp' (Douglas-Peucker) | 'resample' ")
+    parser.add_argument('--tolerance', type=float, default=0.1, help='[m] max deviation in the dp mode')
+    parser.add_argument('--spacing', type=float, default=1., help='[m] arc-length spacing in the resample mode')
+    parser.add_argument('--max_points', type=int, default=0,
+                        help='Max points per element (0 - the max_points_per_elem of the source dataset)')
+    parser.add_argument('--n_scenes_per_copy', type=int, default=1024, help='Number of scenes processed at a time')
+    args = parser.parse_args()
+    simplify_maps(args.data_path, args.out_path, args.mode, args.tolerance, args.spacing, args.max_points,
+                  args.n_scenes_per_copy)
@@ -7,14 +7,17 @@
 """
 
 import pickle
+import time
 from pathlib import Path
 
-import h5py
 import numpy as np
 import torch
 
-from data.avsg_transforms import sample_sanity_check
+from data.avsg_transforms import apply_map_poses, sample_sanity_check
 from data.base_dataset import BaseDataset
+from data.feature_schema import FeatureSchema
+from data.h5_handle import H5FileHandle
+from data.scene_batch import SceneBatch, collate_scenes
 
 
 #########################################################################################
@@ -56,15 +59,19 @@ class ToyDataset(BaseDataset):
         parser.add_argument('--num_agents', type=int, default=4, help=' number of agents in a scene')
 
         parser.add_argument('--theta_type', type=str, default='zero', help=' "zero" | "uniform')
+        parser.add_argument('--direct_batches', type=int, default=1,
+                            help='If 1, whole batches are generated directly on the device, without a DataLoader')
 
         return parser
 
     #########################################################################################
-    def __init__(self, opt, data_path):
+    def __init__(self, opt, data_path, consumers=None):
         """Initialize this dataset class.
 
         Parameters:
             opt (Option class) -- stores all the experiment flags; needs to be a subclass of BaseOptions
+            data_path -- not used (the scenes are generated)
+            consumers -- not used (all the fields are generated)
 
         A few things can be done here.
         - save the options (have been done in BaseDataset)
@@ -75,7 +82,8 @@ class ToyDataset(BaseDataset):
         BaseDataset.__init__(self, opt)
         self.map_data_type = opt.map_data_type
         self.data_path = data_path
-        self.device = torch.device('cuda:{}'.format(opt.gpu_ids[0])) if opt.gpu_ids else torch.device('cpu')
+        # the data is prepared on the CPU, the batches are moved to the training device by the BatchPrefetcher
+        self.device = torch.device('cpu')
         info_file_path = Path(data_path, 'info').with_suffix('.pkl')
         with info_file_path.open('rb') as fid:
             dataset_info = pickle.load(fid)
@@ -87,40 +95,27 @@ class ToyDataset(BaseDataset):
         opt.polygon_types = self.dataset_props['polygon_types']
         opt.closed_polygon_types = self.dataset_props['closed_polygon_types']
         opt.agent_feat_vec_dim = len(opt.agent_feat_vec_coord_labels)
+        opt.feature_schema = FeatureSchema(opt, self.dataset_props)
+        self.feature_schema = opt.feature_schema
         self.agent_feat_vec_dim = opt.agent_feat_vec_dim
         self.agent_feat_vec_coord_labels = opt.agent_feat_vec_coord_labels
         self.max_num_agents = opt.max_num_agents
         self.num_agents = opt.num_agents
         self.theta_type = opt.theta_type
+        if self.map_data_type != 'zeros':
+            self.h5_handle = H5FileHandle(Path(data_path, 'data').with_suffix('.h5'))
+        # the same map is used in all the scenes, so it is loaded once
+        self.fixed_map_feat = self.load_fixed_map()
         #########################################################################################
 
-    def __getitem__(self, index):
-        """Return a data point and its metadata information.
-
-        Parameters:
-            index -- a random integer for data indexing
-
-        Returns:
-            a dictionary of data with their names. It usually contains the data itself and its metadata information.
-
-        Step 1: get a random image path: e.g., path = self.image_paths[index]
-        Step 2: load your data from the disk: e.g., image = Image.open(path).convert('RGB').
-        Step 3: convert your data to a PyTorch tensor. You can use helper functions such as self.transform. e.g., data = self.transform(image)
-        Step 4: return a data point as a dictionary.
-        """
-        dataset_props = self.dataset_props
-        saved_mats_info = self.saved_mats_info
-        agents_feat = {}
-        map_feat = {}
-
+    def load_fixed_map(self):
+        """Return the map features dict of a single scene, which is used in all the toy scenes"""
         polygon_types = self.dataset_props['polygon_types']
         max_num_elem = self.dataset_props['max_num_elem']
         max_points_per_elem = self.dataset_props['max_points_per_elem']
         coord_dim = self.dataset_props['coord_dim']
-        max_num_agents = self.max_num_agents
-        num_agents = self.num_agents
         n_polygon_types = len(polygon_types)
-
+        map_feat = {}
         #####  Set map fields ['map_elems_points', 'map_elems_n_points_orig', 'map_elems_exists']
         if self.map_data_type == 'zeros':
             # Set zero to all map features
@@ -132,41 +127,85 @@ class ToyDataset(BaseDataset):
                                                               dtype=torch.bool, device=self.device)
         else:
             map_scene_idx = int(self.map_data_type)
-            file_path = Path(self.data_path, 'data').with_suffix('.h5')
-            with h5py.File(file_path, 'r') as h5f:
-                for mat_name, mat_info in saved_mats_info.items():
-                    mat_sample = np.array(h5f[mat_name][map_scene_idx])
-                    mat_sample = torch.from_numpy(mat_sample).to(device=self.device)
-                    if mat_info['entity'] == 'map':
-                        map_feat[mat_name] = mat_sample
-
-        ##### Set agents_feat fields ['agents_feat_vecs', 'agents_num', 'agents_exists']
+            has_map_table = 'map_ids' in self.saved_mats_info
+            map_index = int(self.h5_handle.read('map_ids', map_scene_idx)) if has_map_table else map_scene_idx
+            for mat_name, mat_info in self.saved_mats_info.items():
+                if mat_info['entity'] == 'map':
+                    mat_sample = np.array(self.h5_handle.read(mat_name, map_index))
+                    map_feat[mat_name] = torch.from_numpy(mat_sample).to(device=self.device)
+            if has_map_table:
+                map_pose = torch.from_numpy(np.array(self.h5_handle.read('map_poses', map_scene_idx)))
+                map_feat['map_elems_points'] = apply_map_poses(map_feat['map_elems_points'], map_pose)
+            # the data file is not needed anymore
+            self.h5_handle.close()
+        # all the scenes have the same map (so the map encoder can encode it once per batch)
+        map_feat['map_ids'] = torch.zeros((), dtype=torch.int64, device=self.device)
+        map_feat['map_poses'] = torch.zeros(3, dtype=torch.float32, device=self.device)
+        return map_feat
+
+    #########################################################################################
+
+    def generate_agents(self, batch_size, device):
+        """Generate the agents of batch_size toy scenes, with a few tensor ops.
+
+        Returns:
+            agents_feat_vecs -- [batch_size x max_num_agents x agent_feat_vec_dim]
+            agents_exists -- [batch_size x max_num_agents]
+            agents_num -- [batch_size]
+        """
+        max_num_agents = self.max_num_agents
+        num_agents = self.num_agents
         x_range = (-20, 20)
         y_range = (-20, 20)
-        agents_feat_vecs = torch.zeros((max_num_agents, self.agent_feat_vec_dim), dtype=torch.float32,
-                                       device=self.device)
-
-        coord_labels = self.agent_feat_vec_coord_labels
-        agents_feat_vecs[:num_agents, coord_labels.index('centroid_x')] \
-            = x_range[0] + (x_range[1] - x_range[0]) * torch.rand(num_agents, dtype=torch.float32, device=self.device)
-        agents_feat_vecs[:num_agents, coord_labels.index('centroid_y')] \
-            = y_range[0] + (y_range[1] - y_range[0]) * torch.rand(num_agents, dtype=torch.float32, device=self.device)
+        agents_feat_vecs = torch.zeros((batch_size, max_num_agents, self.agent_feat_vec_dim), dtype=torch.float32,
+                                       device=device)
+        schema = self.feature_schema
+        # uniform centroids, in the ranges x_range and y_range
+        range_min = torch.tensor([x_range[0], y_range[0]], dtype=torch.float32, device=device)
+        range_len = torch.tensor([x_range[1] - x_range[0], y_range[1] - y_range[0]], dtype=torch.float32, device=device)
+        centroids = range_min + range_len * torch.rand((batch_size, num_agents, 2), dtype=torch.float32, device=device)
+        agents_feat_vecs[:, :num_agents, [schema.i_centroid_x, schema.i_centroid_y]] = centroids
 
         if self.theta_type == 'uniform':
-            thetas = 2 * torch.pi * torch.rand(num_agents, dtype=torch.float32, device=self.device)  # uniform angle
+            thetas = 2 * torch.pi * torch.rand((batch_size, num_agents), dtype=torch.float32, device=device)
+            agents_feat_vecs[:, :num_agents, schema.i_yaw_cos] = torch.cos(thetas)
+            agents_feat_vecs[:, :num_agents, schema.i_yaw_sin] = torch.sin(thetas)
         elif self.theta_type == 'zero':
-            thetas = torch.zeros(num_agents, dtype=torch.float32, device=self.device)  # zero angle
+            # zero angle
+            agents_feat_vecs[:, :num_agents, schema.i_yaw_cos] = 1.
         else:
             raise NotImplementedError
-        agents_feat_vecs[:num_agents, coord_labels.index('yaw_cos')] = torch.cos(thetas)
-        agents_feat_vecs[:num_agents, coord_labels.index('yaw_sin')] = torch.sin(thetas)
 
-        agents_feat_vecs[:num_agents, coord_labels.index('speed')] = torch.ones(num_agents, dtype=torch.float32,
-                                                                                device=self.device)
+        if schema.i_speed is not None:
+            agents_feat_vecs[:, :num_agents, schema.i_speed] = 1.
+        if schema.has_extent:
+            agents_feat_vecs[:, :num_agents, schema.i_extent_length] = self.opt.default_agent_extent_length
+            agents_feat_vecs[:, :num_agents, schema.i_extent_width] = self.opt.default_agent_extent_width
+
+        agents_exists = torch.zeros((batch_size, max_num_agents), dtype=torch.bool, device=device)
+        agents_exists[:, :num_agents] = 1
+        agents_num = agents_exists.sum(dim=1)
+        return agents_feat_vecs, agents_exists, agents_num
 
-        agents_exists = torch.zeros(max_num_agents, dtype=torch.bool, device=self.device)
-        agents_exists[:num_agents] = 1
-        agents_num = agents_exists.sum()
+    #########################################################################################
+
+    def __getitem__(self, index):
+        """Return a data point and its metadata information.
+
+        Parameters:
+            index -- a random integer for data indexing
+
+        Returns:
+            a dictionary of data with their names. It usually contains the data itself and its metadata information.
+
+        Step 1: get a random image path: e.g., path = self.image_paths[index]
+        Step 2: load your data from the disk: e.g., image = Image.open(path).convert('RGB').
+        Step 3: convert your data to a PyTorch tensor. You can use helper functions such as self.transform. e.g., data = self.transform(image)
+        Step 4: return a data point as a dictionary.
+        """
+        agents_feat_vecs, agents_exists, agents_num = self.generate_agents(batch_size=1, device=self.device)
+        agents_feat_vecs, agents_exists, agents_num = agents_feat_vecs[0], agents_exists[0], agents_num[0]
+        map_feat = dict(self.fixed_map_feat)
 
         conditioning = {'map_feat': map_feat, 'n_agents_in_scene': agents_num, 'agents_exists': agents_exists}
         sample = {'conditioning': conditioning, 'agents_feat_vecs': agents_feat_vecs}
@@ -176,8 +215,71 @@ class ToyDataset(BaseDataset):
 
     ########################################################################################
 
+    def collate_fn(self, samples):
+        """Collate the samples from __getitem__ to a SceneBatch"""
+        return collate_scenes(samples)
+
+    ########################################################################################
+
+    def get_batch_source(self, batch_size, device):
+        """Return an endless source of whole batches, generated on the device (replaces the DataLoader)"""
+        return ToyBatchSource(self, batch_size, device)
+
+    ########################################################################################
+
     def __len__(self):
         """Return the total number of scenes."""
         return self.n_scenes
 
+    ########################################################################################
+
+    def get_io_stats(self, reset=False):
+        """Return the number of data file opens and reads (summed over all workers) since the last reset."""
+        if self.map_data_type == 'zeros':
+            return {'n_opens': 0, 'n_reads': 0}
+        return self.h5_handle.get_io_stats(reset)
+
+#########################################################################################
+
+
+class ToyBatchSource(object):
+    """
+    An endless iterator over toy batches, that are generated directly on the device (no DataLoader, no collate).
+    The fixed map is copied to the device once, and is broadcast to the batch as an expanded view (no copy).
+    It has the same interface as BatchPrefetcher, so it can be used in the training loop instead.
+    """
+
+    def __init__(self, dataset_obj, batch_size, device):
+        self.dataset_obj = dataset_obj
+        self.batch_size = batch_size
+        self.device = device
+        self.map_feat = {mat_name: mat.to(device) for mat_name, mat in dataset_obj.fixed_map_feat.items()}
+        self.wait_time = 0.
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start_time = time.time()
+        batch_size = self.batch_size
+        agents_feat_vecs, agents_exists, agents_num = self.dataset_obj.generate_agents(batch_size, self.device)
+        map_feat = {mat_name: mat.expand((batch_size,) + mat.shape) for mat_name, mat in self.map_feat.items()}
+        batch = SceneBatch(map_feat=map_feat, n_agents_in_scene=agents_num, agents_exists=agents_exists,
+                           agents_feat_vecs=agents_feat_vecs)
+        self.wait_time += time.time() - start_time
+        return batch
+
+    def pop_wait_time(self):
+        """ Returns the total time [sec] spent generating batches since the last call, and resets it """
+        wait_time = self.wait_time
+        self.wait_time = 0.
+        return wait_time
+
+    def fetch_lazy_fields(self, batch):
+        # all the fields are generated
+        return batch
+
+    def close(self):
+        pass
+
 #########################################################################################
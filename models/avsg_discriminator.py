@@ -2,7 +2,7 @@ import torch
 from torch import nn as nn
 from torch.nn.functional import elu
 
-from models.avsg_func import get_extra_D_inputs
+from models.avsg_func import get_extra_D_inputs, segs_names
 from models.avsg_map_encoder import MapEncoder
 from models.sub_modules import PointNet, MLP
 from util.helper_func import init_net, set_spectral_norm_normalization
@@ -54,21 +54,6 @@ def define_D(opt, gpu_ids=None):
     return net
 
 
-##############################################################################
-def get_saved_address(i_agent1, i_agent2, seg1_name, seg2_name, collisions_indicators):
-    # we saved each agent pair one time in a sorted order, in the function 'get_collisions_indicators'
-    if i_agent1 == i_agent2:
-        return None, False
-    if i_agent1 > i_agent2:
-        i_agent1_s, i_agent2_s = i_agent2, i_agent1
-        seg1_name_s, seg2_name_s = seg2_name, seg1_name
-    else:
-        i_agent1_s, i_agent2_s = i_agent1, i_agent2
-        seg1_name_s, seg2_name_s = seg1_name, seg2_name
-    address = (i_agent1_s, i_agent2_s, seg1_name_s, seg2_name_s)
-    is_val_address = address in collisions_indicators.keys()
-    return address, is_val_address
-
 ##############################################################################
 
 
@@ -78,13 +63,16 @@ class CollisionsEncoder(nn.Module):
     out_of_road_indicator &  collisions_indicators  for 'front', 'back', 'left', 'right' (5 features  total)
     The collision indicator at each segment at each i_agent is calculated by
     taking as input the s1,s2 with all agents paired with  i_agent and passing through a PointNet
+    (one PointNet per segment of i_agent, applied to the set of the other agents for each segment of the other agents).
+    The invalid pairs are masked out of the sets, so a set with no valid pairs gives a fixed output.
+    With a broad phase (the packed candidate pairs of get_pairs_collisions_indicators), the sets are built packed from
+    the valid elements of the pairs, and the culled pairs are not in the sets (as if their lines don't cross).
     """
     def __init__(self, opt):
         super(CollisionsEncoder, self).__init__()
         self.device = opt.device
-        self.max_num_agents = opt.max_num_agents
-        self.segs_names = ['front', 'back', 'left', 'right']
-        self.collisions_enc = dict()
+        self.segs_names = list(segs_names)
+        self.collisions_enc = nn.ModuleDict()
         for seg_name in self.segs_names:
             self.collisions_enc[seg_name] = PointNet(d_in=2, d_out=1,
                                                      d_hid=32, n_layers=3, opt=opt)
@@ -92,32 +80,58 @@ class CollisionsEncoder(nn.Module):
     ##############################################################################
 
     def forward(self, collisions_indicators):
-        max_n_agents = self.max_num_agents
-        segs_names = self.segs_names
-        batch_size = collisions_indicators['batch_size']
-        n_segs = len(segs_names)
-        # enc_out = torch.zeros((batch_size, max_n_agents, n_segs**2), device=self.device)
-        aggregator_in = torch.zeros((batch_size, max_n_agents, n_segs**2, max_n_agents, 2), device=self.device)
-        aggregator_in_valid = torch.zeros((batch_size, max_n_agents, n_segs**2, max_n_agents), dtype=torch.bool, device=self.device)
-        for i_agent1 in range(max_n_agents):
-            for i_seg1, seg1_name in enumerate(segs_names):
-                # incoming = the s1 and s2 of all agent2 and seg2
-                for i_agent2 in range(max_n_agents):
-                    for i_seg2, seg2_name in enumerate(segs_names):
-                        address, is_val_address = get_saved_address(i_agent1, i_agent2, seg1_name, seg2_name, collisions_indicators)
-                        if not is_val_address:
-                            continue
-                        s1, s2, valids = collisions_indicators[address]
-                        if valids.sum() == 0:
-                            continue
-                        aggregator_in_valid[:, i_agent1, (i_seg1 * n_segs + i_seg2), i_agent2] = valids
-                        aggregator_in[:, i_agent1,  (i_seg1 * n_segs + i_seg2), i_agent2, 0] = s1
-                        aggregator_in[:, i_agent1,  (i_seg1 * n_segs + i_seg2), i_agent2, 1] = s2
-                        # enc_out[valids, i_agent1, (i_seg1 * n_segs + i_seg2)] +=\
-                        #     (1 + elu(1 - s1[valids].abs())) * (1 + elu(1 - s2[valids].abs()))
-
-        enc_out = self.aggregator(aggregator_in, aggregator_in_valid)
-        return enc_out
+        """
+        collisions_indicators -- the dict of get_collisions_indicators ([batch_size x N x N x 4 x 4] tensors)
+        Returns [batch_size x N x 16] - the encoding of each (segment of the agent, segment of the other agents)
+        """
+        if 'pairs_scene' in collisions_indicators:
+            return self.forward_pairs(collisions_indicators)
+        valids = collisions_indicators['valids']
+        batch_size, max_n_agents, _, n_segs, _ = valids.shape
+        # [batch_size x agent1 x seg1 x seg2 x agent2 (x 2)]
+        enc_in = torch.stack([collisions_indicators['s1'], collisions_indicators['s2']], dim=-1).permute(0, 1, 3, 4, 2, 5)
+        enc_in_valid = valids.permute(0, 1, 3, 4, 2)
+        enc_out = []
+        for i_seg1, seg1_name in enumerate(self.segs_names):
+            # the sets of (s1, s2) of all the other agents, for each agent1 and seg2
+            seg_in = enc_in[:, :, i_seg1].reshape(batch_size * max_n_agents * n_segs, max_n_agents, 2)
+            seg_in_valid = enc_in_valid[:, :, i_seg1].reshape(batch_size * max_n_agents * n_segs, max_n_agents)
+            seg_out = self.collisions_enc[seg1_name](seg_in, seg_in_valid)
+            enc_out.append(seg_out.view(batch_size, max_n_agents, n_segs))
+        # [batch_size x max_n_agents x (seg1 * n_segs + seg2)]
+        return torch.stack(enc_out, dim=2).view(batch_size, max_n_agents, n_segs ** 2)
+
+    def forward_pairs(self, collisions_indicators):
+        """
+        The same as forward, for the packed indicators of the pairs of existing agents ([n_pairs x 4 x 4] tensors)
+        """
+        batch_size, max_n_agents = collisions_indicators['batch_size'], collisions_indicators['max_n_agents']
+        s1, s2, valids = collisions_indicators['s1'], collisions_indicators['s2'], collisions_indicators['valids']
+        n_pairs, n_segs = valids.shape[:2]
+        device = valids.device
+        segs_inds = torch.arange(n_segs, device=device)
+        pair_seg1 = segs_inds[None, :, None].expand(n_pairs, n_segs, n_segs)
+        pair_seg2 = segs_inds[None, None, :].expand(n_pairs, n_segs, n_segs)
+        pair_scene = collisions_indicators['pairs_scene'][:, None, None].expand(n_pairs, n_segs, n_segs)
+        pair_i = collisions_indicators['pairs_i'][:, None, None].expand(n_pairs, n_segs, n_segs)
+        pair_j = collisions_indicators['pairs_j'][:, None, None].expand(n_pairs, n_segs, n_segs)
+        # each pair gives an element to the sets of both its agents:
+        # (i, seg1=a, seg2=b) <- (s1, s2)  and  (j, seg1=b, seg2=a) <- (s2, s1)
+        elems_val = torch.cat([torch.stack([s1, s2], dim=-1)[valids], torch.stack([s2, s1], dim=-1)[valids]])
+        elems_scene = torch.cat([pair_scene[valids], pair_scene[valids]])
+        elems_agent1 = torch.cat([pair_i[valids], pair_j[valids]])
+        elems_seg1 = torch.cat([pair_seg1[valids], pair_seg2[valids]])
+        elems_seg2 = torch.cat([pair_seg2[valids], pair_seg1[valids]])
+        # the set index of each element, in the order of [batch_size x agent1 x seg2]
+        elems_set = (elems_scene * max_n_agents + elems_agent1) * n_segs + elems_seg2
+        n_sets = batch_size * max_n_agents * n_segs
+        enc_out = []
+        for i_seg1, seg1_name in enumerate(self.segs_names):
+            is_seg1 = elems_seg1 == i_seg1
+            seg_out = self.collisions_enc[seg1_name].forward_packed(elems_val[is_seg1], elems_set[is_seg1], n_sets)
+            enc_out.append(seg_out.view(batch_size, max_n_agents, n_segs))
+        # [batch_size x max_n_agents x (seg1 * n_segs + seg2)]
+        return torch.stack(enc_out, dim=2).view(batch_size, max_n_agents, n_segs ** 2)
     ##############################################################################
 
 
@@ -131,7 +145,7 @@ class SceneDiscriminator(nn.Module):
         self.batch_size = opt.batch_size
         self.max_num_agents = opt.max_num_agents
         self.agent_feat_vec_coord_labels = opt.agent_feat_vec_coord_labels
-        self.segs_names = ['front', 'back', 'left', 'right']
+        self.segs_names = list(segs_names)
         self.n_segs = len(self.segs_names)
         self.extra_agent_feat = self.n_segs ** 2 + 1  # we add a feature of each collision type (e.g. front-left) and +1 for out_of_road
         self.dim_agent_feat_vec_orig = len(opt.agent_feat_vec_coord_labels)
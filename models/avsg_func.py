@@ -15,30 +15,27 @@ class ProjectionToAgentFeat(object):
     def __init__(self, opt, device):
         self.device = device
         self.max_num_agents = opt.max_num_agents
-        self.agent_feat_vec_coord_labels = opt.agent_feat_vec_coord_labels
-        self.dim_agent_feat_vec = len(opt.agent_feat_vec_coord_labels)
-        # code now supports only this feature format:
-        assert self.agent_feat_vec_coord_labels == [
-            'centroid_x',  # [0]  Real number
-            'centroid_y',  # [1]  Real number
-            'yaw_cos',  # [2]  in range [-1,1],  sin(yaw)^2 + cos(yaw)^2 = 1
-            'yaw_sin',  # [3]  in range [-1,1],  sin(yaw)^2 + cos(yaw)^2 = 1
-            'speed',  # [4] Real non-negative
-        ]
+        self.feature_schema = opt.feature_schema
+        self.dim_agent_feat_vec = opt.feature_schema.agent_feat_vec_dim
 
     def __call__(self, agents_vecs, n_agents_per_scene, agents_exists):
         '''
         agents_vecs [batch_size x max_num_agents x dim_agent_feat_vec)]
-        # Coordinates 0,1 are centroid x,y - no need to project
-        # Coordinates 2,3 are yaw_cos, yaw_sin - project to unit circle by normalizing to L norm ==1
-        # Coordinate 4 is speed project to positive numbers
+        # The centroid x,y coordinates - no need to project
+        # The yaw_cos, yaw_sin coordinates - project to unit circle by normalizing to L norm ==1
+        # The speed (and extent) coordinates - project to positive numbers
         '''
         eps = 1e-12
-        agents_vecs = torch.cat([
-            agents_vecs[:, :, :2],
-            agents_vecs[:, :, 2:4] / (LA.vector_norm(agents_vecs[:, :, 2:4], ord=2, dim=2, keepdims=True) + eps),
-            torch.abs(agents_vecs[:, :, 4].unsqueeze(-1))  # should we use F.softplus ?
-        ], dim=2)
+        yaw_vec_inds = self.feature_schema.yaw_vec_inds
+        non_negative_inds = self.feature_schema.non_negative_inds
+        # the projections are computed from the input (which is not modified in-place, as autograd needs it)
+        yaw_vecs = agents_vecs[:, :, yaw_vec_inds]
+        projected_vecs = agents_vecs.clone()
+        projected_vecs[:, :, yaw_vec_inds] = yaw_vecs / (LA.vector_norm(yaw_vecs, ord=2, dim=2, keepdims=True) + eps)
+        if non_negative_inds is not None:
+            # should we use F.softplus ?
+            projected_vecs[:, :, non_negative_inds] = torch.abs(agents_vecs[:, :, non_negative_inds])
+        agents_vecs = projected_vecs
         # Set zero at non existent agents
         agents_vecs[agents_exists.logical_not()] = 0.
         return agents_vecs
@@ -58,12 +55,10 @@ def get_out_of_road_indicators(conditioning, agents, opt):
     '''
        # out_of_road_indicators [scene_id x agent_idx] = the distance for which the agent centroid is out-of-road
     '''
-    polygon_types = opt.polygon_types
-    i_centroid_x = opt.agent_feat_vec_coord_labels.index('centroid_x')
-    i_centroid_y = opt.agent_feat_vec_coord_labels.index('centroid_y')
-    i_lanes_mid = polygon_types.index('lanes_mid')
-    i_lanes_left = polygon_types.index('lanes_left')
-    i_lanes_right = polygon_types.index('lanes_right')
+    schema = opt.feature_schema
+    i_lanes_mid = schema.i_lanes_mid
+    i_lanes_left = schema.i_lanes_left
+    i_lanes_right = schema.i_lanes_right
     map_feat = conditioning['map_feat']
     map_elems_points = map_feat['map_elems_points']
     map_elems_exists = map_feat['map_elems_exists']
@@ -75,7 +70,7 @@ def get_out_of_road_indicators(conditioning, agents, opt):
     lanes_mid_points = map_elems_points[:, i_lanes_mid]
 
     # Get agents centroids
-    agents_centroids = agents[:, :, [i_centroid_x, i_centroid_y]]
+    agents_centroids = agents[:, :, schema.centroid_inds]
 
     #   Now we transform the tensors to be with a common dimensions of
     #   [batch_size, max_n_agents, max_num_elem, max_points_per_elem, coord_dim]
@@ -168,17 +163,22 @@ def get_distance_to_closest_lane_points(lanes_points, lanes_points_exists, refer
 ###############################################################################
 
 
-def get_collisions_indicators(conditioning, agents, opt):
-    batch_size, max_n_agents, n_feat = agents.shape
-    i_centroid_x = opt.agent_feat_vec_coord_labels.index('centroid_x')
-    i_centroid_y = opt.agent_feat_vec_coord_labels.index('centroid_y')
-    i_yaw_cos = opt.agent_feat_vec_coord_labels.index('yaw_cos')
-    i_yaw_sin = opt.agent_feat_vec_coord_labels.index('yaw_sin')
-    extent_length = opt.default_agent_extent_length
-    extent_width = opt.default_agent_extent_width
-    agents_exists = conditioning['agents_exists']
-    centroids = agents[:, :, [i_centroid_x, i_centroid_y]]
-    front_direction = agents[:, :, [i_yaw_cos, i_yaw_sin]]
+# the sides of an agent's bounding box, in the order of the sides dimensions of the collisions indicators
+segs_names = ('front', 'back', 'left', 'right')
+
+
+def get_agents_segments(agents, opt):
+    """
+    The sides of the agents bounding boxes, as line segments:
+    segs_mids [batch_size x max_n_agents x 4 x 2] the middle of each side (in the order of segs_names)
+    segs_vecs [batch_size x max_n_agents x 4 x 2] a vector from the middle of each side to one of its ends
+    """
+    schema = opt.feature_schema
+    extents = schema.get_extents(agents, opt)
+    extent_length = extents[:, :, 0:1]
+    extent_width = extents[:, :, 1:2]
+    centroids = agents[:, :, schema.centroid_inds]
+    front_direction = agents[:, :, schema.yaw_vec_inds]
     front_vec = front_direction * extent_length * 0.5
     rot_mat = torch.tensor(([0, -1.], [1., 0])).to(
         opt.device)  # explanation: the original direction vec is (cos(a), sin(a)) we want to rotate by +90 degrees,
@@ -186,61 +186,163 @@ def get_collisions_indicators(conditioning, agents, opt):
     left_vec = front_direction @ rot_mat * extent_width * 0.5
 
     # find the  middle of each of the 4 segments (sides of the car)
-    segs_mids = {'front': centroids + front_vec, 'back': centroids - front_vec,
-                 'left': centroids + left_vec, 'right': centroids - left_vec}
-
+    segs_mids = torch.stack([centroids + front_vec, centroids - front_vec,
+                             centroids + left_vec, centroids - left_vec], dim=2)
     # find a vector that goes from the center of each segment to one of its edges (doesn't matter which of the two)
-    segs_vecs = {'front': + left_vec, 'back': - left_vec,
-                 'left': - front_vec, 'right': + front_vec}
-
-    collisions_indicators = {}
-    for i_agent1 in range(max_n_agents - 1):
-        for i_agent2 in range(i_agent1 + 1, max_n_agents):
-            # find valid scenes = both agents IDs exists,
-            valids = agents_exists[:, i_agent1] * agents_exists[:, i_agent2]
-            if valids.sum() == 0:
-                continue
-            for seg1_name, seg1_vecs in segs_vecs.items():
-                for seg2_name, seg2_vecs in segs_vecs.items():
-                    # get the segments middle points and direction vectors (normalized to be 0.5 * segment_length)
-                    L1_p = segs_mids[seg1_name][:, i_agent1, :]
-                    L2_p = segs_mids[seg2_name][:, i_agent2, :]
-                    L1_v = seg1_vecs[:, i_agent1, :]
-                    L2_v = seg2_vecs[:, i_agent2, :]
-
-                    # find the deviation of the intersection point from the middle of the segment
-                    # See: https://math.stackexchange.com/a/406895
-                    # our problem to solve in a matrix form:  A f = d
-                    # where
-                    # A = [[L1_v_x, -L2_v_x], [L1_v_y, -L2_v_y]]
-                    # s = [s1, s2]
-                    # d = [L2_p_x - L1_p_x, L2_p_y - L1_p_y] = [dx, dy]
-
-                    # determinant(A)  = (L1_v_x) * (-L2_v_y) - (-L2_v_x) * (L1_v_y)
-                    # = (L2_v_x) * (L1_v_y) -(L1_v_x) * (L2_v_y)
-                    determinant = L2_v[:, 0] * L1_v[:, 1] - L1_v[:, 0] * L2_v[:, 1]
-                    epsilon = 1e-6
-
-                    # find valid scenes = where there is a cross of the two infinite lines
-                    # (might not be inside the segments)
-                    is_cross = determinant.abs() > epsilon
-                    if is_cross.sum() == 0:
-                        continue
-                    valids = valids * is_cross
-
-                    # A^{-1} = (1/determinant) * [[ -L2_v_y, L2_v_x], [-L1_v_y, L1_v_x]]
-                    # s = A^{-1} d
-                    # s1 = (1/determinant) * (-L2_v_y * dx + L2_v_x * dy) = (L2_v_x * dy - L2_v_y * dx) / determinant
-                    # s2 = (1/determinant) * (-L1_v_y * dx + L1_v_x * dy) = (L1_v_x * dy - L1_v_y * dx) / determinant
-                    d = L2_p - L1_p
-                    s1 = torch.zeros(batch_size, device=opt.device)
-                    s2 = torch.zeros(batch_size, device=opt.device)
-                    s1[valids] = (L2_v[valids, 0] * d[valids, 1] - L2_v[valids, 1] * d[valids, 0]) / determinant[valids]
-                    s2[valids] = (L1_v[valids, 0] * d[valids, 1] - L1_v[valids, 1] * d[valids, 0]) / determinant[valids]
-
-                    collisions_indicators[(i_agent1, i_agent2, seg1_name, seg2_name)] = (s1, s2, valids)
-    collisions_indicators['batch_size'] = batch_size
-    return collisions_indicators
+    segs_vecs = torch.stack([left_vec, -left_vec, -front_vec, front_vec], dim=2)
+    return segs_mids, segs_vecs
+
+
+def get_segments_intersections(L1_p, L1_v, L2_p, L2_v):
+    """
+    The intersections of the lines of pairs of segments (broadcastable [... x 2] middle points L_p and half-vectors L_v)
+    Returns s1, s2 - the deviations of the intersection point from the middle of each segment (|s| <= 1 inside it),
+     and is_cross - if the lines cross (s1 = s2 = 0 where not)
+    """
+    # find the deviation of the intersection point from the middle of the segment
+    # See: https://math.stackexchange.com/a/406895
+    # our problem to solve in a matrix form:  A f = d
+    # where
+    # A = [[L1_v_x, -L2_v_x], [L1_v_y, -L2_v_y]]
+    # s = [s1, s2]
+    # d = [L2_p_x - L1_p_x, L2_p_y - L1_p_y] = [dx, dy]
+
+    # determinant(A)  = (L1_v_x) * (-L2_v_y) - (-L2_v_x) * (L1_v_y)
+    # = (L2_v_x) * (L1_v_y) -(L1_v_x) * (L2_v_y)
+    determinant = L2_v[..., 0] * L1_v[..., 1] - L1_v[..., 0] * L2_v[..., 1]
+    epsilon = 1e-6
+
+    # find where there is a cross of the two infinite lines (might not be inside the segments)
+    is_cross = determinant.abs() > epsilon
+
+    # A^{-1} = (1/determinant) * [[ -L2_v_y, L2_v_x], [-L1_v_y, L1_v_x]]
+    # s = A^{-1} d
+    # s1 = (1/determinant) * (-L2_v_y * dx + L2_v_x * dy) = (L2_v_x * dy - L2_v_y * dx) / determinant
+    # s2 = (1/determinant) * (-L1_v_y * dx + L1_v_x * dy) = (L1_v_x * dy - L1_v_y * dx) / determinant
+    d = L2_p - L1_p
+    # the parallel lines are divided by 1 (and then zeroed), so they have no inf / nan gradients
+    determinant = torch.where(is_cross, determinant, torch.ones_like(determinant))
+    s1 = torch.where(is_cross, (L2_v[..., 0] * d[..., 1] - L2_v[..., 1] * d[..., 0]) / determinant, 0.)
+    s2 = torch.where(is_cross, (L1_v[..., 0] * d[..., 1] - L1_v[..., 1] * d[..., 0]) / determinant, 0.)
+    return s1, s2, is_cross
+
+
+def get_collisions_indicators(conditioning, agents, opt):
+    """
+    The intersections of the sides of all the pairs of agents, computed at once for the whole batch.
+    Returns a dict of:
+        s1 [batch_size x max_n_agents x max_n_agents x 4 x 4] - at [:, i, j, a, b]: the deviation of the intersection
+         point of the lines of side a of agent i and side b of agent j from the middle of side a (|s1| <= 1 inside it)
+        s2 [batch_size x max_n_agents x max_n_agents x 4 x 4] - the same, from the middle of side b of agent j
+        valids [batch_size x max_n_agents x max_n_agents x 4 x 4] - both agents exist, i != j, and the lines cross
+         (s1 = s2 = 0 where not valid)
+    The sides are in the order of segs_names. Each pair appears twice, as (i, j, a, b) and as (j, i, b, a).
+    With a broad phase (opt.collisions_broad_phase), the indicators are packed per candidate pair of agents
+     (see get_pairs_collisions_indicators).
+    """
+    broad_phase = getattr(opt, 'collisions_broad_phase', 'none')
+    if broad_phase != 'none':
+        return get_pairs_collisions_indicators(conditioning, agents, opt, broad_phase)
+    max_n_agents = agents.shape[1]
+    agents_exists = conditioning['agents_exists'].bool()
+    segs_mids, segs_vecs = get_agents_segments(agents, opt)
+
+    # get the segments middle points and direction vectors (normalized to be 0.5 * segment_length),
+    # broadcast to [batch_size x agent1 x agent2 x seg1 x seg2 (x 2)]
+    s1, s2, is_cross = get_segments_intersections(segs_mids[:, :, None, :, None, :], segs_vecs[:, :, None, :, None, :],
+                                                  segs_mids[:, None, :, None, :, :], segs_vecs[:, None, :, None, :, :])
+    # valid pairs = both agents exist, and there is a cross of the two infinite lines
+    is_other_agent = torch.logical_not(torch.eye(max_n_agents, dtype=torch.bool, device=agents.device))
+    pairs_exists = agents_exists[:, :, None] & agents_exists[:, None, :] & is_other_agent
+    valids = pairs_exists[:, :, :, None, None] & is_cross
+    return {'s1': s1 * valids, 's2': s2 * valids, 'valids': valids}
+
+
+###############################################################################
+
+def get_agents_bounding_radii(agents, opt):
+    """ The radius of the bounding circle of each agent [batch_size x max_n_agents] """
+    extents = opt.feature_schema.get_extents(agents, opt)
+    return 0.5 * extents.square().sum(dim=-1).sqrt()
+
+
+def get_candidate_pairs(agents, agents_exists, opt, broad_phase):
+    """
+    The broad phase of the collision checks: the pairs of existing agents (i < j) whose bounding circles, enlarged by
+    opt.collisions_broad_phase_margin, overlap. The sides of the other pairs cannot intersect.
+    broad_phase - 'circles': test all the pairs (a cheap test of the centroids distances)
+                  'grid': test only the pairs in the same or neighboring cells of a uniform grid over the centroids,
+                   so the work scales with the number of nearby pairs
+    Returns the scene, agent i and agent j indices of the candidate pairs [n_pairs] each
+    """
+    margin = opt.collisions_broad_phase_margin
+    centroids = agents[:, :, opt.feature_schema.centroid_inds].detach()
+    radii = get_agents_bounding_radii(agents, opt).detach()
+    if broad_phase == 'circles':
+        max_n_agents = agents.shape[1]
+        dists_sqr = (centroids[:, :, None, :] - centroids[:, None, :, :]).square().sum(dim=-1)
+        is_candidate = dists_sqr <= (radii[:, :, None] + radii[:, None, :] + margin).square()
+        is_first_of_pair = torch.ones((max_n_agents, max_n_agents), dtype=torch.bool, device=agents.device).triu(1)
+        is_candidate = is_candidate & agents_exists[:, :, None] & agents_exists[:, None, :] & is_first_of_pair
+        return torch.nonzero(is_candidate, as_tuple=True)
+    elif broad_phase != 'grid':
+        raise NotImplementedError(f'Unrecognized opt.collisions_broad_phase  {broad_phase}')
+    agents_scene, agents_ind = torch.nonzero(agents_exists, as_tuple=True)
+    points, radii = centroids[agents_scene, agents_ind], radii[agents_scene, agents_ind]
+    if points.shape[0] == 0:
+        return agents_scene, agents_ind, agents_ind
+    # the candidate pairs are at most one cell apart
+    cell_size = 2 * float(radii.max()) + margin
+    cells = torch.floor(points / cell_size).long()
+    cells = cells - cells.min(dim=0).values + 1  # a margin of one cell for the neighbors
+    n_cells_y = int(cells[:, 1].max()) + 2
+    n_cells_x = int(cells[:, 0].max()) + 2
+    agents_key = (agents_scene * n_cells_x + cells[:, 0]) * n_cells_y + cells[:, 1]
+    sorted_keys, order = torch.sort(agents_key)
+    firsts, seconds = [], []
+    for d_x in (-1, 0, 1):
+        for d_y in (-1, 0, 1):
+            neighbor_key = agents_key + d_x * n_cells_y + d_y
+            starts = torch.searchsorted(sorted_keys, neighbor_key)
+            counts = torch.searchsorted(sorted_keys, neighbor_key, right=True) - starts
+            ends = torch.cumsum(counts, dim=0)
+            n_found = int(ends[-1])
+            found = torch.repeat_interleave(starts - (ends - counts), counts, output_size=n_found) \
+                    + torch.arange(n_found, device=starts.device)
+            firsts.append(torch.repeat_interleave(torch.arange(len(agents_key), device=starts.device), counts,
+                                                  output_size=n_found))
+            seconds.append(order[found])
+    firsts, seconds = torch.cat(firsts), torch.cat(seconds)
+    # each pair is found from both of its agents, it is kept once (i < j)
+    is_candidate = agents_ind[firsts] < agents_ind[seconds]
+    is_candidate &= (points[firsts] - points[seconds]).square().sum(dim=-1) \
+                    <= (radii[firsts] + radii[seconds] + margin).square()
+    firsts, seconds = firsts[is_candidate], seconds[is_candidate]
+    return agents_scene[firsts], agents_ind[firsts], agents_ind[seconds]
+
+
+def get_pairs_collisions_indicators(conditioning, agents, opt, broad_phase):
+    """
+    The collisions indicators of the candidate pairs of agents (i < j) of the broad phase (see get_candidate_pairs).
+    Returns a dict of:
+        pairs_scene, pairs_i, pairs_j [n_pairs] - the candidate pairs (i < j)
+        s1, s2, valids [n_pairs x 4 x 4] - as in get_collisions_indicators, for [scene, i, j]
+        batch_size, max_n_agents
+    The other pairs are far apart, and they get the far-pair limit (|s1|, |s2| -> inf): no penalty (see
+     get_collisions_penalty), and no elements in the discriminator collisions sets (like the pairs whose lines don't
+     cross, see CollisionsEncoder).
+    """
+    batch_size, max_n_agents = agents.shape[:2]
+    agents_exists = conditioning['agents_exists'].bool()
+    pairs_scene, pairs_i, pairs_j = get_candidate_pairs(agents, agents_exists, opt, broad_phase)
+    segs_mids, segs_vecs = get_agents_segments(agents, opt)
+    # [n_pairs x seg1 x seg2 (x 2)]
+    s1, s2, valids = get_segments_intersections(segs_mids[pairs_scene, pairs_i][:, :, None, :],
+                                                segs_vecs[pairs_scene, pairs_i][:, :, None, :],
+                                                segs_mids[pairs_scene, pairs_j][:, None, :, :],
+                                                segs_vecs[pairs_scene, pairs_j][:, None, :, :])
+    return {'pairs_scene': pairs_scene, 'pairs_i': pairs_i, 'pairs_j': pairs_j, 's1': s1, 's2': s2, 'valids': valids,
+            'batch_size': batch_size, 'max_n_agents': max_n_agents}
 
 
 ###############################################################################
@@ -248,17 +350,14 @@ def get_collisions_penalty(conditioning, extra_D_inputs, opt):
     agents_exists = conditioning['agents_exists']
     batch_size,  max_n_agents = agents_exists.shape
     collisions_indicators = extra_D_inputs['collisions_indicators']
-    segs_names = ['front', 'back', 'left', 'right']
-    penalty = torch.tensor(0., device=opt.device)
-    for i_agent1 in range(max_n_agents - 1):
-        for i_agent2 in range(i_agent1 + 1, max_n_agents):
-            for seg1_name in segs_names:
-                for seg2_name in segs_names:
-                    s1, s2, valids = collisions_indicators[(i_agent1, i_agent2, seg1_name, seg2_name)]
-                    if valids.sum() == 0:
-                        continue
-                    curr_penalty = (1 + elu(1 - s1[valids].abs())) * (1 + elu(1 - s2[valids].abs()))
-                    penalty += curr_penalty.sum()
+    s1, s2 = collisions_indicators['s1'], collisions_indicators['s2']
+    valids = collisions_indicators['valids']
+    if 'pairs_scene' not in collisions_indicators:
+        # each agent pair is counted once (i < j), the pairs of a broad phase are already so
+        # (and the pairs that it culled have the far-pair limit of the penalty term, which is zero)
+        is_first_of_pair = torch.ones((max_n_agents, max_n_agents), dtype=torch.bool, device=s1.device).triu(1)
+        valids = valids & is_first_of_pair[None, :, :, None, None]
+    penalty = torch.where(valids, (1 + elu(1 - s1.abs())) * (1 + elu(1 - s2.abs())), 0.).sum()
     # s1,s2 are the distances of the intersections from the middle of the corresponding segments
     # # if the intersection is in both segment (|s1| < 1 and |s2| < 1),
     # # then it is a collision between the cars and a penalty is added
@@ -7,6 +7,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from data.packed_map import PackedMap
 from models.sub_modules import MLP, PointNet
 
 
@@ -66,6 +67,21 @@ class PolygonEncoder(nn.Module):
         h = self.out_layer(h)
         return h
 
+    def forward_packed(self, elems_points):
+        """Forward of the existing elements only (the same as forward for these elements)
+        elems_points  [n_elements x n_points x 2d]
+        Returns the elements latents [n_elements x dim_latent]
+        """
+        # fit to conv1d input dimensions [n_elements x in_channels=2  x n_points]
+        h = torch.permute(elems_points, (0, 2, 1))
+        for i_layer in range(self.n_conv_layers):
+            h = self.conv_layers[i_layer](h)
+            h = F.leaky_relu(h)
+        # Sum all points (to get shift invariance):
+        h = h.sum(dim=-1)  # [n_elements x out_channels]
+        h = self.out_layer(h)
+        return h
+
 
 #########################################################################################
 
@@ -75,10 +91,10 @@ class MapEncoder(nn.Module):
     def __init__(self, opt):
         super(MapEncoder, self).__init__()
         self.device = opt.device
-        self.polygon_types = opt.polygon_types
-        self.closed_polygon_types = opt.closed_polygon_types
+        self.polygon_types = opt.feature_schema.polygon_types
+        self.closed_polygon_types = opt.feature_schema.closed_polygon_types
         self.dim_latent_polygon_elem = opt.dim_latent_polygon_elem
-        self.n_polygon_types = len(opt.polygon_types)
+        self.n_polygon_types = opt.feature_schema.n_polygon_types
         self.dim_latent_polygon_type = opt.dim_latent_polygon_type
         self.dim_latent_map = opt.dim_latent_map
         self.poly_encoder = nn.ModuleDict()
@@ -101,9 +117,37 @@ class MapEncoder(nn.Module):
 
     def forward(self, map_feat):
         """Standard forward
+        If map_feat has 'map_ids' and 'map_poses', scenes with the same map id and pose have the same map,
+        so each unique map is encoded once, and its latent is copied to all the scenes that use it.
+        The latent depends on the frame of the map points (the encoder is not invariant to the map pose), so scenes
+         that use the same map at different poses are encoded separately.
+        The augmentation and the map crop give each scene its own map, so they drop the map ids, and this applies
+         only to batches that are neither augmented nor cropped (--augmentation_type none, without --map_crop_radius).
         """
+        if isinstance(map_feat, PackedMap):
+            return self.encode_packed_maps(map_feat)
         map_elems_exists = map_feat['map_elems_exists']  # True for coordinates of valid poly elements
         map_elems_points = map_feat['map_elems_points']  # coordinates of the polygon elements
+        map_ids = map_feat.get('map_ids')
+        if map_ids is not None:
+            batch_size = map_ids.shape[0]
+            map_keys = torch.cat([map_ids.unsqueeze(-1).to(torch.float64),
+                                  map_feat['map_poses'].to(torch.float64)], dim=-1)
+            unique_keys, inverse = torch.unique(map_keys, dim=0, return_inverse=True)
+            n_unique_maps = unique_keys.shape[0]
+            if n_unique_maps < batch_size:
+                # the index of one of the scenes that use each unique map
+                scene_inds = torch.empty(n_unique_maps, dtype=torch.long, device=inverse.device)
+                scene_inds.scatter_(0, inverse, torch.arange(batch_size, device=inverse.device))
+                map_latent = self.encode_maps(map_elems_points[scene_inds], map_elems_exists[scene_inds])
+                return map_latent[inverse]
+        return self.encode_maps(map_elems_points, map_elems_exists)
+
+    def encode_maps(self, map_elems_points, map_elems_exists):
+        """
+        map_elems_points [batch_size x n_polygon_types x max_num_elem x max_points_per_elem x 2]
+        map_elems_exists [batch_size x n_polygon_types x max_num_elem]
+        """
         batch_size = map_elems_points.shape[0]
         poly_types_latents = torch.zeros((batch_size, self.n_polygon_types, self.dim_latent_polygon_type)
                                          , device=self.device)
@@ -114,8 +158,31 @@ class MapEncoder(nn.Module):
             poly_elems_exists = map_elems_exists[:, i_poly_type, :]     # [batch_size]
             poly_elems_latent = poly_encoder(poly_elems_points, poly_elems_exists)
             # Run PointNet to aggregate all polygon elements of this  polygon type
-            # note that non-existent elements have 0 value in poly_elems_latent
-            poly_types_latents[:, i_poly_type, :] = self.sets_aggregators[poly_type](poly_elems_latent)
+            # the non-existent elements are masked out, so the number of padding slots (which depends on the
+            # cropping / trimming of the batch) doesn't change the latent of a scene
+            poly_types_latents[:, i_poly_type, :] = self.sets_aggregators[poly_type](poly_elems_latent,
+                                                                                     poly_elems_exists)
+
+        poly_types_latents = poly_types_latents.view(batch_size,
+                                                     self.dim_latent_polygon_type * self.n_polygon_types)
+        map_latent = self.poly_types_aggregator(poly_types_latents)
+        return map_latent
+
+    def encode_packed_maps(self, packed_map):
+        """
+        Encode the maps with only the existing elements (the result is the same as of encode_maps on the padded maps,
+         where the padding elements are masked out of the sets)
+        """
+        batch_size = packed_map.batch_size
+        elems_scene = packed_map.elems_scene
+        poly_types_latents = torch.zeros((batch_size, self.n_polygon_types, self.dim_latent_polygon_type)
+                                         , device=self.device)
+        for i_poly_type, poly_type in enumerate(self.polygon_types):
+            is_poly_type = packed_map.elems_poly_type == i_poly_type
+            poly_elems_scene = elems_scene[is_poly_type]
+            poly_elems_latent = self.poly_encoder[poly_type].forward_packed(packed_map.elems_points[is_poly_type])
+            poly_types_latents[:, i_poly_type, :] = self.sets_aggregators[poly_type].forward_packed(
+                poly_elems_latent, poly_elems_scene, batch_size)
 
         poly_types_latents = poly_types_latents.view(batch_size,
                                                      self.dim_latent_polygon_type * self.n_polygon_types)
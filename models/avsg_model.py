@@ -53,6 +53,14 @@ class AvsgModel(BaseModel):
             parser.add_argument('--point_net_aggregate_func', type=str, default='sum', help='sum / max ')
             parser.add_argument('--lamb_loss_G_out_of_road', type=float, default=0., help=" ")
             parser.add_argument('--lamb_loss_G_collisions', type=float, default=0., help=" ")
+            parser.add_argument('--collisions_broad_phase', type=str, default='none',
+                                help=" 'none' (dense [batch x agents x agents] indicators) | 'circles' | 'grid' -"
+                                     " packed indicators of only the candidate agent pairs (overlapping bounding"
+                                     " circles, tested for all pairs, or for the pairs in neighboring cells of a"
+                                     " uniform grid). The other pairs have no penalty and are not in the"
+                                     " discriminator collisions sets (as pairs that don't intersect)")
+            parser.add_argument('--collisions_broad_phase_margin', type=float, default=2.,
+                                help='[m] Added to the bounding circles radii in the broad phase')
 
             # ~~~~ map encoder settings
             parser.add_argument('--dim_latent_polygon_elem', type=int, default=8, help='')
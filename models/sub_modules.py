@@ -63,7 +63,7 @@ class PointNet(nn.Module):
         if self.use_layer_norm:
             self.layer_normalizer = nn.LayerNorm(d_hid, device=self.device)
 
-    def forward(self, in_set):
+    def forward(self, in_set, in_set_valid=None):
         """'
             in_set  [batch_size x n_elements x feat_dim]
              each layer the function that operates on each element in the set x is
@@ -73,6 +73,8 @@ class PointNet(nn.Module):
              and finally  a linear layer gives the output
 
             input is a tensor of size [batch_size x num_set_elements x elem_dim]
+            in_set_valid [batch_size x n_elements] (optional) - the elements that are in the sets, the others are
+             excluded from the sums and from the aggregation (a set with no valid elements is aggregated to zeros)
 
         """
 
@@ -80,11 +82,12 @@ class PointNet(nn.Module):
         batch_size = h.shape[0]
         n_elements = h.shape[1]
         feat_dim = h.shape[2]
+        valid_weights = None if in_set_valid is None else in_set_valid.unsqueeze(-1).to(h.dtype)
         for i_layer in range(self.n_layers - 1):
             linearA = self.linearA[i_layer]
             linearB = self.linearB[i_layer]
             # find for each element coord now yje the sum over all elements in its set
-            h_sum = h.sum(dim=-2)
+            h_sum = h.sum(dim=-2) if valid_weights is None else (h * valid_weights).sum(dim=-2)
             h_sum = h_sum.repeat(n_elements, 1, 1)
             h_sum = torch.permute(h_sum, (1, 0, 2))
             sum_without_elem = h_sum - h
@@ -97,14 +100,74 @@ class PointNet(nn.Module):
             h = F.leaky_relu(h)
         # apply permutation invariant aggregation over all elements
         if self.point_net_aggregate_func == 'max':
-            h = h.max(dim=-2)
+            if valid_weights is None:
+                h = h.max(dim=-2).values
+            else:
+                h = h.masked_fill(valid_weights == 0, -torch.inf).max(dim=-2).values
+                h = torch.where(torch.isinf(h), 0., h)
         elif self.point_net_aggregate_func == 'sum':
-            h = h.sum(dim=-2)
+            h = h.sum(dim=-2) if valid_weights is None else (h * valid_weights).sum(dim=-2)
         else:
             raise NotImplementedError
         h = self.out_layer(h)
         return h
 
+    def forward_packed(self, in_elems, elems_set, n_sets):
+        """
+        The same as forward with in_set_valid, for sets that are given packed (only their valid elements):
+            in_elems  [n_elements x feat_dim] the elements of all the sets
+            elems_set  [n_elements] the set index of each element
+            n_sets - the number of sets (a set with no elements is aggregated to zeros)
+        """
+        h = in_elems  # [n_elements x feat_dim]
+        for i_layer in range(self.n_layers - 1):
+            linearA = self.linearA[i_layer]
+            linearB = self.linearB[i_layer]
+            # the sum over all elements in each set
+            h_sum = torch.zeros((n_sets, h.shape[-1]), dtype=h.dtype, device=h.device).index_add(0, elems_set, h)
+            h = linearA(h) + linearB(h_sum[elems_set] - h)
+            if self.use_layer_norm:
+                h = self.layer_normalizer(h)
+            h = F.leaky_relu(h)
+        # apply permutation invariant aggregation over all elements
+        if self.point_net_aggregate_func == 'max':
+            h = segment_max(h, elems_set, n_sets)
+            # a set with no elements aggregates to zeros (as in forward)
+            h = torch.where(torch.isneginf(h), 0., h)
+        elif self.point_net_aggregate_func == 'sum':
+            h = torch.zeros((n_sets, h.shape[-1]), dtype=h.dtype, device=h.device).index_add(0, elems_set, h)
+        else:
+            raise NotImplementedError
+        h = self.out_layer(h)
+        return h
+
+
+###############################################################################
+
+def segment_max(values, segments, n_segments):
+    """
+    The max of the values of each segment (-inf for an empty segment)
+        values [n_elements x feat_dim],  segments [n_elements] the segment index of each element
+        Returns [n_segments x feat_dim]
+    The values are sorted by segment, and a segmented prefix max (in log2(largest segment) steps) leaves the max of
+     each segment at its last element (torch 1.10 has no scatter max).
+    """
+    h_max = torch.full((n_segments, values.shape[-1]), -torch.inf, dtype=values.dtype, device=values.device)
+    if values.shape[0] == 0:
+        return h_max
+    segments, order = torch.sort(segments)
+    values = values[order]
+    max_segment_len = int(torch.bincount(segments).max())
+    shift = 1
+    while shift < max_segment_len:
+        is_same_segment = (segments[shift:] == segments[:-shift]).unsqueeze(-1)
+        shifted_max = torch.where(is_same_segment, torch.maximum(values[shift:], values[:-shift]), values[shift:])
+        values = torch.cat([values[:shift], shifted_max])
+        shift *= 2
+    is_last = torch.ones_like(segments, dtype=torch.bool)
+    is_last[:-1] = segments[1:] != segments[:-1]
+    return h_max.index_put((segments[is_last],), values[is_last])
+
 
 ###############################################################################
 
@@ -54,6 +54,13 @@ class BaseOptions:
         parser.add_argument('--batch_size', type=int, default=512, help='input batch size')
 
         parser.add_argument('--num_threads', default=0, type=int, help='# threads for loading data') # threads for loading data, can increase to 4 for faster run if no mem issues
+        parser.add_argument('--n_prefetch_batches', default=2, type=int,
+                            help='Number of batches loaded in the background, ahead of the training loop (0 - load in the training loop).'
+                                 ' With --num_threads 0 the batches are always loaded in the training loop')
+        parser.add_argument('--pin_memory', default=1, type=int,
+                            help='If 1 and running on GPU, the data batches are put in page-locked memory (for a faster copy to the GPU)')
+        parser.add_argument('--sampler_seed', default=-1, type=int,
+                            help='The data is reshuffled in each epoch with the seed sampler_seed + epoch (if negative, it is drawn from the global RNG)')
 
         # parser.add_argument('--max_dataset_size', type=int, default=float("inf"),
         #                     help='Maximum number of samples allowed per dataset. If the dataset directory contains more than max_dataset_size, only a subset is loaded.')
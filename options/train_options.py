@@ -63,5 +63,14 @@ class TrainOptions(BaseOptions):
                             help='frequency of generating visualization images (non-positive number = no images')
         parser.add_argument('--print_freq', type=int, default=5,
                             help='frequency of showing training results on console')
+        parser.add_argument('--val_cache_n_batches', type=int, default=0,
+                            help='If positive, the validation uses this many fixed batches, read once and kept on the'
+                                 ' device (otherwise a new batch is drawn from the validation data loader each time)')
+        parser.add_argument('--val_cache_mode', type=str, default='round_robin',
+                            help=" 'round_robin' (one cached batch per evaluation) | 'all' (average over all of them)")
+        parser.add_argument('--val_cache_augment', type=int, default=0,
+                            help='If 1, the cached batches are augmented with a fixed seed, if 0 they are not augmented')
+        parser.add_argument('--val_cache_seed', type=int, default=0,
+                            help='The seed of the selection (and of the augmentation) of the cached validation scenes')
 
         return parser
@@ -0,0 +1,151 @@
+"""Tests of the broad phase of the collision checks (--collisions_broad_phase): only the candidate pairs are solved,
+and they give the same collisions penalty and discriminator collisions features as the dense indicators of these pairs
+
+* To run:
+$ python -m pytest -q tests/test_collisions.py
+"""
+import types
+
+import pytest
+import torch
+
+from data.feature_schema import FeatureSchema
+from models.avsg_discriminator import CollisionsEncoder
+from models.avsg_func import get_agents_bounding_radii, get_collisions_indicators, get_collisions_penalty
+
+
+#########################################################################################
+
+def get_opt(collisions_broad_phase, point_net_aggregate_func='max'):
+    opt = types.SimpleNamespace(device=torch.device('cpu'),
+                                agent_feat_vec_coord_labels=['centroid_x', 'centroid_y', 'yaw_cos', 'yaw_sin', 'speed'],
+                                default_agent_extent_length=4., default_agent_extent_width=1.5,
+                                collisions_broad_phase=collisions_broad_phase, collisions_broad_phase_margin=2.,
+                                use_layer_norm=False, point_net_aggregate_func=point_net_aggregate_func)
+    opt.feature_schema = FeatureSchema(opt, {'polygon_types': [], 'closed_polygon_types': []})
+    return opt
+
+
+def get_agents(batch_size=5, max_n_agents=16, area_size=40., seed=0, all_exist=False):
+    """ Random agents in a square area (so there are colliding, near and far pairs), with some non-existent agents
+    (unless all_exist) """
+    generator = torch.Generator().manual_seed(seed)
+    centroids = (torch.rand((batch_size, max_n_agents, 2), generator=generator) - 0.5) * area_size
+    yaws = torch.rand((batch_size, max_n_agents), generator=generator) * 2 * torch.pi
+    speeds = torch.rand((batch_size, max_n_agents, 1), generator=generator) * 10
+    agents = torch.cat([centroids, torch.cos(yaws).unsqueeze(-1), torch.sin(yaws).unsqueeze(-1), speeds], dim=-1)
+    agents_num = torch.randint(0, max_n_agents + 1, (batch_size,), generator=generator)
+    agents_num[0] = max_n_agents
+    if all_exist:
+        agents_num[:] = max_n_agents
+    agents_exists = torch.arange(max_n_agents).unsqueeze(0) < agents_num.unsqueeze(1)
+    agents = agents * agents_exists.unsqueeze(-1)
+    return agents, {'agents_exists': agents_exists, 'n_agents_in_scene': agents_num}
+
+
+def get_dense_indicators(agents, conditioning, pairs_indicators=None):
+    """ The dense indicators, only of the candidate pairs of pairs_indicators (both orders) if given """
+    collisions_indicators = get_collisions_indicators(conditioning, agents, get_opt('none'))
+    if pairs_indicators is not None:
+        is_candidate = torch.zeros(collisions_indicators['valids'].shape[:3], dtype=torch.bool)
+        pairs = [pairs_indicators[name] for name in ['pairs_scene', 'pairs_i', 'pairs_j']]
+        is_candidate[pairs[0], pairs[1], pairs[2]] = True
+        is_candidate[pairs[0], pairs[2], pairs[1]] = True
+        valids = collisions_indicators['valids'] & is_candidate[..., None, None]
+        collisions_indicators = {'s1': collisions_indicators['s1'] * valids,
+                                 's2': collisions_indicators['s2'] * valids, 'valids': valids}
+    return collisions_indicators
+
+
+def get_penalty_and_grad(agents, conditioning, opt, use_candidates_of_opt=None):
+    """ The collisions penalty and its gradient, with the dense indicators of only the candidate pairs of
+    the broad phase of use_candidates_of_opt if given """
+    agents = agents.clone().requires_grad_(True)
+    if use_candidates_of_opt is None:
+        collisions_indicators = get_collisions_indicators(conditioning, agents, opt)
+    else:
+        collisions_indicators = get_dense_indicators(
+            agents, conditioning, get_collisions_indicators(conditioning, agents, use_candidates_of_opt))
+    penalty = get_collisions_penalty(conditioning, {'collisions_indicators': collisions_indicators}, opt)
+    penalty.backward()
+    return penalty.detach(), agents.grad
+
+
+def get_near_pairs(agents, conditioning, opt):
+    """ The pairs of existing agents (i < j) whose enlarged bounding circles overlap (a brute-force test) """
+    agents_exists = conditioning['agents_exists']
+    centroids = agents[:, :, opt.feature_schema.centroid_inds]
+    radii = get_agents_bounding_radii(agents, opt)
+    dists = (centroids[:, :, None, :] - centroids[:, None, :, :]).square().sum(dim=-1).sqrt()
+    is_near = dists <= radii[:, :, None] + radii[:, None, :] + opt.collisions_broad_phase_margin
+    is_near &= agents_exists[:, :, None] & agents_exists[:, None, :]
+    return set(map(tuple, torch.nonzero(is_near.triu(1)).tolist()))
+
+
+#########################################################################################
+
+@pytest.mark.parametrize('collisions_broad_phase', ['circles', 'grid'])
+@pytest.mark.parametrize('area_size', [15., 40., 200.])
+def test_broad_phase_penalty_equals_dense_of_candidates(collisions_broad_phase, area_size):
+    agents, conditioning = get_agents(area_size=area_size)
+    opt = get_opt(collisions_broad_phase)
+    penalty, grad = get_penalty_and_grad(agents, conditioning, opt)
+    penalty_dense, grad_dense = get_penalty_and_grad(agents, conditioning, get_opt('none'), use_candidates_of_opt=opt)
+    assert torch.allclose(penalty, penalty_dense, rtol=1e-5)
+    assert torch.allclose(grad, grad_dense, rtol=1e-4, atol=1e-6)
+    # the culled pairs only add the tails of their penalty terms to the dense penalty
+    penalty_all, _ = get_penalty_and_grad(agents, conditioning, get_opt('none'))
+    assert 0 < penalty_all
+    assert penalty <= penalty_all
+
+
+@pytest.mark.parametrize('collisions_broad_phase', ['circles', 'grid'])
+@pytest.mark.parametrize('point_net_aggregate_func', ['max', 'sum'])
+def test_broad_phase_discriminator_features_equal_dense_of_candidates(collisions_broad_phase,
+                                                                      point_net_aggregate_func):
+    agents, conditioning = get_agents()
+    torch.manual_seed(0)
+    collisions_enc = CollisionsEncoder(get_opt('none', point_net_aggregate_func))
+    with torch.no_grad():
+        pairs_indicators = get_collisions_indicators(conditioning, agents, get_opt(collisions_broad_phase))
+        enc = collisions_enc(pairs_indicators)
+        enc_dense = collisions_enc(get_dense_indicators(agents, conditioning, pairs_indicators))
+    assert enc.shape == enc_dense.shape
+    # the sums of the sets are in a different order (and the s1, s2 of nearly parallel sides are large)
+    assert torch.allclose(enc, enc_dense, rtol=1e-4, atol=1e-6 * float(enc_dense.abs().max()))
+
+
+def test_candidate_pairs_are_the_near_pairs():
+    agents, conditioning = get_agents(area_size=60.)
+    opt = get_opt('circles')
+    near_pairs = get_near_pairs(agents, conditioning, opt)
+    assert near_pairs
+    for collisions_broad_phase in ['circles', 'grid']:
+        indicators = get_collisions_indicators(conditioning, agents, get_opt(collisions_broad_phase))
+        candidates = list(zip(*[indicators[name].tolist() for name in ['pairs_scene', 'pairs_i', 'pairs_j']]))
+        assert len(candidates) == len(set(candidates))
+        assert set(candidates) == near_pairs
+    # no collision outside the candidate pairs (the intersections are not inside both sides)
+    dense_indicators = get_dense_indicators(agents, conditioning)
+    is_collision = dense_indicators['valids'] & (dense_indicators['s1'].abs() <= 1) \
+                   & (dense_indicators['s2'].abs() <= 1)
+    collision_pairs = torch.nonzero(is_collision.any(dim=-1).any(dim=-1).triu(1)).tolist()
+    assert set(map(tuple, collision_pairs)) <= near_pairs
+
+
+@pytest.mark.parametrize('collisions_broad_phase', ['circles', 'grid'])
+def test_solved_pairs_scale_with_near_pairs(collisions_broad_phase):
+    # the same density of agents in larger areas: the number of pairs grows quadratically with the number of agents,
+    # and the number of near pairs (and of solved pairs) linearly
+    opt = get_opt(collisions_broad_phase)
+    n_solved, n_near, n_all = [], [], []
+    for max_n_agents in [64, 256]:
+        agents, conditioning = get_agents(batch_size=2, max_n_agents=max_n_agents,
+                                          area_size=20. * max_n_agents ** 0.5, all_exist=True)
+        indicators = get_collisions_indicators(conditioning, agents, opt)
+        n_solved.append(indicators['valids'].shape[0])
+        n_near.append(len(get_near_pairs(agents, conditioning, opt)))
+        n_all.append(2 * max_n_agents * (max_n_agents - 1) // 2)
+    assert n_solved == n_near
+    assert n_solved[1] < 0.1 * n_all[1]
+    assert n_solved[1] / n_solved[0] < 0.5 * n_all[1] / n_all[0]
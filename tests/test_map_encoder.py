@@ -0,0 +1,77 @@
+"""Tests that the map latent of a scene doesn't depend on the padding of its batch (trimming, packing)
+
+* To run:
+$ python -m pytest -q tests/test_map_encoder.py
+"""
+import types
+
+import pytest
+import torch
+
+from data.avsg_transforms import TrimMapElems
+from data.packed_map import PackedMap
+from models.avsg_map_encoder import MapEncoder
+
+
+#########################################################################################
+
+def get_opt(point_net_aggregate_func, use_layer_norm):
+    feature_schema = types.SimpleNamespace(polygon_types=['lanes_mid', 'lanes_left', 'crosswalks'],
+                                           closed_polygon_types=['crosswalks'], n_polygon_types=3)
+    return types.SimpleNamespace(device=torch.device('cpu'), feature_schema=feature_schema,
+                                 dim_latent_polygon_elem=8, dim_latent_polygon_type=8, dim_latent_map=8,
+                                 n_conv_layers_polygon=2, kernel_size_conv_polygon=3, n_layers_sets_aggregator=3,
+                                 n_layers_poly_types_aggregator=2, use_layer_norm=use_layer_norm,
+                                 point_net_aggregate_func=point_net_aggregate_func)
+
+
+def get_map_feat(batch_size=6, n_polygon_types=3, max_num_elem=16, n_points=5, seed=0):
+    """ A padded map_feat of random maps, with scenes of very different sizes (and a scene with no elements) """
+    generator = torch.Generator().manual_seed(seed)
+    exists_prob = torch.linspace(0., 0.6, batch_size).view(-1, 1, 1)
+    map_elems_exists = torch.rand((batch_size, n_polygon_types, max_num_elem), generator=generator) < exists_prob
+    map_elems_points = torch.randn((batch_size, n_polygon_types, max_num_elem, n_points, 2), generator=generator)
+    map_elems_points = map_elems_points * map_elems_exists[..., None, None]
+    return {'map_elems_points': map_elems_points, 'map_elems_exists': map_elems_exists,
+            'map_elems_n_points_orig': map_elems_exists.long() * n_points}
+
+
+def to_packed(map_feat):
+    map_elems_exists = map_feat['map_elems_exists']
+    elems_scene, elems_poly_type, elems_slot = torch.nonzero(map_elems_exists, as_tuple=True)
+    scene_n_elems = torch.bincount(elems_scene, minlength=map_elems_exists.shape[0])
+    return PackedMap(elems_points=map_feat['map_elems_points'][elems_scene, elems_poly_type, elems_slot],
+                     elems_n_points_orig=map_feat['map_elems_n_points_orig'][elems_scene, elems_poly_type, elems_slot],
+                     elems_poly_type=elems_poly_type, elems_slot=elems_slot,
+                     scene_elems_offsets=torch.cat([scene_n_elems.new_zeros(1), torch.cumsum(scene_n_elems, dim=0)]),
+                     n_polygon_types=map_elems_exists.shape[1], max_num_elem=map_elems_exists.shape[2])
+
+
+def trim(map_feat):
+    return TrimMapElems()({'conditioning': {'map_feat': map_feat}})['conditioning']['map_feat']
+
+
+#########################################################################################
+
+@pytest.mark.parametrize('point_net_aggregate_func', ['max', 'sum'])
+@pytest.mark.parametrize('use_layer_norm', [False, True])
+def test_trimming_keeps_the_scene_map_latent(point_net_aggregate_func, use_layer_norm):
+    torch.manual_seed(0)
+    map_encoder = MapEncoder(get_opt(point_net_aggregate_func, use_layer_norm))
+    map_feat = get_map_feat()
+    batch_size = map_feat['map_elems_exists'].shape[0]
+    with torch.no_grad():
+        latent = map_encoder(dict(map_feat))
+        # each scene alone (with the dataset max_num_elem padding), and trimmed with the other scenes of the batch
+        latent_single = torch.cat([map_encoder({name: mat[i_scene:i_scene + 1] for name, mat in map_feat.items()})
+                                   for i_scene in range(batch_size)])
+        trimmed_map_feat = trim(dict(map_feat))
+        latent_trimmed = map_encoder(trimmed_map_feat)
+        # trimmed with a different batch (the largest scene removed, so the trimmed max_num_elem is smaller)
+        latent_trimmed_part = map_encoder(trim({name: mat[:-1] for name, mat in map_feat.items()}))
+        latent_packed = map_encoder(to_packed(map_feat))
+        latent_packed_trimmed = map_encoder(trim(to_packed(map_feat)))
+    assert trimmed_map_feat['map_elems_exists'].shape[2] < map_feat['map_elems_exists'].shape[2]
+    for other_latent in [latent_single, latent_trimmed, latent_packed, latent_packed_trimmed]:
+        assert torch.allclose(other_latent, latent, atol=1e-5)
+    assert torch.allclose(latent_trimmed_part, latent[:-1], atol=1e-5)
@@ -0,0 +1,72 @@
+"""Tests that the matrices that are not preloaded to shared memory (--preload_data shm) are still read from the data
+file, e.g., the fields of other consumers that are fetched lazily
+
+* To run:
+$ python -m pytest -q tests/test_preload.py
+"""
+import pickle
+import types
+from pathlib import Path
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+from data.avsg_dataset import AvsgDataset
+
+
+#########################################################################################
+
+agent_labels = ['centroid_x', 'centroid_y', 'yaw_cos', 'yaw_sin', 'speed']
+
+
+def get_opt(preload_data):
+    return types.SimpleNamespace(agent_feat_vec_coord_labels=agent_labels, normalize_agent_coords='',
+                                 default_agent_extent_length=4., default_agent_extent_width=1.5,
+                                 max_num_agents=4, shuffle_agents_inds_flag=0, map_crop_radius=0., trim_map_elems=0,
+                                 augmentation_type='none', preload_data=preload_data, preload_max_gb=1., num_threads=0)
+
+
+def save_dataset(data_path, n_scenes=12, n_agents=6, n_polygon_types=2, max_num_elem=5, n_points=4, seed=0):
+    """ A small avsg dataset (info.pkl + data.h5) of random scenes """
+    rng = np.random.default_rng(seed)
+    yaws = rng.uniform(0., 2 * np.pi, (n_scenes, n_agents))
+    agents_feat_vecs = np.stack([rng.normal(0., 10., (n_scenes, n_agents)), rng.normal(0., 10., (n_scenes, n_agents)),
+                                 np.cos(yaws), np.sin(yaws), rng.uniform(0., 10., (n_scenes, n_agents))], axis=-1)
+    map_elems_exists = rng.random((n_scenes, n_polygon_types, max_num_elem)) < 0.7
+    mats = {'agents_feat_vecs': agents_feat_vecs.astype(np.float32),
+            'agents_num': rng.integers(1, n_agents + 1, n_scenes),
+            'map_elems_points': rng.normal(0., 20., (n_scenes, n_polygon_types, max_num_elem, n_points, 2)).astype(
+                np.float32),
+            'map_elems_exists': map_elems_exists,
+            'map_elems_n_points_orig': (map_elems_exists * n_points).astype(np.int32)}
+    with h5py.File(Path(data_path, 'data.h5'), 'w') as h5f:
+        for mat_name, mat in mats.items():
+            h5f.create_dataset(mat_name, data=mat)
+    saved_mats_info = {mat_name: {'entity': 'map' if mat_name.startswith('map') else 'agents'} for mat_name in mats}
+    dataset_props = {'n_scenes': n_scenes, 'polygon_types': ['lanes_mid', 'crosswalks'][:n_polygon_types],
+                     'closed_polygon_types': ['crosswalks'], 'agent_feat_vec_coord_labels': agent_labels,
+                     'max_num_elem': max_num_elem, 'max_points_per_elem': n_points}
+    with Path(data_path, 'info.pkl').open('wb') as fid:
+        pickle.dump({'dataset_props': dataset_props, 'saved_mats_info': saved_mats_info}, fid)
+    return mats
+
+
+#########################################################################################
+
+@pytest.mark.parametrize('preload_data', ['none', 'shm'])
+def test_lazy_fields_with_preload(tmp_path, preload_data):
+    mats = save_dataset(tmp_path)
+    dataset = AvsgDataset(get_opt(preload_data), str(tmp_path), consumers=['train'])
+    assert dataset.lazy_mat_names == ['map_elems_n_points_orig']
+    if preload_data == 'shm':
+        assert set(dataset.preloaded_mats.keys()) == set(dataset.read_mat_names)
+    indices = [7, 2, 3]
+    batch = dataset.__getitems__(indices)
+    map_feat = batch['conditioning']['map_feat']
+    assert 'map_elems_n_points_orig' not in map_feat
+    assert torch.equal(map_feat['map_elems_points'], torch.from_numpy(mats['map_elems_points'][indices]))
+    batch = dataset.fetch_lazy_fields(batch)
+    assert torch.equal(batch['conditioning']['map_feat']['map_elems_n_points_orig'],
+                       torch.from_numpy(mats['map_elems_n_points_orig'][indices]))
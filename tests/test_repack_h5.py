@@ -0,0 +1,86 @@
+"""Tests of the map coordinates encoding of data/repack_h5.py (int16 / float16 offsets) and its decoding
+
+* To run:
+$ python -m pytest -q tests/test_repack_h5.py
+"""
+import numpy as np
+import pytest
+import torch
+
+from data.avsg_transforms import decode_map_coords
+from data.repack_h5 import encode_map_points, get_encoding_error_bound
+
+
+#########################################################################################
+
+def encode_decode(points, is_real, coords_dtype, resolution):
+    """
+    Encode the padded map points [batch_size x n_polygon_types x max_num_elem x n_points x 2] as offsets from the
+    scenes bounding box centers (as repack_h5 does), and decode them like the training batches.
+    Returns the decoded points, the encoding max error and its bound
+    """
+    mins = np.where(is_real[..., np.newaxis], points, np.inf).reshape(points.shape[0], -1, 2).min(axis=1)
+    maxs = np.where(is_real[..., np.newaxis], points, -np.inf).reshape(points.shape[0], -1, 2).max(axis=1)
+    origins = (mins + maxs) / 2
+    encoded, max_error = encode_map_points(points, origins.reshape(-1, 1, 1, 1, 2), is_real, coords_dtype,
+                                           resolution, 'map_elems_points')
+    max_abs_offset = np.abs(np.where(is_real[..., np.newaxis], points - origins.reshape(-1, 1, 1, 1, 2), 0.)).max()
+    error_bound = get_encoding_error_bound(coords_dtype, resolution, max_abs_offset)
+    scale = resolution if coords_dtype == 'int16' else 1.
+    map_coords_pose = torch.from_numpy(np.concatenate([origins, np.zeros((len(origins), 1))], axis=-1)).float()
+    map_feat = {'map_elems_points': torch.from_numpy(encoded),
+                'map_coords_pose': map_coords_pose,
+                'map_coords_scale': torch.full((len(origins),), scale)}
+    batch = decode_map_coords({'conditioning': {'map_feat': map_feat}})
+    return batch['conditioning']['map_feat']['map_elems_points'].numpy(), max_error, error_bound
+
+
+def get_dists(points_a, points_b, is_real):
+    return np.sqrt(np.square(points_a.astype(np.float64) - points_b).sum(axis=-1))[is_real]
+
+
+#########################################################################################
+
+@pytest.mark.parametrize('coords_dtype, resolution', [('int16', 0.01), ('int16', 0.001), ('float16', 0.)])
+def test_round_trip_error_is_within_bound(coords_dtype, resolution):
+    rng = np.random.default_rng(0)
+    batch_size, n_polygon_types, max_num_elem, n_points = 8, 3, 10, 20
+    # scenes of up to ~60 m around a random location, as in the avsg datasets
+    centers = rng.uniform(-300., 300., size=(batch_size, 1, 1, 1, 2))
+    points = centers + rng.uniform(-30., 30., size=(batch_size, n_polygon_types, max_num_elem, n_points, 2))
+    is_real = rng.random((batch_size, n_polygon_types, max_num_elem, n_points)) < 0.8
+    decoded, max_error, error_bound = encode_decode(points, is_real, coords_dtype, resolution)
+    dists = get_dists(decoded, points, is_real)
+    if coords_dtype == 'int16':
+        # half a quantization step (scale = resolution) per axis
+        assert error_bound == pytest.approx(np.sqrt(2.) * resolution / 2)
+    assert max_error <= error_bound * (1 + 1e-6)
+    # the decoding is in float32 (coordinates of hundreds of meters)
+    assert dists.max() <= error_bound + 1e-4
+
+
+@pytest.mark.parametrize('coords_dtype, resolution', [('int16', 0.01), ('float16', 0.)])
+def test_extreme_offsets(coords_dtype, resolution):
+    # offsets at the limits of the encoding (the largest int16 value, the largest finite float16)
+    max_offset = np.iinfo(np.int16).max * resolution if coords_dtype == 'int16' else float(np.finfo(np.float16).max)
+    offsets = np.array([[0., 0.], [max_offset, -max_offset], [-max_offset, max_offset], [1e-7, -1e-7]])
+    is_real = np.ones(len(offsets), dtype=bool)
+    encoded, max_error = encode_map_points(offsets, np.zeros(2), is_real, coords_dtype, resolution, 'map_points')
+    assert np.all(np.isfinite(encoded.astype(np.float64)))
+    assert max_error <= get_encoding_error_bound(coords_dtype, resolution, max_offset) * (1 + 1e-6)
+
+
+@pytest.mark.parametrize('coords_dtype, resolution, max_offset', [('int16', 0.01, 400.), ('int16', 0.001, 40.),
+                                                                  ('float16', 0., 1e5)])
+def test_out_of_range_offsets_are_rejected(coords_dtype, resolution, max_offset):
+    offsets = np.array([[0., 0.], [max_offset, 0.]])
+    with pytest.raises(ValueError):
+        encode_map_points(offsets, np.zeros(2), np.ones(2, dtype=bool), coords_dtype, resolution, 'map_points')
+
+
+def test_non_real_points_are_ignored():
+    # the padding points may hold any value, they are encoded as zeros
+    offsets = np.array([[1., 2.], [1e9, -1e9]])
+    is_real = np.array([True, False])
+    encoded, _ = encode_map_points(offsets, np.zeros(2), is_real, 'int16', 0.01, 'map_points')
+    assert np.array_equal(encoded[1], np.zeros(2))
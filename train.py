@@ -27,7 +27,7 @@ Note: if you get CUDA Unknown error, try $ apt-get install nvidia-modprobe
 """
 import time
 
-from data.data_func import create_dataloader, get_next_batch_cyclic
+from data.data_func import create_dataloader, create_val_cache
 from models import create_model
 from options.train_options import TrainOptions
 from util.visualizer import Visualizer
@@ -36,8 +36,12 @@ from util.visualizer import Visualizer
 if __name__ == '__main__':
     run_start_time = time.time()
     opt = TrainOptions().parse()  # get training options
-    train_data_gen = create_dataloader(opt, data_path=opt.data_path_train)
-    val_data_gen = create_dataloader(opt, data_path=opt.data_path_val)
+    # only the matrices used in training / validation are read, the visualization fetches its own on demand
+    train_data_gen = create_dataloader(opt, data_path=opt.data_path_train, consumers=['train'])
+    if opt.val_cache_n_batches > 0:
+        val_data_gen = create_val_cache(opt, data_path=opt.data_path_val, consumers=['val'])
+    else:
+        val_data_gen = create_dataloader(opt, data_path=opt.data_path_val, consumers=['val'])
 
     model = create_model(opt)  # create a model given opt.model and other options
     opt.device = model.device
@@ -48,27 +52,24 @@ if __name__ == '__main__':
     start_time = time.time()
     for i in range(opt.n_iter):
         iter_start_time = time.time()  # timer for entire epoch
-        conditioning = None
-        real_actors = None
+        scenes_batch = None
         for i_step in range(opt.n_steps_D):
-            scenes_batch = get_next_batch_cyclic(train_data_gen)
-            conditioning, real_actors = scenes_batch['conditioning'], scenes_batch['agents_feat_vecs']
-            model.optimize_discriminator(opt, real_actors, conditioning)
+            scenes_batch = next(train_data_gen)
+            model.optimize_discriminator(opt, scenes_batch.agents_feat_vecs, scenes_batch)
 
         for i_step in range(opt.n_steps_G):
-            scenes_batch = get_next_batch_cyclic(train_data_gen)
-            conditioning, real_actors = scenes_batch['conditioning'], scenes_batch['agents_feat_vecs']
-            model.optimize_generator(opt, real_actors, conditioning)
+            scenes_batch = next(train_data_gen)
+            model.optimize_generator(opt, scenes_batch.agents_feat_vecs, scenes_batch)
 
         # update learning rates (must be after first model update step):
         model.update_learning_rate()
 
         # print training losses and save logging information to the log file and wandb charts:
         if i % opt.print_freq == 0:
-            visualizer.print_current_metrics(model, i, opt, conditioning, val_data_gen, run_start_time)
+            visualizer.print_current_metrics(model, i, opt, scenes_batch, val_data_gen, run_start_time)
         # Display visualizations:
         if i > 0 and i % opt.display_freq == 0:
-            visualizer.display_current_results(model, i, opt, conditioning, real_actors, val_data_gen)
+            visualizer.display_current_results(model, i, opt, scenes_batch, val_data_gen, train_data_gen)
 
         # cache our latest model every <save_latest_freq> iterations:
         if i > 0 and i % opt.save_latest_freq == 0:
@@ -77,5 +78,8 @@ if __name__ == '__main__':
             model.save_networks(save_suffix)
 
         print(f'End of iteration {i + 1}/{opt.n_iter}'
-              f', iter run time {(time.time() - iter_start_time):.2f} sec')
+              f', iter run time {(time.time() - iter_start_time):.2f} sec'
+              f', waited for training data {train_data_gen.pop_wait_time():.2f} sec')
+    train_data_gen.close()
+    val_data_gen.close()
     visualizer.wandb_run.finish()
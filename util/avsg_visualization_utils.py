@@ -106,8 +106,8 @@ def visualize_scene_feat(agents_feat_s, real_map, opt, title=''):
     map_points_s = real_map['map_elems_points']
     map_elems_availability_s = real_map['map_elems_exists']
     map_n_points_orig_s = real_map['map_elems_n_points_orig']
-    polygon_types = opt.polygon_types
-    closed_polygon_types = opt.closed_polygon_types
+    polygon_types = opt.feature_schema.polygon_types
+    closed_polygon_types = opt.feature_schema.closed_polygon_types
     centroids = [af['centroid'] for af in agents_feat_s]
     yaws = [af['yaw'] for af in agents_feat_s]
     # print('agents centroids: ', centroids)
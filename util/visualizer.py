@@ -8,9 +8,7 @@ import numpy as np
 import torch
 import wandb
 
-from data.avsg_utils import agents_feat_vecs_to_dicts, get_agents_descriptions, \
-    get_single_conditioning_from_batch
-from data.data_func import get_next_batch_cyclic
+from data.avsg_utils import agents_feat_vecs_to_dicts, get_agents_descriptions
 from util.avsg_visualization_utils import visualize_scene_feat
 from util.common_util import append_to_field, num_to_str, to_num
 
@@ -53,12 +51,13 @@ class Visualizer:
 
     # ==========================================================================
 
-    def print_current_metrics(self, model, i, opt, train_conditioning, val_data_gen, run_start_time):
+    def print_current_metrics(self, model, i, opt, train_batch, val_data_gen, run_start_time):
         """  print training losses and save logging information to the log file and wandblog charts
 
         Parameters:
             i_epoch (int) -- current epoch
             i_batch (int) -- current training iteration during this epoch (reset to 0 at the end of every epoch)
+            train_batch (SceneBatch) -- the last training batch
 
         """
         model.eval()
@@ -66,11 +65,16 @@ class Visualizer:
         metrics['train']['G'] = model.train_log_metrics_G
         metrics['train']['D'] = model.train_log_metrics_D
 
-        val_batch = get_next_batch_cyclic(val_data_gen)
-        val_conditioning, val_real_actors = val_batch['conditioning'], val_batch['agents_feat_vecs']
-
-        _, metrics['val']['G'] = model.get_G_losses(opt, val_real_actors, val_conditioning)
-        _, metrics['val']['D'] = model.get_D_losses(opt, val_real_actors, val_conditioning)
+        if getattr(opt, 'val_cache_mode', 'round_robin') == 'all' and hasattr(val_data_gen, 'batches'):
+            # the metrics are averaged over all the cached validation batches
+            val_batches = val_data_gen.batches
+        else:
+            val_batches = [next(val_data_gen)]
+        val_batch = val_batches[0]
+        for net_type, get_losses in [('G', model.get_G_losses), ('D', model.get_D_losses)]:
+            batches_metrics = [get_losses(opt, batch.agents_feat_vecs, batch)[1] for batch in val_batches]
+            metrics['val'][net_type] = {name: np.mean([batch_metrics[name] for batch_metrics in batches_metrics])
+                                        for name in batches_metrics[0].keys()}
 
         # add some more metrics
         # additional metrics:
@@ -78,7 +82,7 @@ class Visualizer:
                           'run_hours': (time.time() - run_start_time) / 60 ** 2}
 
         # sample several fake agents per map to calculate G out variance
-        for conditioning, data_type in [(train_conditioning, 'train'), (val_conditioning, 'val')]:
+        for conditioning, data_type in [(train_batch, 'train'), (val_batch, 'val')]:
             samples_fake_agents_vecs = []
             for i_generator_run in range(opt.G_variability_n_runs):
                 samples_fake_agents_vecs.append(model.netG(conditioning).detach())
@@ -155,11 +159,11 @@ class Visualizer:
 
     # ==========================================================================
 
-    def display_current_results(self, model, i, opt, train_conditioning, train_real_actors, val_data_gen):
+    def display_current_results(self, model, i, opt, train_batch, val_data_gen, train_data_gen=None):
         """Display current results
 b
          """
-        wandb_logs = get_images(model, i, opt, train_conditioning, train_real_actors, val_data_gen)
+        wandb_logs = get_images(model, i, opt, train_batch, val_data_gen, train_data_gen)
         if wandb_logs:
             for log_label, log_data in wandb_logs.items():
                 self.wandb_run.log({log_label: log_data})
@@ -167,26 +171,29 @@ b
     # ==========================================================================
 
 
-def get_images(model, i, opt, train_conditioning, train_real_actors, val_data_gen):
-    """Return visualization images. train.py will display these images with visdom, and save the images  """
+def get_images(model, i, opt, train_batch, val_data_gen, train_data_gen=None):
+    """Return visualization images. train.py will display these images with visdom, and save the images
+    The fields that are used only by the visualization are fetched by the data generators, for the plotted scenes only.
+    """
 
     vis_n_maps = min(opt.vis_n_maps, opt.batch_size)  # how many maps to visualize
     vis_n_generator_runs = opt.vis_n_generator_runs  # how many sampled fake agents per map to visualize
-    validation_batch = get_next_batch_cyclic(val_data_gen)
-    val_conditioning, val_real_actors = validation_batch['conditioning'], validation_batch['agents_feat_vecs']
+    val_batch = next(val_data_gen)
 
     wandb_logs = {}
     if opt.display_freq <= 0:
         return wandb_logs
     model.eval()
-    for dataset_name, real_agents_vecs_batch, conditioning_batch \
-            in [('train', train_real_actors, train_conditioning), ('val', val_real_actors, val_conditioning)]:
-        for i_map in range(vis_n_maps):
+    for dataset_name, scenes_batch, data_gen in [('train', train_batch, train_data_gen),
+                                                 ('val', val_batch, val_data_gen)]:
+        for i_map in range(min(vis_n_maps, len(scenes_batch))):
             log_label = f"images/{dataset_name}/map_{i_map}"
             wandb_logs[log_label] = []
             # take data of current scene:
-            real_agents_vecs = real_agents_vecs_batch[i_map].unsqueeze(0)
-            conditioning = get_single_conditioning_from_batch(conditioning_batch, i_map)
+            conditioning = scenes_batch.select(i_map)
+            if data_gen is not None:
+                conditioning = data_gen.fetch_lazy_fields(conditioning)
+            real_agents_vecs = conditioning.agents_feat_vecs
             # create an image of the map & real agents
             img, wandb_img = get_wandb_image(model, conditioning, real_agents_vecs, opt, caption_prefix='real',
                                              title=f'{dataset_name}_iter_{i + 1}_map_{i_map + 1}_real')